@@ -0,0 +1,138 @@
+from django.conf import settings
+from django.core.cache import caches
+import threading
+import time
+
+from cafb_scan_api.process_upc import Food, ITEM_NOT_FOUND
+from cafb_scan_api.rules import engine
+from cafb_scan_api.metrics import timed
+from cafb_scan_api.catalog import catalog
+from cafb_scan_api.gtin import canonical
+
+# per-process hit/miss counters (+= isn't atomic, so they're bumped under the lock)
+counters = {'hits': 0, 'unknown_hits': 0, 'catalog_hits': 0, 'misses': 0}
+counters_lock = threading.Lock()
+
+
+def count(name):
+	with counters_lock:
+		counters[name] += 1
+
+
+def wellness_cache():
+	return caches[getattr(settings, 'WELLNESS_CACHE', 'default')]
+
+
+def rule_version():
+	'''
+	The current rule version. It lives in the database (see RuleEngine.sync), so every process sees a bump within RULE_VERSION_TTL seconds, whether or not the cache is shared.
+	'''
+	return engine.version
+
+
+def bump_rule_version():
+	'''
+	Call whenever rules, categories or scores change. Every cached answer keyed on the old version stops being used, in every process.
+	'''
+	engine.bump()
+
+
+def result_key(gtin, food_cat, version):
+	return 'wellness:%s:%s:%s' % (version, gtin, food_cat)
+
+
+def unknown_key(gtin, version):
+	# versioned too, so bump_rule_version() (after an import, say) forgets them all
+	return 'wellness:unknown:%s:%s' % (version, gtin)
+
+
+def changed_key(gtin):
+	return 'wellness:changed:%s' % gtin
+
+
+def invalidate_upc(gtin):
+	'''
+	Stops every cached answer for one product (by UPC.gtin) being used, whatever food_cat it was asked for with, plus any "unknown" entry for it.
+	Notes when it changed; cached_food() only trusts entries made when that note was the same, and the catalogue (catalog.py) isn't trusted for the product until the next build.
+	A process-local cache can't tell the other workers, so then every cached answer, everywhere, is dropped instead.
+	'''
+	if gtin is None:
+		# never looked up, so never cached
+		return
+	if not getattr(settings, 'WELLNESS_CACHE_SHARED', False):
+		bump_rule_version()
+		return
+	cache = wellness_cache()
+	version = rule_version()
+	# the usual ones, in case the note is evicted; the note covers the rest
+	keys = [result_key(gtin, food_cat, version) for food_cat in list(engine.categories) + [None]]
+	keys.append(unknown_key(gtin, version))
+	cache.delete_many(keys)
+	cache.set(changed_key(gtin), int(time.time() * 1000), None)
+
+
+class CachedFood(object):
+	'''
+	The parts of a Food that scan_view needs, as they come out of the cache.
+	'''
+
+	def __init__(self, food_info, api_response, wellness, upc_pk, food_cat_pk):
+		self.food_info = food_info
+		self.api_response = api_response
+		self.wellness = wellness
+		self.upc_pk = upc_pk
+		self.food_cat_pk = food_cat_pk
+
+
+def cached_food(upc_code, food_cat, api_key, api_id):
+	'''
+	Food(...) with a cache in front, keyed by (GTIN, food_cat, rule_version), so every spelling of a barcode shares one entry.
+	UPCs neither API knows are remembered for WELLNESS_UNKNOWN_TTL, so we don't keep asking. Misses because an API was down, slow or out of quota aren't, so the next scan asks again.
+	On a cache miss, products already scored come out of the memory-mapped catalogue (catalog.py) when there is one, before the database is asked.
+	'''
+	cache = wellness_cache()
+	version = rule_version()
+
+	gtin = canonical(upc_code)
+	if gtin is None:
+		# not a barcode; Food answers with an error without looking anything up
+		return Food(upc_code, food_cat, api_key, api_id)
+
+	key = result_key(gtin, food_cat, version)
+	with timed('cache'):
+		hit = cache.get_many([key, unknown_key(gtin, version), changed_key(gtin)])
+	# entries are (CachedFood args, the product's change note when they were made)
+	changed = hit.get(changed_key(gtin))
+	if key in hit and hit[key][1] == changed:
+		count('hits')
+		return CachedFood(*hit[key][0])
+	if unknown_key(gtin, version) in hit and hit[unknown_key(gtin, version)][1] == changed:
+		count('unknown_hits')
+		return CachedFood(*hit[unknown_key(gtin, version)][0])
+
+	if getattr(settings, 'CATALOG_ENABLED', True):
+		with timed('catalog'):
+			found = catalog.lookup(gtin, food_cat, engine.fingerprint, changed)
+		if found is not None:
+			count('catalog_hits')
+			food_info, wellness, upc_pk = found
+			return CachedFood(food_info, {'success': 'Wellness Score already calculated.'}, wellness, upc_pk, engine.food_cat_pk(food_cat))
+
+	count('misses')
+	item = Food(upc_code, food_cat, api_key, api_id)
+
+	if item.upc_pk is not None:
+		api_response = {'success': 'Wellness Score already calculated.'} if item.wellness is not None else {'success': 'Already in database'}
+		cache.set(key, ((item.food_info, api_response, item.wellness, item.upc_pk, item.food_cat_pk), changed), getattr(settings, 'WELLNESS_CACHE_TTL', 60 * 60 * 24))
+	elif item.api_response == {'error': ITEM_NOT_FOUND}:
+		cache.set(unknown_key(gtin, version), ((item.food_info, item.api_response, item.wellness, item.upc_pk, item.food_cat_pk), changed), getattr(settings, 'WELLNESS_UNKNOWN_TTL', 60 * 15))
+
+	return item
+
+
+def stats():
+	'''
+	Hit/miss counters for this process.
+	'''
+	lookups = sum(counters.values())
+	return dict(counters, lookups=lookups, hit_rate=float(counters['hits'] + counters['unknown_hits'] + counters['catalog_hits']) / lookups if lookups else None, rule_version=rule_version())
@@ -0,0 +1,203 @@
+'''
+A read-only, memory-mapped copy of the scored catalogue, so scans of products we already know don't touch the database.
+
+A build is a directory with:
+	gtin.npy    every product's GTIN-14 (UPC.gtin) as an int64, sorted (binary searched)
+	rows.npy    per product, in the same order: UPC pk, a bit per food category saying whether it has a score, the wellness bits, and where its JSON is in blobs.bin
+	blobs.bin   each product's UPC row as JSON, exactly what the app gets back as "product"
+	meta.json   the food categories (bit order), the rule fingerprint and when the build started
+CATALOG_DIR/current is a symlink to the live build. build() writes a new directory and swaps the link in one rename, so workers never see half a catalogue.
+Workers map the files read-only, so they all share one copy through the page cache, and notice a new build within CATALOG_CHECK_INTERVAL seconds.
+
+Lookups give up (and the scan goes to the database as before) when the rules have changed since the build, when the UPC was changed after it (see cache.invalidate_upc), or when the product has no score for the category.
+Both of those are learnt through the wellness cache, so with more than one worker it has to be shared (see CATALOG_ENABLED in production.py).
+'''
+from array import array
+from django.conf import settings
+import json
+import mmap
+import numpy as np
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from cafb_scan_api.models import UPC, CurrentWellScore
+from cafb_scan_api.rules import RuleEngine, fingerprint
+
+CATALOG_DIR = getattr(settings, 'CATALOG_DIR', os.path.join(tempfile.gettempdir(), 'cafb_catalog'))
+CHECK_INTERVAL = getattr(settings, 'CATALOG_CHECK_INTERVAL', 30)
+CHUNK_SIZE = 5000
+
+# one bit per food category in a uint64
+MAX_CATEGORIES = 64
+
+ROW = np.dtype([('upc_pk', np.int64), ('scored', np.uint64), ('wellness', np.uint64), ('start', np.int64), ('end', np.int64)])
+
+
+def to_key(gtin):
+	'''
+	The int64 key for a GTIN-14, or None if there isn't one.
+	'''
+	if not gtin:
+		return None
+	return int(gtin)
+
+
+class Build(object):
+	'''
+	One catalogue build, mapped into memory.
+	'''
+
+	def __init__(self, path):
+		self.path = path
+		with open(os.path.join(path, 'meta.json')) as f:
+			meta = json.load(f)
+		self.fingerprint = meta['fingerprint']
+		self.built_at = meta['built_at']
+		self.bits = dict((load_cat, bit) for bit, load_cat in enumerate(meta['categories']))
+		self.gtins = np.load(os.path.join(path, 'gtin.npy'), mmap_mode='r')
+		self.rows = np.load(os.path.join(path, 'rows.npy'), mmap_mode='r')
+		with open(os.path.join(path, 'blobs.bin'), 'rb') as f:
+			# an empty file can't be mapped
+			self.blobs = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else ''
+
+	def __len__(self):
+		return len(self.gtins)
+
+	def lookup(self, gtin, food_cat):
+		'''
+		Returns (food_info, wellness, upc_pk), or None if the product or its score for the category isn't in the build.
+		'''
+		key = to_key(gtin)
+		bit = self.bits.get(None if food_cat is None else str(food_cat))
+		if key is None or bit is None:
+			return None
+
+		i = int(np.searchsorted(self.gtins, key))
+		if i == len(self.gtins) or self.gtins[i] != key:
+			return None
+		upc_pk, scored, wellness, start, end = self.rows[i].item()
+		if not scored >> bit & 1:
+			return None
+
+		return json.loads(self.blobs[start:end]), bool(wellness >> bit & 1), upc_pk
+
+
+class Catalog(object):
+	'''
+	The live build in CATALOG_DIR, reloaded when a new one is swapped in.
+	'''
+
+	def __init__(self, directory=CATALOG_DIR, check_interval=CHECK_INTERVAL):
+		self.directory = directory
+		self.check_interval = check_interval
+		self.build = None
+		self.checked = 0
+		self.lock = threading.Lock()
+
+	def current(self):
+		if time.time() - self.checked >= self.check_interval:
+			with self.lock:
+				if time.time() - self.checked >= self.check_interval:
+					path = os.path.realpath(os.path.join(self.directory, 'current'))
+					if not os.path.isdir(path):
+						self.build = None
+					elif self.build is None or self.build.path != path:
+						try:
+							self.build = Build(path)
+						except (IOError, OSError, ValueError):
+							# swapped out from under us; try again next time
+							self.build = None
+					self.checked = time.time()
+		return self.build
+
+	def lookup(self, gtin, food_cat, rule_fingerprint, changed_at=None):
+		'''
+		(food_info, wellness, upc_pk) from the live build, or None if there isn't one or it can't be trusted for this scan.
+		changed_at is when the UPC was last changed (ms), if we know.
+		'''
+		build = self.current()
+		if build is None or build.fingerprint != rule_fingerprint:
+			return None
+		if changed_at is not None and changed_at >= build.built_at:
+			return None
+		return build.lookup(gtin, food_cat)
+
+
+catalog = Catalog()
+
+
+def build(directory=CATALOG_DIR, chunk_size=CHUNK_SIZE):
+	'''
+	Builds a new catalogue from the UPC and CurrentWellScore tables and makes it the live one.
+	Returns the number of products in it.
+	'''
+	# anything changed from here on is newer than the build
+	built_at = int(time.time() * 1000)
+	rules = RuleEngine().load()
+	categories = sorted(rules)[:MAX_CATEGORIES]
+	bits = dict((rules[load_cat].id, bit) for bit, load_cat in enumerate(categories))
+
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	path = tempfile.mkdtemp(dir=directory, prefix='build-')
+
+	gtins, upc_pks, scored, wellness, starts, ends = array('l'), array('l'), array('L'), array('L'), array('l'), array('l')
+	offset = 0
+	last = 0
+	with open(os.path.join(path, 'blobs.bin'), 'wb') as blobs:
+		while True:
+			products = list(UPC.objects.filter(pk__gt=last).order_by('pk').values()[:chunk_size])
+			if not products:
+				break
+			last = products[-1]['id']
+
+			rows = CurrentWellScore.objects.filter(upc_id__gte=products[0]['id'], upc_id__lte=last, nut_id__in=bits.keys()).exclude(wellness=None).values_list('upc_id', 'nut_id', 'wellness')
+			latest = dict(((upc_id, nut_id), well) for upc_id, nut_id, well in rows)
+
+			for product in products:
+				key = to_key(product['gtin'])
+				if key is None:
+					# not a valid barcode, so nothing can scan it
+					continue
+				scored_bits = wellness_bits = 0
+				for nut_id, bit in bits.items():
+					well = latest.get((product['id'], nut_id))
+					if well is not None:
+						scored_bits |= 1 << bit
+						wellness_bits |= int(well) << bit
+				blob = json.dumps(product, default=lambda x: str(x))
+				blobs.write(blob)
+
+				gtins.append(key)
+				upc_pks.append(product['id'])
+				scored.append(scored_bits)
+				wellness.append(wellness_bits)
+				starts.append(offset)
+				ends.append(offset + len(blob))
+				offset += len(blob)
+
+	# sorted for binary search (UPC.gtin is unique, so there are no ties)
+	gtins = np.array(gtins, dtype=np.int64)
+	order = np.argsort(gtins)
+
+	rows = np.zeros(len(order), dtype=ROW)
+	for name, column in (('upc_pk', upc_pks), ('scored', scored), ('wellness', wellness), ('start', starts), ('end', ends)):
+		rows[name] = np.array(column, dtype=ROW[name])[order]
+	np.save(os.path.join(path, 'gtin.npy'), gtins[order])
+	np.save(os.path.join(path, 'rows.npy'), rows)
+	with open(os.path.join(path, 'meta.json'), 'w') as f:
+		json.dump({'categories': categories, 'fingerprint': fingerprint(rules), 'built_at': built_at, 'products': len(order)}, f)
+
+	# swap the link in one go, then clear out older builds (workers still mapping them keep their pages until they move on)
+	link = os.path.join(directory, 'current')
+	temp_link = os.path.join(directory, 'current.%d' % os.getpid())
+	os.symlink(os.path.basename(path), temp_link)
+	os.rename(temp_link, link)
+	for name in os.listdir(directory):
+		if name.startswith('build-') and os.path.join(directory, name) != path:
+			shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+	return len(order)
@@ -0,0 +1,125 @@
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urlparse import urlsplit
+import requests
+import threading
+import time
+
+POOL_SIZE = getattr(settings, 'UPSTREAM_POOL_SIZE', 10)
+RETRIES = getattr(settings, 'UPSTREAM_RETRIES', 2)
+BACKOFF = getattr(settings, 'UPSTREAM_BACKOFF', 0.1)
+BREAKER_THRESHOLD = getattr(settings, 'UPSTREAM_BREAKER_THRESHOLD', 5)
+BREAKER_COOLDOWN = getattr(settings, 'UPSTREAM_BREAKER_COOLDOWN', 30.0)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class UpstreamError(Exception):
+	'''
+	An upstream API couldn't be reached, kept failing, or is switched off by its circuit breaker.
+	'''
+	pass
+
+
+class CircuitBreaker(object):
+	'''
+	Stops calling a host after BREAKER_THRESHOLD failures in a row.
+	After BREAKER_COOLDOWN seconds one call is let through to see if it's back; success closes the breaker, failure opens it again.
+	'''
+
+	def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self.failures = 0
+		self.opened_at = None
+		self.trying = False
+		self.lock = threading.Lock()
+
+	@property
+	def state(self):
+		if self.opened_at is None:
+			return 'closed'
+		return 'half-open' if time.time() - self.opened_at >= self.cooldown else 'open'
+
+	def allow(self):
+		with self.lock:
+			state = self.state
+			if state == 'closed':
+				return True
+			if state == 'half-open' and not self.trying:
+				self.trying = True
+				return True
+			return False
+
+	def success(self):
+		with self.lock:
+			self.failures = 0
+			self.opened_at = None
+			self.trying = False
+
+	def failure(self):
+		with self.lock:
+			self.failures += 1
+			self.trying = False
+			if self.failures >= self.threshold:
+				self.opened_at = time.time()
+
+
+class Host(object):
+	'''
+	A keep-alive session (connection pool) and circuit breaker for one upstream host.
+	'''
+
+	def __init__(self):
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+		self.session.headers.update({"Accept": "application/json"})
+		self.breaker = CircuitBreaker()
+
+
+hosts = {}
+hosts_lock = threading.Lock()
+
+
+def host(url):
+	netloc = urlsplit(url).netloc
+	if netloc not in hosts:
+		with hosts_lock:
+			hosts.setdefault(netloc, Host())
+	return hosts[netloc]
+
+
+def get(url, timeout=None, retries=RETRIES, backoff=BACKOFF):
+	'''
+	GET through the host's pooled session. 429 and 5xx responses and connection errors are retried with exponential backoff.
+	Returns the final requests.Response; raises UpstreamError if the host is unreachable, keeps failing, or its breaker is open.
+	'''
+	upstream = host(url)
+	if not upstream.breaker.allow():
+		raise UpstreamError('circuit open for %s' % urlsplit(url).netloc)
+
+	for attempt in range(retries + 1):
+		if attempt:
+			time.sleep(backoff * 2 ** (attempt - 1))
+		try:
+			response = upstream.session.get(url, timeout=timeout)
+		except requests.RequestException as e:
+			error = e
+			continue
+		if response.status_code not in RETRY_STATUSES:
+			upstream.breaker.success()
+			return response
+		error = 'HTTP %d' % response.status_code
+
+	upstream.breaker.failure()
+	# just the host: the query string can hold API keys, and this ends up in logs
+	raise UpstreamError('%s failed after %d tries: %s' % (urlsplit(url).netloc, retries + 1, error))
+
+
+def status():
+	'''
+	Breaker state for each host we've talked to.
+	'''
+	return dict((netloc, {'state': h.breaker.state, 'failures': h.breaker.failures}) for netloc, h in hosts.items())
@@ -0,0 +1,85 @@
+from django.conf import settings
+from django.core.cache import caches
+import threading
+import time
+
+# how long a worker may hold the fetch lock for a UPC; a bit longer than an upstream lookup can take
+LOCK_TIMEOUT = getattr(settings, 'UPSTREAM_DEADLINE', 3.0) + 2.0
+POLL_INTERVAL = 0.05
+
+
+class Call(object):
+	def __init__(self):
+		self.event = threading.Event()
+		self.result = None
+		self.error = None
+
+
+class SingleFlight(object):
+	'''
+	Runs at most one call per key at a time within this process.
+	Anyone who asks for a key that's already in flight waits for that call and gets its result (or its exception).
+	'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.calls = {}
+
+	def do(self, key, fn, *args):
+		'''
+		Returns (result, leader); leader is True for the caller that actually ran fn.
+		'''
+		with self.lock:
+			call = self.calls.get(key)
+			leader = call is None
+			if leader:
+				call = self.calls[key] = Call()
+
+		if not leader:
+			call.event.wait()
+			if call.error is not None:
+				raise call.error
+			return call.result, False
+
+		try:
+			call.result = fn(*args)
+		except Exception as e:
+			call.error = e
+			raise
+		finally:
+			with self.lock:
+				del self.calls[key]
+			call.event.set()
+		return call.result, True
+
+
+def lock_cache():
+	return caches[getattr(settings, 'WELLNESS_CACHE', 'default')]
+
+
+def acquire(key):
+	'''
+	Takes the cross-worker lock for key. Only works across workers if the cache backend is shared.
+	'''
+	return lock_cache().add('lock:%s' % key, 1, LOCK_TIMEOUT)
+
+
+def release(key):
+	lock_cache().delete('lock:%s' % key)
+
+
+def wait_for(key, ready):
+	'''
+	Waits while another worker holds the lock for key, until ready() returns something or the lock goes away.
+	Returns whatever ready() returned last.
+	'''
+	cache = lock_cache()
+	give_up = time.time() + LOCK_TIMEOUT
+	found = ready()
+	while not found and cache.get('lock:%s' % key) is not None and time.time() < give_up:
+		time.sleep(POLL_INTERVAL)
+		found = ready()
+	return found or ready()
+
+
+fetches = SingleFlight()
@@ -0,0 +1,122 @@
+'''
+Streaming CSV / JSON-lines exports of the Scan, UPC and WellScore tables, for reporting.
+
+Rows are fetched CHUNK_SIZE at a time by primary key ("id > last ORDER BY id LIMIT n" on the index) and written out as they come, so an export of millions of scans holds one chunk in memory, not the whole table (and not the whole result set, which the database drivers would otherwise buffer).
+Columns are the same as the flat (?flat=1) API serializers; related codes come from joins in the same query.
+Exports can be filtered by created range, food category and scan status (see queryset()), and gzipped.
+'''
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from collections import OrderedDict
+from datetime import datetime, time, timedelta
+import csv
+import json
+
+from cafb_scan_api.serializers import FlatScanSerializer, FlatUPCSerializer, FlatWellScoreSerializer
+
+CHUNK_SIZE = getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+
+
+class ExportError(ValueError):
+	pass
+
+
+# name: (flat serializer, {its looked-up fields: the columns they come from}, {filter: column})
+TABLES = {
+	'scan': (FlatScanSerializer, {'upc_code': 'upc_id__upc_code', 'load_cat': 'food_cat_id__load_cat'}, {'food_cat': 'food_cat_id__load_cat', 'scan_status': 'scan_status'}),
+	'upc': (FlatUPCSerializer, {}, {}),
+	'wellscore': (FlatWellScoreSerializer, {'upc_code': 'upc_id__upc_code', 'load_cat': 'nut_id__food_cat_id__load_cat'}, {'food_cat': 'nut_id__food_cat_id__load_cat'}),
+}
+
+FORMATS = ('csv', 'ndjson')
+
+
+def parse_time(value, end=False):
+	'''
+	A query string date or datetime as an aware datetime; a bare date means the start of that day (or, with end, the start of the next one).
+	'''
+	moment = parse_datetime(value)
+	if moment is None:
+		day = parse_date(value)
+		if day is None:
+			raise ExportError('%s is not a date or datetime (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS).' % value)
+		moment = datetime.combine(day + timedelta(days=1) if end else day, time())
+	if timezone.is_naive(moment):
+		moment = timezone.make_aware(moment)
+	return moment
+
+
+def queryset(table, params):
+	'''
+	The rows of a table to export, filtered by the query string:
+	?since= / ?until= (created on or after / before; dates or datetimes, until a date includes that day), ?food_cat= (load_cat; scans and scores) and ?scan_status= (scans).
+	'''
+	serializer, related, filters = TABLES[table]
+	rows = serializer.Meta.model.objects.all()
+	try:
+		if params.get('since'):
+			rows = rows.filter(created__gte=parse_time(params['since']))
+		if params.get('until'):
+			rows = rows.filter(created__lt=parse_time(params['until'], end=True))
+	except ValueError as e:
+		raise ExportError(str(e))
+	for name in ('food_cat', 'scan_status'):
+		if params.get(name):
+			if name not in filters:
+				raise ExportError('The %s export can\'t be filtered by %s.' % (table, name))
+			rows = rows.filter(**{filters[name]: params[name]})
+	return rows
+
+
+def chunks(rows, columns):
+	'''
+	Yields lists of row tuples, CHUNK_SIZE at a time in id order.
+	'''
+	last = 0
+	while True:
+		chunk = list(rows.filter(pk__gt=last).order_by('pk').values_list('pk', *columns)[:CHUNK_SIZE])
+		if not chunk:
+			return
+		last = chunk[-1][0]
+		yield [row[1:] for row in chunk]
+
+
+def cell(value):
+	if value is None:
+		return ''
+	if isinstance(value, datetime):
+		return value.isoformat()
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+
+class Line(object):
+	# csv only writes to files; this hands back what it would have written
+	def write(self, value):
+		return value
+
+
+def csv_lines(rows, fields, columns):
+	writer = csv.writer(Line())
+	yield writer.writerow(fields)
+	for chunk in chunks(rows, columns):
+		yield ''.join(writer.writerow([cell(value) for value in row]) for row in chunk)
+
+
+def ndjson_lines(rows, fields, columns):
+	for chunk in chunks(rows, columns):
+		yield ''.join(json.dumps(OrderedDict(zip(fields, row)), default=lambda x: x.isoformat(), separators=(',', ':')) + '\n' for row in chunk)
+
+
+def lines(table, fmt, rows):
+	'''
+	The export as an iterator of strings, one chunk of rows each (csv starts with a header row).
+	'''
+	serializer, related, filters = TABLES[table]
+	fields = list(serializer.Meta.fields)
+	columns = [related.get(name, name) for name in fields]
+	if fmt == 'csv':
+		return csv_lines(rows, fields, columns)
+	return ndjson_lines(rows, fields, columns)
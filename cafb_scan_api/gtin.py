@@ -0,0 +1,47 @@
+'''
+Barcodes come to us as UPC-A (12 digits), EAN-13, GTIN-14, EAN-8, or with leading zeros dropped (products.csv has 12000017421 for 012000017421).
+They're all the same GTIN once zero padded to 14 digits, which is what UPC.gtin stores and everything looks products up by.
+'''
+
+
+def check_digit(body):
+	'''
+	The GS1 mod 10 check digit for a string of digits: weights 3, 1, 3, ... from the right.
+	'''
+	total = sum(int(digit) * (3 if i % 2 == 0 else 1) for i, digit in enumerate(reversed(body)))
+	return str((10 - total % 10) % 10)
+
+
+def with_check_digit(body):
+	'''
+	A valid code from its digits minus the check digit.
+	'''
+	return body + check_digit(body)
+
+
+def canonical(code):
+	'''
+	The GTIN-14 for a barcode, or None if it isn't one (not digits, too long, or a bad check digit).
+	'''
+	if code is None:
+		return None
+	code = code.strip()
+	if not code.isdigit() or len(code) > 14 or not code.strip('0'):
+		return None
+	code = code.zfill(14)
+	if check_digit(code[:-1]) != code[-1]:
+		return None
+	return code
+
+
+def short(gtin):
+	'''
+	The form the upstream APIs know a GTIN-14 by: EAN-8, UPC-A or EAN-13 if it fits, else the GTIN-14 itself.
+	'''
+	if gtin.startswith('000000'):
+		return gtin[6:]
+	if gtin.startswith('00'):
+		return gtin[2:]
+	if gtin.startswith('0'):
+		return gtin[1:]
+	return gtin
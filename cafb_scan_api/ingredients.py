@@ -0,0 +1,96 @@
+'''
+Ingredient statements, parsed once when a product is written instead of on every scan.
+
+Each UPC row gets first_ingredient (its first ingredient, lowercased, whitespace collapsed) and an IngredientToken row per word in its ingredients, flagged if the word is in the first ingredient.
+So "which products have whole grain first" is an indexed query (see matching()), and update_well_score scores ingredient rules from the index instead of string processing every product.
+Anything that writes UPC.ingredients calls reindex() on the rows it wrote.
+'''
+import re
+
+from cafb_scan_api.models import UPC, IngredientToken
+
+WORD = re.compile(r'\w+', re.UNICODE)
+CHUNK_SIZE = 500
+
+
+def normalize(text):
+	return u' '.join(text.lower().split())
+
+
+def first_ingredient(ingredients):
+	'''
+	The first ingredient of an ingredient statement, normalized. CSV loads separate items with '+++', the APIs use commas.
+	'''
+	if ingredients is None:
+		return None
+	return normalize(ingredients.replace('+++', ',').split(',')[0])
+
+
+def tokens(ingredients):
+	'''
+	{word: whether it's in the first ingredient} for an ingredient statement.
+	'''
+	if not ingredients:
+		return {}
+	first = set(WORD.findall(first_ingredient(ingredients)))
+	return dict((word, word in first) for word in WORD.findall(ingredients.lower()))
+
+
+def reindex(upc_ids):
+	'''
+	Recomputes first_ingredient and the IngredientToken rows for the given UPC ids.
+	'''
+	upc_ids = list(upc_ids)
+	for i in range(0, len(upc_ids), CHUNK_SIZE):
+		pks = upc_ids[i:i + CHUNK_SIZE]
+		firsts = {}
+		rows = []
+		for pk, ingredients in UPC.objects.filter(pk__in=pks).values_list('pk', 'ingredients'):
+			firsts.setdefault(first_ingredient(ingredients), []).append(pk)
+			rows.extend(IngredientToken(upc_id_id=pk, token=token, first=first) for token, first in tokens(ingredients).items())
+
+		# one UPDATE per distinct first ingredient rather than per product
+		for first, same in firsts.items():
+			UPC.objects.filter(pk__in=same).update(first_ingredient=first)
+		IngredientToken.objects.filter(upc_id__in=pks).delete()
+		IngredientToken.objects.bulk_create(rows)
+
+
+def candidate_tokens(value, first_only=False):
+	'''
+	The indexed tokens any text containing value must have one of, or None if value has no words to go on.
+	If value is several words, the last one starts a token; a single word can be anywhere in one.
+	'''
+	words = WORD.findall(value)
+	if not words:
+		return None
+	word = words[-1]
+	vocabulary = IngredientToken.objects.order_by().values_list('token', flat=True).distinct()
+	if first_only:
+		vocabulary = vocabulary.filter(first=True)
+	if len(words) > 1:
+		return list(vocabulary.filter(token__startswith=word))
+	return [token for token in vocabulary if word in token]
+
+
+def matching(value, first_only=False):
+	'''
+	Ids of the products whose ingredients (or first ingredient, with first_only) contain value, same as the contains and first_item rules would say.
+	Candidates come from the token index; only their text is checked.
+	'''
+	value = normalize(value) if first_only else value.lower()
+	column = 'first_ingredient' if first_only else 'ingredients'
+	candidates = candidate_tokens(value, first_only)
+
+	if candidates is None:
+		# nothing to look up by; check every product
+		rows = UPC.objects.exclude(ingredients=None).values_list('pk', column).iterator()
+	else:
+		index = IngredientToken.objects.filter(first=True) if first_only else IngredientToken.objects.all()
+		pks = set()
+		for i in range(0, len(candidates), CHUNK_SIZE):
+			pks.update(index.filter(token__in=candidates[i:i + CHUNK_SIZE]).values_list('upc_id', flat=True))
+		pks = sorted(pks)
+		rows = (row for i in range(0, len(pks), CHUNK_SIZE) for row in UPC.objects.filter(pk__in=pks[i:i + CHUNK_SIZE]).values_list('pk', column))
+
+	return set(pk for pk, text in rows if text is not None and value in text.lower())
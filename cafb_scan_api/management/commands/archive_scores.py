@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from datetime import timedelta
+import time
+
+from cafb_scan_api import scores
+
+
+class Command(BaseCommand):
+	help = 'Moves WellScore history older than --older-than days into gzipped files, one per --chunk-days, keeping each product\'s current scores'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--older-than', type=int, dest='older_than', default=180, help='Archive history older than this many days')
+		parser.add_argument('--chunk-days', type=int, dest='chunk_days', default=30, help='Days of history per archive file')
+		parser.add_argument('--dir', dest='directory', default=scores.ARCHIVE_DIR, help='Where to write the archive files (default SCORE_ARCHIVE_DIR); somewhere durable, not inside the app')
+
+	def handle(self, *args, **options):
+		if options['older_than'] < 0:
+			raise CommandError('--older-than must be positive')
+		if options['chunk_days'] < 1:
+			raise CommandError('--chunk-days must be at least 1')
+
+		if not options['directory']:
+			raise CommandError('Give --dir or set SCORE_ARCHIVE_DIR: the archive files are the only copy of the history they hold')
+
+		start = time.time()
+		before = timezone.now() - timedelta(days=options['older_than'])
+		self.stdout.write('Archiving wellness scores from before %s ...' % before.date())
+		try:
+			archived = scores.archive(before, timedelta(days=options['chunk_days']), options['directory'])
+		except ValueError as e:
+			raise CommandError(str(e))
+		for path, count in archived:
+			self.stdout.write('%s: %d scores' % (path, count))
+		elapsed = time.time() - start
+		self.stdout.write(self.style.SUCCESS('Archived %d scores in %.2fs' % (sum(count for path, count in archived), elapsed)))
@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+import random
+import time
+
+from cafb_scan_api.models import UPC, FoodCat, NutRule, WellScore, CurrentWellScore
+from cafb_scan_api.gtin import with_check_digit
+from cafb_scan_api.scores import record
+
+# synthetic GTINs (before the check digit) start here so they can't collide with real ones
+BENCH_UPC_BASE = 9000000000000
+
+
+def bench_upc(i):
+	'''
+	The i'th synthetic GTIN-14, check digit and all.
+	'''
+	return with_check_digit(str(BENCH_UPC_BASE + i))
+
+
+def percentile(timings, pct):
+	return timings[min(len(timings) - 1, int(len(timings) * pct / 100.0))]
+
+
+class Command(BaseCommand):
+	help = 'Benchmarks the scan path lookups (UPC, FoodCat, latest WellScore, CurrentWellScore) against a large synthetic UPC table. Everything it inserts is rolled back.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--rows', type=int, dest='rows', default=1000000, help='Synthetic UPC rows to insert')
+		parser.add_argument('--lookups', type=int, dest='lookups', default=1000, help='Lookups to time per query')
+		parser.add_argument('--batch-size', type=int, dest='batch_size', default=5000, help='Rows per bulk_create while filling the table')
+
+	def fill(self, rows, batch_size, nut_rule):
+		start = time.time()
+		for offset in range(0, rows, batch_size):
+			UPC.objects.bulk_create([
+				UPC(upc_code=bench_upc(i), gtin=bench_upc(i), item_name='bench', sodium=i % 900, sugars=i % 30, api_last_update=None, data_source='bench')
+				for i in range(offset, min(rows, offset + batch_size))
+			])
+		self.stdout.write('Inserted %d UPCs in %.1fs' % (rows, time.time() - start))
+
+		# a few generations of scores for a slice of the table, like repeated rescoring runs would leave
+		upc_ids = list(UPC.objects.filter(data_source='bench').order_by('pk').values_list('pk', flat=True)[:min(rows, 100000)])
+		for generation in range(3):
+			for offset in range(0, len(upc_ids), batch_size):
+				record([WellScore(upc_id_id=upc_id, nut_id_id=nut_rule, wellness=bool(generation % 2)) for upc_id in upc_ids[offset:offset + batch_size]])
+		self.stdout.write('Inserted %d WellScores' % (len(upc_ids) * 3))
+
+		return upc_ids
+
+	def time_lookups(self, label, lookup, args):
+		timings = []
+		for arg in args:
+			start = time.time()
+			lookup(arg)
+			timings.append((time.time() - start) * 1000)
+		timings.sort()
+		self.stdout.write('%-20s mean %.3fms  p50 %.3fms  p95 %.3fms  p99 %.3fms' % (
+			label, sum(timings) / len(timings), percentile(timings, 50), percentile(timings, 95), percentile(timings, 99)))
+
+	def handle(self, *args, **options):
+		rows = options['rows']
+		lookups = options['lookups']
+
+		nut_rule = NutRule.objects.exclude(food_cat_id=None).select_related('food_cat_id').first()
+		if nut_rule is None:
+			raise CommandError('Load the nutrition rules first (manage.py initial_load)')
+
+		with transaction.atomic():
+			upc_ids = self.fill(rows, options['batch_size'], nut_rule.pk)
+
+			codes = [bench_upc(random.randrange(rows)) for i in range(lookups)]
+			self.time_lookups('UPC.gtin', lambda code: UPC.objects.values_list('pk', flat=True).get(gtin=code), codes)
+
+			load_cat = nut_rule.food_cat_id.load_cat
+			self.time_lookups('FoodCat.load_cat', lambda cat: FoodCat.objects.values_list('pk', flat=True).get(load_cat=cat), [load_cat] * lookups)
+
+			scored = [random.choice(upc_ids) for i in range(lookups)]
+			self.time_lookups('latest WellScore', lambda upc_id: WellScore.objects.filter(upc_id_id=upc_id, nut_id_id=nut_rule.pk).order_by('-created').values_list('wellness', flat=True).first(), scored)
+			self.time_lookups('CurrentWellScore', lambda upc_id: CurrentWellScore.objects.filter(upc_id_id=upc_id, nut_id_id=nut_rule.pk).values_list('wellness', flat=True).first(), scored)
+
+			transaction.set_rollback(True)
+
+		self.stdout.write(self.style.SUCCESS('Done; benchmark rows rolled back'))
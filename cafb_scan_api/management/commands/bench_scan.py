@@ -0,0 +1,378 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, connections
+from datetime import datetime
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+import SocketServer
+import csv
+import json
+import os
+import random
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import requests
+
+from cafb_scan_api.management.commands.bench_lookup import percentile, bench_upc
+from cafb_scan_api.gtin import with_check_digit
+from cafb_scan_api import metrics, upstream, quota, stubs
+from cafb_scan_api.scan_log import recorder
+
+# synthetic products are bench_lookup.bench_upc(i), and UPCs nobody has seen start at UNKNOWN_BASE (before the check digit), so neither can collide with real ones
+UNKNOWN_BASE = 9500000000000
+# Nutritionix calls a day while benchmarking, so the unknown scans never run out
+BENCH_QUOTA = 10 ** 9
+
+# columns of fixtures/products.csv (see initial_load.product_fields)
+GTIN, ITEM_NAME, SODIUM, SUGARS = 21, 23, 47, 48
+
+# scan_known_under_load times known scans while --concurrency more clients keep scanning unknown UPCs, so the upstreams are busy the whole time
+PHASES = ('scan_known', 'scan_unknown', 'scan_known_under_load', 'batch', 'list')
+
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+	daemon_threads = True
+
+	def handle_error(self, request, client_address):
+		pass
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+	def log_message(self, *args):
+		pass
+
+
+def git_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, stderr=open(os.devnull, 'w')).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def free_port():
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+
+def database_url(settings_dict):
+	'''
+	A dj-database-url URL for a database settings dict, so a gunicorn started by the benchmark uses the benchmark database.
+	'''
+	engine = settings_dict['ENGINE'].rsplit('.', 1)[-1]
+	if engine == 'sqlite3':
+		return 'sqlite:///' + settings_dict['NAME']
+	scheme = 'postgres' if engine.startswith('postgresql') else engine
+	return '%s://%s:%s@%s:%s/%s' % (scheme, settings_dict['USER'], settings_dict['PASSWORD'], settings_dict['HOST'] or 'localhost', settings_dict['PORT'] or '', settings_dict['NAME'])
+
+
+def sql_and_requests():
+	'''
+	Totals of the SQL query and request counters that metrics.MetricsMiddleware keeps.
+	'''
+	with metrics.lock:
+		items = list(metrics.counters.items())
+	return (
+		sum(value for (name, labels), value in items if name == 'cafb_sql_queries_total'),
+		sum(value for (name, labels), value in items if name == 'cafb_requests_total'),
+	)
+
+
+class Command(BaseCommand):
+	help = 'Load benchmark of the scan API against a throwaway database: synthetic catalogue, stub OFF/Nutritionix servers, fixed concurrency. Saves the results as JSON to compare between commits.'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--scale', type=int, dest='scale', default=10000, help='Synthetic products in the catalogue')
+		parser.add_argument('--requests', type=int, dest='requests', default=2000, help='Requests per phase')
+		parser.add_argument('--concurrency', type=int, dest='concurrency', default=8, help='Requests in flight at once')
+		parser.add_argument('--warmup', type=int, dest='warmup', default=50, help='Untimed requests before each phase')
+		parser.add_argument('--batch-items', type=int, dest='batch_items', default=50, help='Scans per /scan/batch/ request')
+		parser.add_argument('--upstream-latency', type=float, dest='upstream_latency', default=0.1, help='Seconds the stub upstreams take to answer')
+		parser.add_argument('--upstream-error-rate', type=float, dest='upstream_error_rate', default=0.02, help='Fraction of stub upstream calls that fail with a 503')
+		parser.add_argument('--upstream-known-rate', type=float, dest='upstream_known_rate', default=0.7, help='Fraction of new UPCs the stub upstreams know')
+		parser.add_argument('--phases', dest='phases', default=','.join(PHASES), help='Comma separated request phases to run (%s); loading and rescoring always run' % ', '.join(PHASES))
+		parser.add_argument('--gunicorn', dest='gunicorn', default=None, help='Serve the app with gunicorn.conf.py and this worker class (sync, gevent) instead of in process; SQL counts are only kept in process')
+		parser.add_argument('--gunicorn-workers', type=int, dest='gunicorn_workers', default=2, help='Gunicorn worker processes')
+		parser.add_argument('--output', dest='output', default=None, help='Where to save the JSON results (default: bench-<commit>-<time>.json)')
+
+	def handle(self, *args, **options):
+		phases = [phase.strip() for phase in options['phases'].split(',') if phase.strip()]
+		for phase in phases:
+			if phase not in PHASES:
+				raise CommandError('Unknown phase "%s" (pick from %s)' % (phase, ', '.join(PHASES)))
+		if options['concurrency'] < 1 or options['requests'] < 1 or options['scale'] < 1:
+			raise CommandError('--scale, --requests and --concurrency must be positive')
+
+		self.options = options
+		self.devnull = open(os.devnull, 'w')
+		results = {
+			'commit': git_commit(),
+			'started': datetime.utcnow().isoformat() + 'Z',
+			'options': dict((key, options[key]) for key in ('scale', 'requests', 'concurrency', 'warmup', 'batch_items', 'upstream_latency', 'upstream_error_rate', 'upstream_known_rate', 'gunicorn', 'gunicorn_workers')),
+			'database': settings.DATABASES['default']['ENGINE'],
+			'phases': {},
+		}
+
+		workdir = tempfile.mkdtemp(prefix='cafb_bench_')
+		old_name = self.setup_database(workdir)
+		servers = []
+		app = None
+		try:
+			servers = self.start_servers()
+			results['phases']['initial_load'] = self.load(workdir)
+			results['phases']['rescore'] = self.rescore()
+
+			if options['gunicorn']:
+				app, base = self.start_gunicorn()
+			else:
+				base = 'http://127.0.0.1:%d' % servers[-1].server_address[1]
+			for phase in phases:
+				self.stdout.write('Running %s ...' % phase)
+				if phase == 'scan_known_under_load':
+					results['phases'][phase] = self.drive(self.requests_scan_known(base), background=self.requests_scan_unknown(base))
+				else:
+					results['phases'][phase] = self.drive(getattr(self, 'requests_' + phase)(base))
+				self.report(phase, results['phases'][phase])
+		finally:
+			if app is not None:
+				app.terminate()
+				app.wait()
+			for server in servers:
+				server.shutdown()
+				server.server_close()
+			recorder.flush()
+			connections.close_all()
+			connection.creation.destroy_test_db(old_name, verbosity=0)
+			for name in os.listdir(workdir):
+				os.remove(os.path.join(workdir, name))
+			os.rmdir(workdir)
+
+		output = options['output'] or 'bench-%s-%s.json' % ((results['commit'] or 'nocommit')[:8], datetime.now().strftime('%Y%m%d%H%M%S'))
+		with open(output, 'w') as f:
+			json.dump(results, f, indent=4, sort_keys=True)
+		self.stdout.write(self.style.SUCCESS('Results saved to %s' % output))
+
+	def setup_database(self, workdir):
+		'''
+		A fresh, migrated test database (like manage.py test makes), so the benchmark never touches real data.
+		SQLite gets a file rather than the in-memory default, so the server threads can share it.
+		'''
+		settings_dict = connection.settings_dict
+		if settings_dict['ENGINE'].endswith('sqlite3'):
+			settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(workdir, 'bench.sqlite3')
+		old_name = settings_dict['NAME']
+		self.stdout.write('Creating the benchmark database ...')
+		connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+		return old_name
+
+	def start_servers(self):
+		'''
+		Stub OFF and Nutritionix servers, pointed at by the upstream lookups, then the app itself behind a threaded WSGI server.
+		'''
+		options = self.options
+		off = stubs.stub_server(upstream.OFF, options['upstream_latency'], options['upstream_error_rate'], options['upstream_known_rate'])
+		nutritionix = stubs.stub_server(upstream.NUTRITIONIX, options['upstream_latency'], options['upstream_error_rate'], options['upstream_known_rate'])
+		upstream.OFF_URL = stubs.url(off)
+		upstream.NUTRITIONIX_URL = stubs.url(nutritionix)
+		# the stub has no quota, and a run shouldn't be cut short by (or use up) the real one
+		quota.nutritionix.quota = quota.nutritionix.burst = BENCH_QUOTA
+
+		app = ThreadingWSGIServer(('127.0.0.1', 0), QuietWSGIRequestHandler)
+		app.set_app(get_wsgi_application())
+		thread = threading.Thread(target=app.serve_forever, name='bench-app')
+		thread.daemon = True
+		thread.start()
+		return [off, nutritionix, app]
+
+	def start_gunicorn(self):
+		'''
+		Starts gunicorn on the benchmark database and stub upstreams, and waits for it to answer.
+		Returns the process and its base URL.
+		'''
+		port = free_port()
+		env = dict(os.environ,
+			DATABASE_URL=database_url(connection.settings_dict),
+			OFF_URL=upstream.OFF_URL,
+			NUTRITIONIX_URL=upstream.NUTRITIONIX_URL,
+			NUTRITIONIX_DAILY_QUOTA=str(BENCH_QUOTA),
+			GUNICORN_WORKER_CLASS=self.options['gunicorn'],
+			WEB_CONCURRENCY=str(self.options['gunicorn_workers']),
+			PORT=str(port),
+		)
+		self.stdout.write('Starting gunicorn (%d %s workers) ...' % (self.options['gunicorn_workers'], self.options['gunicorn']))
+		process = subprocess.Popen(['gunicorn', 'cafb_scan_api.wsgi', '--config', os.path.join(settings.BASE_DIR, 'gunicorn.conf.py')], cwd=settings.BASE_DIR, env=env, stdout=self.devnull, stderr=self.devnull)
+
+		base = 'http://127.0.0.1:%d' % port
+		give_up = time.time() + 30
+		while True:
+			try:
+				requests.get(base + '/metrics', timeout=1)
+				return process, base
+			except requests.RequestException:
+				if process.poll() is not None or time.time() > give_up:
+					process.kill()
+					raise CommandError('gunicorn did not start (is it installed, along with the worker class?)')
+				time.sleep(0.2)
+
+	def load(self, workdir):
+		'''
+		Writes a products CSV of --scale rows shaped like fixtures/products.csv (its rows, recycled, with new GTINs and jittered sugar and sodium) and times initial_load on it.
+		'''
+		fixtures = os.path.join(settings.BASE_DIR, 'cafb_scan_api', 'fixtures')
+		with open(os.path.join(fixtures, 'products.csv'), 'rb') as f:
+			reader = csv.reader(f)
+			header = next(reader)
+			templates = list(reader)
+
+		rng = random.Random(0)
+		path = os.path.join(workdir, 'products.csv')
+		with open(path, 'wb') as f:
+			writer = csv.writer(f)
+			writer.writerow(header)
+			for i in range(self.options['scale']):
+				row = list(templates[i % len(templates)])
+				row[GTIN] = bench_upc(i)
+				row[ITEM_NAME] = '%s %d' % (row[ITEM_NAME], i)
+				row[SODIUM] = str(rng.randint(0, 900))
+				row[SUGARS] = str(rng.randint(0, 30))
+				writer.writerow(row)
+
+		self.stdout.write('Running initial_load on %d products ...' % self.options['scale'])
+		start = time.time()
+		call_command('initial_load', products=path, categories=os.path.join(fixtures, 'categories.csv'), rules=os.path.join(fixtures, 'nutrules.csv'), batch_size=1000, stdout=self.devnull)
+		elapsed = time.time() - start
+		result = {'seconds': elapsed, 'rows': self.options['scale'], 'rows_per_second': self.options['scale'] / elapsed}
+		self.stdout.write('  %.2fs (%.0f rows/s)' % (elapsed, result['rows_per_second']))
+		return result
+
+	def rescore(self):
+		self.stdout.write('Running update_well_score ...')
+		start = time.time()
+		call_command('update_well_score', stdout=self.devnull)
+		elapsed = time.time() - start
+		result = {'seconds': elapsed, 'rows': self.options['scale'], 'rows_per_second': self.options['scale'] / elapsed}
+		self.stdout.write('  %.2fs (%.0f rows/s)' % (elapsed, result['rows_per_second']))
+		return result
+
+	def categories(self):
+		from cafb_scan_api.rules import engine
+		engine.invalidate()
+		return sorted(engine.rules)
+
+	def requests_scan_known(self, base):
+		cats = self.categories()
+		scale = self.options['scale']
+		while True:
+			yield 'GET', '%s/scan/%s/?food_cat=%s' % (base, bench_upc(random.randrange(scale)), random.choice(cats)), None
+
+	def requests_scan_unknown(self, base):
+		cats = self.categories()
+		for i in xrange(10 ** 9):
+			yield 'GET', '%s/scan/%s/?food_cat=%s' % (base, with_check_digit(str(UNKNOWN_BASE + random.randrange(10 ** 6) * 1000 + i % 1000)), random.choice(cats)), None
+
+	def requests_batch(self, base):
+		cats = self.categories()
+		scale = self.options['scale']
+		while True:
+			items = [[bench_upc(random.randrange(scale)), random.choice(cats)] for i in range(self.options['batch_items'])]
+			yield 'POST', base + '/scan/batch/', json.dumps(items)
+
+	def requests_list(self, base):
+		urls = ['/api/v1/upc/?page_size=100', '/api/v1/upc/?page_size=100&fields=upc_code,item_name', '/api/v1/wellscore/?flat=1&page_size=100', '/api/v1/scan/?flat=1&page_size=100']
+		while True:
+			yield 'GET', base + random.choice(urls), None
+
+	def drive(self, specs, background=None):
+		'''
+		Sends --warmup untimed requests, then --requests timed ones, --concurrency at a time.
+		With background, another --concurrency clients send those requests, untimed, until the timed ones are done.
+		'''
+		options = self.options
+		lock = threading.Lock()
+		timings = []
+		errors = [0]
+
+		def worker(count, timed):
+			session = requests.Session()
+			while True:
+				with lock:
+					if count[0] <= 0:
+						return
+					count[0] -= 1
+					method, url, body = next(specs)
+				start = time.time()
+				try:
+					response = session.request(method, url, data=body, headers={'Content-Type': 'application/json'} if body else {})
+					ok = response.status_code < 400
+				except requests.RequestException:
+					ok = False
+				elapsed = time.time() - start
+				if timed:
+					with lock:
+						timings.append(elapsed * 1000)
+						errors[0] += not ok
+
+		def load(stop):
+			session = requests.Session()
+			while not stop.is_set():
+				with lock:
+					method, url, body = next(background)
+				try:
+					session.request(method, url, data=body, headers={'Content-Type': 'application/json'} if body else {})
+				except requests.RequestException:
+					pass
+
+		def run(total, timed):
+			# every thread takes requests off the one countdown
+			count = [total]
+			threads = [threading.Thread(target=worker, args=(count, timed)) for i in range(options['concurrency'])]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+
+		stop = threading.Event()
+		loaders = [threading.Thread(target=load, args=(stop,)) for i in range(options['concurrency'] if background else 0)]
+		for thread in loaders:
+			thread.start()
+		try:
+			run(options['warmup'], False)
+			recorder.flush()
+
+			queries, served = sql_and_requests()
+			start = time.time()
+			run(options['requests'], True)
+			elapsed = time.time() - start
+		finally:
+			stop.set()
+			for thread in loaders:
+				thread.join()
+		recorder.flush()
+		queries, served = [after - before for after, before in zip(sql_and_requests(), (queries, served))]
+		if loaders:
+			# the background requests are in the counts too
+			served = None
+
+		timings.sort()
+		return {
+			'requests': len(timings),
+			'errors': errors[0],
+			'seconds': elapsed,
+			'throughput': len(timings) / elapsed,
+			'mean_ms': sum(timings) / len(timings),
+			'p50_ms': percentile(timings, 50),
+			'p95_ms': percentile(timings, 95),
+			'p99_ms': percentile(timings, 99),
+			'queries_per_request': float(queries) / served if served else None,
+		}
+
+	def report(self, phase, result):
+		self.stdout.write('  %d requests, %d errors, %.1f req/s  p50 %.1fms  p95 %.1fms  p99 %.1fms  %s queries/request' % (
+			result['requests'], result['errors'], result['throughput'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+			'?' if result['queries_per_request'] is None else '%.1f' % result['queries_per_request']))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+import time
+
+from cafb_scan_api import catalog
+
+
+class Command(BaseCommand):
+	help = 'Rebuilds the memory-mapped catalogue of scored products that scans read before the database'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--dir', dest='directory', default=catalog.CATALOG_DIR, help='Catalogue directory (default: CATALOG_DIR)')
+		parser.add_argument('--chunk-size', type=int, dest='chunk_size', default=catalog.CHUNK_SIZE, help='Products read per query')
+
+	def handle(self, *args, **options):
+		start = time.time()
+		self.stdout.write('Building the catalogue in %s ...' % options['directory'])
+		products = catalog.build(options['directory'], options['chunk_size'])
+		elapsed = time.time() - start
+		self.stdout.write(self.style.SUCCESS('Catalogue of %d products built in %.2fs' % (products, elapsed)))
@@ -0,0 +1,245 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, connections, transaction
+from collections import Counter, deque
+from multiprocessing import Pool, cpu_count
+import gzip
+import json
+import os
+import signal
+import time
+
+from cafb_scan_api.models import UPC
+from cafb_scan_api.process_upc import off_columns
+from cafb_scan_api.gtin import canonical
+from cafb_scan_api.ingredients import reindex
+from cafb_scan_api.cache import bump_rule_version
+from cafb_scan_api.management.commands.initial_load import update_rows
+from cafb_scan_api import catalog
+
+# what off_columns() reads; dump records leave out what they don't have, where the API sends empty values
+PRODUCT_KEYS = ('product_name', 'brands', 'generic_name', 'serving_quantity')
+NUTRIMENT_KEYS = ('energy', 'energy_unit', 'fat', 'saturated-fat', 'sodium', 'carbohydrates', 'fiber', 'sugars', 'proteins')
+# seconds a batch may take to parse
+JOB_TIMEOUT = 3600
+# GTINs per query; SQLite allows 999 variables in one
+CHUNK_SIZE = 500
+
+
+def api_product(record):
+	'''
+	A dump record in the shape the OFF API sends products, so off_columns() can map it.
+	'''
+	product = dict((key, record.get(key)) for key in PRODUCT_KEYS)
+	nutriments = record.get('nutriments') or {}
+	product['nutriments'] = dict((key, nutriments.get(key)) for key in NUTRIMENT_KEYS)
+	product['last_edit_dates_tags'] = record.get('last_edit_dates_tags') or [None]
+	product['ingredients'] = [item for item in record.get('ingredients') or [] if item.get('text')]
+	product['serving_size'] = record.get('serving_size') or ''
+	return product
+
+
+def wanted(record, countries, categories):
+	if countries and not countries.intersection(record.get('countries_tags') or ()):
+		return False
+	if categories and not categories.intersection(record.get('categories_tags') or ()):
+		return False
+	return True
+
+
+def ignore_interrupts():
+	# Ctrl-C is for the parent, which stops at a checkpoint
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def parse_lines(job):
+	'''
+	Runs in the pool: parses, filters and maps a batch of dump lines. No database here.
+	Returns ([(gtin, upc_code, UPC columns)], lines skipped by the filters or for a bad barcode, {cause: lines that failed to parse}).
+	'''
+	lines, countries, categories = job
+	rows = []
+	skipped = 0
+	failed = Counter()
+	for line in lines:
+		try:
+			record = json.loads(line)
+		except ValueError:
+			failed['not JSON'] += 1
+			continue
+		code = unicode(record.get('code') or '').strip()
+		gtin = canonical(code)
+		if gtin is None or not wanted(record, countries, categories):
+			skipped += 1
+			continue
+		try:
+			rows.append((gtin, code, off_columns(api_product(record))))
+		except (KeyError, IndexError, TypeError, ValueError, AttributeError, ArithmeticError) as e:
+			# by type and message, less the value after any colon, so there are only so many causes
+			failed['%s: %s' % (type(e).__name__, unicode(e).split(':')[0][:80])] += 1
+	return rows, skipped, dict(failed)
+
+
+class Command(BaseCommand):
+	help = 'Imports an Open Food Facts JSONL dump (openfoodfacts-products.jsonl, or .gz) into the UPC table, mapping products the same way the scan path does'
+
+	def add_arguments(self, parser):
+		parser.add_argument('path', help='The dump file')
+		parser.add_argument('--country', action='append', dest='countries', default=[], help='Only import products sold here (an OFF countries tag, e.g. en:united-states); can be repeated')
+		parser.add_argument('--category', action='append', dest='categories', default=[], help='Only import products in this category (an OFF categories tag, e.g. en:breakfast-cereals); can be repeated')
+		parser.add_argument('--upsert', action='store_true', dest='upsert', default=False, help='Update products already imported from OFF; products from anywhere else are never overwritten')
+		parser.add_argument('--workers', type=int, dest='workers', default=cpu_count(), help='Parsing processes')
+		parser.add_argument('--batch-size', type=int, dest='batch_size', default=1000, help='Dump lines per parsing job and per write')
+		parser.add_argument('--checkpoint', dest='checkpoint', default=None, help='Where to keep the resume point (default: the dump path + .checkpoint)')
+		parser.add_argument('--restart', action='store_true', dest='restart', default=False, help='Ignore the checkpoint and start from the top of the file')
+		parser.add_argument('--progress', type=float, dest='progress', default=10, help='Seconds between progress lines')
+
+	def batches(self, raw, f, offset, batch_size):
+		'''
+		Yields (lines, offset after them, raw file position) batch_size lines at a time, starting at offset (a position in the uncompressed text).
+		'''
+		f.seek(offset)
+		lines = []
+		for line in iter(f.readline, b''):
+			offset += len(line)
+			if line.strip():
+				lines.append(line)
+			if len(lines) >= batch_size:
+				yield lines, offset, raw.tell()
+				lines = []
+		yield lines, offset, raw.tell()
+
+	def write(self, rows, upsert):
+		'''
+		Adds the new products in a batch (and with upsert, updates ones we imported before). Returns (added, updated).
+		'''
+		latest = {}
+		for gtin, code, columns in rows:
+			# last one in the dump wins
+			latest[gtin] = (code, columns)
+		gtins = list(latest)
+		existing = {}
+		for i in range(0, len(gtins), CHUNK_SIZE):
+			existing.update((gtin, (pk, data_source)) for gtin, pk, data_source in UPC.objects.filter(gtin__in=gtins[i:i + CHUNK_SIZE]).values_list('gtin', 'pk', 'data_source'))
+
+		with transaction.atomic():
+			updated = []
+			if upsert:
+				rows = {}
+				for gtin, (pk, data_source) in existing.items():
+					if data_source == 'Open Food Facts':
+						rows[pk] = dict(latest[gtin][1])
+						updated.append(gtin)
+				# one executemany for the batch, like initial_load --upsert
+				update_rows(UPC, rows)
+			new = [UPC(upc_code=code, gtin=gtin, **columns) for gtin, (code, columns) in latest.items() if gtin not in existing]
+			try:
+				with transaction.atomic():
+					UPC.objects.bulk_create(new)
+			except IntegrityError:
+				# a code spelt differently in another row; add the rest one at a time
+				for obj in new:
+					try:
+						with transaction.atomic():
+							obj.save()
+					except IntegrityError:
+						pass
+			# bulk_create doesn't give us the pks
+			changed = [obj.gtin for obj in new] + updated
+			pks = []
+			for i in range(0, len(changed), CHUNK_SIZE):
+				pks.extend(UPC.objects.filter(gtin__in=changed[i:i + CHUNK_SIZE]).values_list('pk', flat=True))
+			reindex(pks)
+		return len(pks) - len(updated), len(updated)
+
+	def load_checkpoint(self, path, dump):
+		if not os.path.exists(path):
+			return None
+		with open(path) as f:
+			checkpoint = json.load(f)
+		if checkpoint['path'] != dump:
+			raise CommandError('%s is the checkpoint for %s; use --checkpoint or --restart' % (path, checkpoint['path']))
+		if not isinstance(checkpoint['failed'], dict):
+			# written before failures were counted by cause
+			checkpoint['failed'] = {'unknown': checkpoint['failed']} if checkpoint['failed'] else {}
+		return checkpoint
+
+	def save_checkpoint(self, path, checkpoint):
+		partial = path + '.partial'
+		with open(partial, 'w') as f:
+			json.dump(checkpoint, f)
+		os.rename(partial, path)
+
+	def causes(self, failed, top=10):
+		'''
+		The commonest causes of parse failures, one per line.
+		'''
+		return ''.join('\n    %8d  %s' % (n, cause) for cause, n in Counter(failed).most_common(top))
+
+	def handle(self, *args, **options):
+		dump = os.path.abspath(options['path'])
+		if not os.path.exists(dump):
+			raise CommandError('No such file: %s' % dump)
+		if options['workers'] < 1 or options['batch_size'] < 1:
+			raise CommandError('--workers and --batch-size must be at least 1')
+		checkpoint_path = options['checkpoint'] or dump + '.checkpoint'
+
+		checkpoint = None if options['restart'] else self.load_checkpoint(checkpoint_path, dump)
+		if checkpoint is None:
+			checkpoint = {'path': dump, 'offset': 0, 'read': 0, 'added': 0, 'updated': 0, 'skipped': 0, 'failed': {}}
+		else:
+			self.stdout.write('Resuming from line %d (%d added so far)' % (checkpoint['read'], checkpoint['added']))
+		countries, categories = set(options['countries']), set(options['categories'])
+		size = os.path.getsize(dump)
+
+		# the pool's processes are forked from this one and mustn't share its database connection
+		connections.close_all()
+		pool = Pool(options['workers'], ignore_interrupts)
+		start = last_report = time.time()
+		read_at_start = checkpoint['read']
+		try:
+			with open(dump, 'rb') as raw:
+				f = gzip.GzipFile(fileobj=raw) if dump.endswith('.gz') else raw
+				# a few jobs ahead of the writes, so the workers stay busy without the whole file piling up in memory
+				pending = deque()
+				jobs = self.batches(raw, f, checkpoint['offset'], options['batch_size'])
+				while True:
+					for lines, offset, position in jobs:
+						pending.append((len(lines), offset, position, pool.apply_async(parse_lines, ((lines, countries, categories),))))
+						if len(pending) >= options['workers'] * 2:
+							break
+					if not pending:
+						break
+
+					count, offset, position, job = pending.popleft()
+					# with a timeout, so Ctrl-C gets through (the checkpoint has the last batch written)
+					rows, skipped, failed = job.get(JOB_TIMEOUT)
+					added, updated = self.write(rows, options['upsert'])
+					checkpoint.update(offset=offset, read=checkpoint['read'] + count, added=checkpoint['added'] + added, updated=checkpoint['updated'] + updated,
+						skipped=checkpoint['skipped'] + skipped + len(rows) - added - updated, failed=dict(Counter(checkpoint['failed']) + Counter(failed)))
+					# only once the batch is committed
+					self.save_checkpoint(checkpoint_path, checkpoint)
+
+					now = time.time()
+					if now - last_report >= options['progress']:
+						last_report = now
+						rate = (checkpoint['read'] - read_at_start) / (now - start)
+						self.stdout.write('  %.1f%%  %d read, %d added, %d updated, %d skipped, %d failed  (%.0f lines/s)' % (
+							100.0 * position / size if size else 100, checkpoint['read'], checkpoint['added'], checkpoint['updated'], checkpoint['skipped'], sum(checkpoint['failed'].values()), rate))
+		finally:
+			# let the workers finish the few jobs they have; killing them mid-job can leave the pool's result pipe locked and hang us
+			pool.close()
+			pool.join()
+
+		os.remove(checkpoint_path)
+		elapsed = time.time() - start
+		self.stdout.write(self.style.SUCCESS('Read %d lines in %.1fs (%.0f lines/s): %d added, %d updated, %d skipped, %d failed to parse' % (
+			checkpoint['read'], elapsed, (checkpoint['read'] - read_at_start) / elapsed if elapsed else 0, checkpoint['added'], checkpoint['updated'], checkpoint['skipped'], sum(checkpoint['failed'].values()))))
+		if checkpoint['failed']:
+			self.stdout.write('Commonest causes:' + self.causes(checkpoint['failed']))
+
+		# cached "not found"s for what we just added (unknown_key is versioned), and the catalogue, are out of date
+		bump_rule_version()
+		if getattr(settings, 'CATALOG_ENABLED', True):
+			self.stdout.write('Rebuilding the catalogue ...')
+			self.stdout.write(self.style.SUCCESS('Catalogue of %d products built' % catalog.build()))
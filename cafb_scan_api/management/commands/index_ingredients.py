@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+import time
+
+from cafb_scan_api.models import UPC
+from cafb_scan_api.ingredients import reindex
+
+
+class Command(BaseCommand):
+	help = 'Reparses every product\'s ingredients into UPC.first_ingredient and the IngredientToken index'
+
+	def handle(self, *args, **options):
+		start = time.time()
+		upc_ids = list(UPC.objects.order_by('pk').values_list('pk', flat=True))
+		with transaction.atomic():
+			reindex(upc_ids)
+		elapsed = time.time() - start
+		self.stdout.write(self.style.SUCCESS('Indexed the ingredients of %d products in %.2fs' % (len(upc_ids), elapsed)))
@@ -1,101 +1,219 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from itertools import islice
+import csv
+import time
 
 from cafb_scan_api.models import UPC, FoodCat, NutRule
+from cafb_scan_api.cache import bump_rule_version
+from cafb_scan_api.gtin import canonical
+from cafb_scan_api.ingredients import reindex
+
+# GTINs per query; SQLite allows 999 variables in one
+CHUNK_SIZE = 500
+
+
+def read_csv(path):
+	'''
+	Streams the rows of a CSV file (minus the header) as lists of unicode strings.
+	'''
+	with open(path, 'rb') as f:
+		reader = csv.reader(f)
+		next(reader, None)
+		for row in reader:
+			yield [unicode(field, 'utf-8').strip() for field in row]
+
+
+def chunks(rows, size):
+	rows = iter(rows)
+	chunk = list(islice(rows, size))
+	while chunk:
+		yield chunk
+		chunk = list(islice(rows, size))
+
+
+def to_float(value):
+	return float(value) if value not in ('', None) else None
+
+
+def product_fields(product):
+	return dict(
+		upc_code=product[21],
+		gtin=canonical(product[21]),
+		item_name=product[23],
+		brand_id=product[0],
+		brand_name=product[3],
+		item_image=product[22],
+		ingredients=product[24],
+		calories=to_float(product[4]),
+		calories_from_fat=to_float(product[5]),
+		total_fat=to_float(product[52]),
+		saturated_fat=to_float(product[42]),
+		cholesterol=to_float(product[8]),
+		sodium=to_float(product[47]),
+		total_carb=to_float(product[50]),
+		dietary_fiber=to_float(product[11]),
+		sugars=to_float(product[48]),
+		protein=to_float(product[39]),
+		vitamin_a_dv=to_float(product[54]),
+		vitamin_c_dv=to_float(product[55]),
+		calcium_dv=to_float(product[6]),
+		iron_dv=to_float(product[25]),
+		serving_per_cont=to_float(product[43]),
+		serving_size_qty=to_float(product[56]),
+		serving_size_unit=product[57],
+		data_source='CSV'
+	)
+
+
+def update_rows(model, rows):
+	'''
+	Updates rows ({pk: {field attname: value}}, all with the same fields) in one executemany rather than an UPDATE per row.
+	'''
+	if not rows:
+		return
+	attnames = dict((field.attname, field) for field in model._meta.concrete_fields)
+	names = sorted(next(iter(rows.values())))
+	fields = [attnames[name] for name in names]
+	# what save() would have done for auto_now fields
+	now = timezone.now()
+	for field in model._meta.concrete_fields:
+		if getattr(field, 'auto_now', False) and field.attname not in names:
+			fields.append(field)
+			for row in rows.values():
+				row[field.attname] = now
+	sql = 'UPDATE %s SET %s WHERE %s = %%s' % (
+		connection.ops.quote_name(model._meta.db_table),
+		', '.join('%s = %%s' % connection.ops.quote_name(field.column) for field in fields),
+		connection.ops.quote_name(model._meta.pk.column))
+	params = [[field.get_db_prep_save(row[field.attname], connection) for field in fields] + [pk] for pk, row in rows.items()]
+	with connection.cursor() as cursor:
+		cursor.executemany(sql, params)
+
+
+def cat_fields(cat):
+	return dict(
+		load_cat=cat[0],
+		abbr=cat[1],
+		name=cat[2],
+		description=cat[3],
+		notes=cat[4]
+	)
+
+
+def nut_fields(nut):
+	return dict(
+		nutrient=nut[1],
+		nutritional_field=nut[2],
+		rule_type=nut[3],
+		value=nut[4],
+		wellness=int(nut[5])
+	)
+
 
 class Command(BaseCommand):
 	help = 'Loads initial UPC data, food categories, and wellness rules'
 
+	def add_arguments(self, parser):
+		fixtures = settings.BASE_DIR + '/cafb_scan_api/fixtures/'
+		parser.add_argument('--products', dest='products', default=fixtures + 'products.csv', help='Product CSV to load')
+		parser.add_argument('--categories', dest='categories', default=fixtures + 'categories.csv', help='Food category CSV to load')
+		parser.add_argument('--rules', dest='rules', default=fixtures + 'nutrules.csv', help='Nutrition rule CSV to load')
+		parser.add_argument('--batch-size', type=int, dest='batch_size', default=1000, help='Rows per bulk_create')
+		parser.add_argument('--upsert', action='store_true', dest='upsert', default=False, help='Update products, categories and rules that already exist instead of adding duplicates')
+
+	def load(self, model, rows, fields, key, batch_size, upsert):
+		'''
+		Bulk loads rows into model, batch_size at a time.
+		With upsert, rows whose key matches an existing row update it instead (last one in the file wins).
+		Returns (created, updated, the keys of the rows added or updated).
+		'''
+		created = updated = 0
+		keys = []
+		start = time.time()
+
+		for chunk in chunks(rows, batch_size):
+			chunk = [fields(row) for row in chunk]
+
+			if upsert:
+				latest = {}
+				for row in chunk:
+					latest[row[key]] = row
+				# newest first, so the dict ends up with the oldest row, the one the scan path reads
+				existing = dict(model.objects.filter(**{key + '__in': latest.keys()}).order_by('-created').values_list(key, 'pk'))
+				update_rows(model, dict((pk, latest.pop(value)) for value, pk in existing.items()))
+				updated += len(existing)
+				keys.extend(existing)
+				chunk = latest.values()
+
+			model.objects.bulk_create([model(**row) for row in chunk])
+			created += len(chunk)
+			keys.extend(row[key] for row in chunk)
+
+			elapsed = time.time() - start
+			self.stdout.write('  %d added, %d updated (%.0f rows/s)' % (created, updated, (created + updated) / elapsed if elapsed else 0))
+
+		return created, updated, keys
+
+	def valid_products(self, rows):
+		'''
+		Skips (and counts) products whose UPC isn't a valid barcode; nothing could ever scan them.
+		'''
+		self.skipped = 0
+		for row in rows:
+			if canonical(row[21]) is None:
+				self.skipped += 1
+				continue
+			yield row
+
 	def handle(self, *args, **options):
+		batch_size = options['batch_size']
+		upsert = options['upsert']
+
+		try:
+			with transaction.atomic():
+				self.load_all(options, batch_size, upsert)
+		except IntegrityError as e:
+			# the whole load is rolled back
+			raise CommandError('%s: some of these rows are already loaded; run again with --upsert to update them' % e)
 
-		PATH = settings.BASE_DIR
+		bump_rule_version()
 
+	def load_all(self, options, batch_size, upsert):
 		# load products
 		self.stdout.write('Loading products ...')
-		products  = PATH +'/cafb_scan_api/fixtures/products.csv'
-
-		self.stdout.write(products)
-		with open(products, 'r+') as f:
-			data = list(f)
-
-		for product in data[1:]:
-			product = unicode(product, 'utf-8').replace('\n', '').split(',')
-
-			obj = UPC(
-						upc_code=product[21],
-						item_name=product[23],
-						brand_id=product[0],
-						brand_name=product[3],
-						item_image=product[22],
-						ingredients=product[24],
-						calories=float(product[4]),
-						calories_from_fat=float(product[5]),
-						total_fat=float(product[52]),
-						saturated_fat=float(product[42]),
-						cholesterol=float(product[8]),
-						sodium=float(product[47]),
-						total_carb=float(product[50]),
-						dietary_fiber=float(product[11]),
-						sugars=float(product[48]),
-						protein=float(product[39]),
-						vitamin_a_dv=float(product[54]),
-						vitamin_c_dv=float(product[55]),
-						calcium_dv=float(product[6]),
-						iron_dv=float(product[25]),
-						serving_per_cont=float(product[43]),
-						serving_size_qty=float(product[56]),
-						serving_size_unit=product[57],
-						data_source='CSV'
-			)
-
-			obj.save()
-
-			self.stdout.write(self.style.SUCCESS('Product name: Added "%s"' % product[23]))
-
+		self.stdout.write(options['products'])
+		# matched on GTIN, so a code spelt without its leading zeros updates the product rather than duplicating it
+		created, updated, gtins = self.load(UPC, self.valid_products(read_csv(options['products'])), product_fields, 'gtin', batch_size, upsert)
+		self.stdout.write(self.style.SUCCESS('Products: Added %d, updated %d, skipped %d with invalid UPCs' % (created, updated, self.skipped)))
+
+		# products went in with bulk_create, so parse the ingredients of the ones this load added or updated in one pass
+		self.stdout.write('Indexing ingredients ...')
+		pks = []
+		for i in range(0, len(gtins), CHUNK_SIZE):
+			pks.extend(UPC.objects.filter(gtin__in=gtins[i:i + CHUNK_SIZE]).values_list('pk', flat=True))
+		reindex(sorted(pks))
 
 		# load food categories
 		self.stdout.write('Loading food categories ...')
-		cats  = PATH +'/cafb_scan_api/fixtures/categories.csv'
-
-		self.stdout.write(cats)
-		with open(cats, 'r+') as f:
-			data = list(f)
-
-		for cat in data[1:]:
-			cat = unicode(cat, 'utf-8').replace('\n', '').split(',')
-
-			obj = FoodCat(
-					load_cat=cat[0],
-					abbr=cat[1],
-					name=cat[2],
-					description=cat[3],
-					notes=cat[4]
-			)
-
-			obj.save()
-
-			self.stdout.write(self.style.SUCCESS('Catgory: Added "%s"' % cat[1]))
-
+		self.stdout.write(options['categories'])
+		created, updated = self.load(FoodCat, read_csv(options['categories']), cat_fields, 'load_cat', batch_size, upsert)[:2]
+		self.stdout.write(self.style.SUCCESS('Categories: Added %d, updated %d' % (created, updated)))
 
 		# load nutrition rules
 		self.stdout.write('Loading nutrition rules ...')
-		nuts  = PATH +'/cafb_scan_api/fixtures/nutrules.csv'
-
-		self.stdout.write(nuts)
-		with open(nuts, 'r+') as f:
-			data = list(f)
-
-		for nut in data[1:]:
-			nut = unicode(nut, 'utf-8').replace('\n', '').split(',')
-
-			obj = NutRule(
-					nutrient=nut[1],
-					nutritional_field=nut[2],
-					rule_type=nut[3],
-					value=nut[4],
-					wellness=int(nut[5])		
-					)
-			obj.food_cat_id_id=FoodCat.objects.values_list('pk', flat=True).get(load_cat=nut[0])
-			obj.save()
-
-			self.stdout.write(self.style.SUCCESS('Nutrition Rule: Added "%s"' % nut[1]))
\ No newline at end of file
+		self.stdout.write(options['rules'])
+		# newest first, so the dict ends up with the oldest row for each category
+		cat_keys = dict(FoodCat.objects.order_by('-created').values_list('load_cat', 'pk'))
+
+		def rule_fields(nut):
+			if nut[0] not in cat_keys:
+				raise CommandError('Nutrition rule for unknown food category "%s"' % nut[0])
+			fields = nut_fields(nut)
+			fields['food_cat_id_id'] = cat_keys[nut[0]]
+			return fields
+
+		created, updated = self.load(NutRule, read_csv(options['rules']), rule_fields, 'food_cat_id_id', batch_size, upsert)[:2]
+		self.stdout.write(self.style.SUCCESS('Nutrition Rules: Added %d, updated %d' % (created, updated)))
@@ -0,0 +1,140 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+from datetime import datetime, timedelta
+from multiprocessing import Pool, cpu_count
+import time
+
+from cafb_scan_api.models import UPC, UpstreamFetch
+from cafb_scan_api.process_upc import COLUMNS
+from cafb_scan_api.upstream import OFF, NUTRITIONIX
+from cafb_scan_api.gtin import short
+from cafb_scan_api.ingredients import reindex
+from cafb_scan_api.cache import bump_rule_version
+from cafb_scan_api import catalog, payloads
+
+# a product is saved a moment after its payload is archived, so a row this much newer than its last fetch is still as fetched
+WRITE_SLACK = timedelta(seconds=60)
+
+
+def parse(job):
+	'''
+	Runs in the pool: (gtin, source, compressed payload) -> (gtin, UPC columns or None, error or None). No database here.
+	'''
+	gtin, source, data = job
+	try:
+		return gtin, COLUMNS[source](payloads.decode(data)), None
+	except (KeyError, IndexError, TypeError, ValueError, AttributeError, ArithmeticError) as e:
+		return gtin, None, '%s: %r' % (type(e).__name__, e)
+
+
+def column_value(name, value):
+	# what the column will hold, to compare with what it holds now
+	value = UPC._meta.get_field(name).to_python(value)
+	if isinstance(value, datetime) and settings.USE_TZ and timezone.is_naive(value):
+		value = timezone.make_aware(value)
+	return value
+
+
+class Command(BaseCommand):
+	help = 'Rebuilds UPC rows from the archived OFF / Nutritionix payloads (the last one fetched for each GTIN) with the current parsing code, without asking the APIs'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--source', choices=[OFF, NUTRITIONIX], dest='source', default=None, help='Only reparse payloads from this source')
+		parser.add_argument('--workers', type=int, dest='workers', default=cpu_count(), help='Parsing processes')
+		parser.add_argument('--chunk-size', type=int, dest='chunk_size', default=500, help='GTINs read and written at a time')
+		parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False, help='Parse everything and count what would change, but write nothing')
+
+	def gtins(self, source, chunk_size):
+		fetches = UpstreamFetch.objects.order_by('gtin')
+		if source is not None:
+			fetches = fetches.filter(source=source)
+		last = ''
+		while True:
+			chunk = list(fetches.filter(gtin__gt=last).values_list('gtin', flat=True).distinct()[:chunk_size])
+			if not chunk:
+				return
+			yield chunk
+			last = chunk[-1]
+
+	def apply(self, parsed, fetches, dry_run):
+		'''
+		Writes a chunk of parsed rows: updates the UPC rows whose columns changed and adds the ones we don't have. Returns (updated pks, added pks, kept pks).
+		Rows that have changed since they were written from their last fetch are kept as they are: ones from another source (the CSV load, or OFF instead of Nutritionix), and ones edited since (through the API, or by initial_load --upsert).
+		Each rewrite is recorded as a fetch of the same payload (see payloads.py), so the row doesn't look edited next time.
+		'''
+		rows = dict((row['gtin'], row) for row in UPC.objects.filter(gtin__in=list(parsed)).values())
+		updated, added, kept, rewritten = [], [], [], []
+		with transaction.atomic():
+			for gtin, columns in sorted(parsed.items()):
+				row = rows.get(gtin)
+				source, data, fetched, payload_id = fetches[gtin]
+				if row is not None and (row['data_source'] != columns['data_source'] or row['updated'] > fetched + WRITE_SLACK):
+					kept.append(row['id'])
+					continue
+				if row is None:
+					if not dry_run:
+						obj = UPC(upc_code=short(gtin), gtin=gtin, **columns)
+						obj.save()
+						added.append(obj.pk)
+					else:
+						added.append(None)
+				elif any(column_value(name, value) != row[name] for name, value in columns.items()):
+					if not dry_run:
+						UPC.objects.filter(pk=row['id']).update(updated=timezone.now(), **columns)
+					updated.append(row['id'])
+				else:
+					continue
+				rewritten.append(UpstreamFetch(source=source, gtin=gtin, payload_id=payload_id))
+			if not dry_run:
+				# after the rows, so the fetches are newer
+				UpstreamFetch.objects.bulk_create(rewritten)
+				reindex(updated + added)
+		return updated, added, kept
+
+	def handle(self, *args, **options):
+		if options['workers'] < 1:
+			raise CommandError('--workers must be at least 1')
+		start = time.time()
+		dry_run = options['dry_run']
+
+		# the pool's processes are forked from this one and mustn't share its database connection
+		connections.close_all()
+		pool = Pool(options['workers'])
+		total = updated = added = kept = failed = 0
+		try:
+			for gtins in self.gtins(options['source'], options['chunk_size']):
+				fetches = payloads.latest(gtins, options['source'])
+				jobs = [(gtin, source, data) for gtin, (source, data, fetched, payload_id) in fetches.items()]
+				parsed = {}
+				for gtin, columns, error in pool.map(parse, jobs):
+					if error is not None:
+						failed += 1
+						self.stderr.write('%s: %s' % (gtin, error))
+					else:
+						parsed[gtin] = columns
+				chunk_updated, chunk_added, chunk_kept = self.apply(parsed, fetches, dry_run)
+				total += len(jobs)
+				updated += len(chunk_updated)
+				added += len(chunk_added)
+				kept += len(chunk_kept)
+		finally:
+			pool.close()
+			pool.join()
+
+		elapsed = time.time() - start
+		self.stdout.write('Reparsed %d payloads in %.2fs: %d products changed, %d added, %d kept (changed since fetched), %d failed to parse' % (total, elapsed, updated, added, kept, failed))
+		if dry_run:
+			self.stdout.write(self.style.SUCCESS('Dry run: nothing written'))
+			return
+		if not updated and not added:
+			self.stdout.write(self.style.SUCCESS('Nothing changed'))
+			return
+
+		# cached scans and the catalogue carry the old product details
+		bump_rule_version()
+		if getattr(settings, 'CATALOG_ENABLED', True):
+			self.stdout.write('Rebuilding the catalogue ...')
+			self.stdout.write(self.style.SUCCESS('Catalogue of %d products built' % catalog.build()))
+		self.stdout.write(self.style.SUCCESS('Done; run manage.py update_well_score to rescore the changed products'))
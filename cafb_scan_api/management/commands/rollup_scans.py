@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from datetime import timedelta
+import time
+
+from cafb_scan_api import rollups
+
+
+class Command(BaseCommand):
+	help = 'Rebuilds the hourly and daily scan rollups behind the scan tracker from the Scan table'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--days', type=int, dest='days', default=None, help='Only rebuild the last N days (default: everything)')
+
+	def handle(self, *args, **options):
+		start = time.time()
+		since = None
+		if options['days'] is not None:
+			if options['days'] < 0:
+				raise CommandError('--days must be positive')
+			since = timezone.now() - timedelta(days=options['days'])
+
+		self.stdout.write('Rolling up scans%s ...' % ('' if since is None else ' since %s' % since.date()))
+		total = rollups.rebuild(since)
+		elapsed = time.time() - start
+		self.stdout.write(self.style.SUCCESS('Rolled up %d scans in %.2fs' % (total, elapsed)))
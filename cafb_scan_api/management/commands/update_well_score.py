@@ -0,0 +1,130 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+import numpy as np
+import time
+
+from cafb_scan_api.models import UPC, WellScore
+from cafb_scan_api.rules import RuleEngine
+from cafb_scan_api.cache import bump_rule_version
+from cafb_scan_api import catalog
+from cafb_scan_api.ingredients import matching
+from cafb_scan_api.scores import record
+
+# UPC columns the nutrition rules can look at; ingredient rules go through the token index instead (see ingredients.py)
+NUMERIC_FIELDS = ['sugars', 'sodium']
+TEXT_FIELDS = ['item_name']
+
+
+def text_column(values):
+	'''
+	Turns a list of strings (or None) into a lowercased numpy unicode array plus a mask of which ones were there.
+	'''
+	present = np.array([value is not None for value in values], dtype=bool)
+	column = np.array([value or u'' for value in values], dtype=np.unicode_)
+	return np.char.lower(column) if len(column) else column, present
+
+
+def score_rule(rule, columns, load_cat):
+	'''
+	Applies a compiled rule to every product at once.
+	Returns an array of wellness scores and a mask of the products the rule could actually be applied to.
+	'''
+	count = len(columns['id'])
+
+	if rule.predicate is None:
+		return np.zeros(count, dtype=int), np.ones(count, dtype=bool)
+
+	if rule.rule_type == 'lte':
+		if rule.field not in columns:
+			return np.zeros(count, dtype=int), np.zeros(count, dtype=bool)
+		column = columns[rule.field]
+		valid = ~np.isnan(column)
+		passed = np.zeros(count, dtype=bool)
+		passed[valid] = column[valid] <= rule.value
+	elif rule.field == 'category':
+		valid = np.ones(count, dtype=bool)
+		passed = np.repeat(rule.value in str(load_cat).lower(), count)
+	elif rule.rule_type == 'first_item' or rule.field == 'ingredients':
+		valid = columns['has_ingredients']
+		matched = np.fromiter(matching(rule.value, first_only=rule.rule_type == 'first_item'), dtype=np.int64)
+		passed = np.in1d(columns['id'], matched)
+	else:
+		if rule.field not in columns:
+			return np.zeros(count, dtype=int), np.zeros(count, dtype=bool)
+		column, valid = columns[rule.field]
+		passed = np.char.find(column, rule.value) >= 0 if count else np.zeros(0, dtype=bool)
+
+	return np.where(passed, rule.wellness, abs(rule.wellness - 1)), valid
+
+
+class Command(BaseCommand):
+	help = 'Recalculates wellness scores for every product against the current nutrition rules'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--category', action='append', dest='categories', help='Only rescore this food category (load_cat); can be repeated')
+		parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False, help='Score everything but do not write to the WellScore table')
+		parser.add_argument('--batch-size', type=int, dest='batch_size', default=1000, help='Scores written per batch')
+
+	def load_columns(self):
+		rows = list(UPC.objects.values_list('id', *(NUMERIC_FIELDS + TEXT_FIELDS + ['first_ingredient'])))
+		columns = {'id': np.array([row[0] for row in rows], dtype=np.int64)}
+		# first_ingredient is only null when ingredients is
+		columns['has_ingredients'] = np.array([row[-1] is not None for row in rows], dtype=bool)
+
+		for i, field in enumerate(NUMERIC_FIELDS, 1):
+			columns[field] = np.array([np.nan if row[i] is None else row[i] for row in rows], dtype=float)
+
+		for i, field in enumerate(TEXT_FIELDS, 1 + len(NUMERIC_FIELDS)):
+			columns[field] = text_column([row[i] for row in rows])
+
+		return columns
+
+	def handle(self, *args, **options):
+		start = time.time()
+
+		rules = RuleEngine().load()
+		if options['categories']:
+			missing = [cat for cat in options['categories'] if cat not in rules]
+			if missing:
+				raise CommandError('No nutrition rule for food category %s' % ', '.join(missing))
+			rules = dict((cat, rules[cat]) for cat in options['categories'])
+
+		self.stdout.write('Loading products ...')
+		columns = self.load_columns()
+		self.stdout.write('%d products x %d rules' % (len(columns['id']), len(rules)))
+
+		scores = []
+		for load_cat, rule in sorted(rules.items()):
+			wellness, valid = score_rule(rule, columns, load_cat)
+			scores.append((rule, columns['id'][valid], wellness[valid]))
+
+		total = sum(len(upc_ids) for rule, upc_ids, wellness in scores)
+		scored = time.time()
+		self.stdout.write('Scored %d rows in %.2fs' % (total, scored - start))
+
+		if options['dry_run']:
+			for rule, upc_ids, wellness in scores:
+				self.stdout.write('Category %s: %d scored, %d wellness' % (rule.load_cat, len(upc_ids), wellness.sum()))
+			self.stdout.write(self.style.SUCCESS('Dry run: nothing written'))
+			return
+
+		batch_size = options['batch_size']
+		batch = []
+		with transaction.atomic():
+			for rule, upc_ids, wellness in scores:
+				for upc_id, well in zip(upc_ids.tolist(), wellness.tolist()):
+					batch.append(WellScore(upc_id_id=upc_id, nut_id_id=rule.id, wellness=bool(well)))
+					if len(batch) >= batch_size:
+						record(batch)
+						batch = []
+			record(batch)
+		bump_rule_version()
+
+		elapsed = time.time() - start
+		self.stdout.write(self.style.SUCCESS('Wrote %d wellness scores in %.2fs (%.0f rows/s)' % (total, elapsed, total / elapsed if elapsed else 0)))
+
+		if getattr(settings, 'CATALOG_ENABLED', True):
+			# the catalogue has the old scores in it
+			self.stdout.write('Rebuilding the catalogue ...')
+			self.stdout.write(self.style.SUCCESS('Catalogue of %d products built' % catalog.build()))
@@ -0,0 +1,222 @@
+'''
+Counters and latency histograms for the scan pipeline, served in Prometheus text format at /metrics.
+
+Code times a stage with `with timed('check_wellness'):` ... The time goes into the cafb_stage_seconds histogram and, inside a request, into that request's Server-Timing header (see MetricsMiddleware).
+Everything is kept per process (like cache_stats and log_stats), so each worker reports its own numbers.
+Recording something is a dict lookup and a few additions under a lock, cheap enough to leave on.
+'''
+from bisect import bisect_left
+from collections import defaultdict
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+import threading
+import time
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+	'cafb_requests_total': ('counter', 'Requests served, by view and status code.'),
+	'cafb_request_seconds': ('histogram', 'Time to build each response, by view.'),
+	'cafb_stage_seconds': ('histogram', 'Time spent in each stage of the scan pipeline.'),
+	'cafb_sql_queries_total': ('counter', 'SQL queries run while serving requests, by view.'),
+	'cafb_upstream_seconds': ('histogram', 'Upstream API calls, by source and outcome (found, not_found, error, over_quota).'),
+	'cafb_upstream_lookups_total': ('counter', 'Lookups of unknown UPCs, by the source that answered (none if neither knew it, unavailable if one of them couldn\'t say).'),
+	'cafb_quota_calls_total': ('counter', 'Calls asking for a quota token (see quota.py), by quota, priority and outcome (granted, denied).'),
+}
+
+lock = threading.Lock()
+counters = defaultdict(int)
+histograms = {}
+
+# per-request stage timings, for Server-Timing
+local = threading.local()
+
+SQL_TIMING = getattr(settings, 'METRICS_SQL', True)
+
+
+def labelled(name, labels):
+	return name, tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+	key = labelled(name, labels)
+	with lock:
+		counters[key] += amount
+
+
+def observe(name, seconds, **labels):
+	key = labelled(name, labels)
+	with lock:
+		histogram = histograms.get(key)
+		if histogram is None:
+			# one count per bucket, then +Inf, then the sum
+			histogram = histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+		histogram[bisect_left(BUCKETS, seconds)] += 1
+		histogram[-1] += seconds
+
+
+def stage(name, seconds):
+	observe('cafb_stage_seconds', seconds, stage=name)
+	timings = getattr(local, 'timings', None)
+	if timings is not None:
+		timings.append((name, seconds))
+
+
+class timed(object):
+	'''
+	with timed('stage'): ... records how long the block took, whether or not it raises.
+	'''
+
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, *exc_info):
+		stage(self.name, time.time() - self.start)
+
+
+def server_timing(timings, total):
+	# repeated stages (a batch, say) are added up, in the order they first ran
+	names = []
+	durations = {}
+	for name, seconds in timings:
+		if name not in durations:
+			names.append(name)
+			durations[name] = 0.0
+		durations[name] += seconds
+	parts = ['%s;dur=%.1f' % (name, durations[name] * 1000) for name in names]
+	parts.append('total;dur=%.1f' % (total * 1000))
+	return ', '.join(parts)
+
+
+class TimedCursor(object):
+	'''
+	Wraps a database cursor to count and time its queries for the request being served (local.sql), without keeping the SQL like Django's query log does.
+	'''
+
+	def __init__(self, cursor):
+		self.cursor = cursor
+
+	def __getattr__(self, attr):
+		return getattr(self.cursor, attr)
+
+	def __iter__(self):
+		return iter(self.cursor)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		return self.cursor.__exit__(*exc_info)
+
+	def timed(self, method, *args):
+		start = time.time()
+		try:
+			return method(*args)
+		finally:
+			sql = getattr(local, 'sql', None)
+			if sql is not None:
+				sql[0] += 1
+				sql[1] += time.time() - start
+
+	def execute(self, sql, params=None):
+		return self.timed(self.cursor.execute, sql, params)
+
+	def executemany(self, sql, param_list):
+		return self.timed(self.cursor.executemany, sql, param_list)
+
+
+def time_queries(connection):
+	'''
+	Makes every cursor of a connection a TimedCursor. Connections are per thread, so this is done for each one as requests come in.
+	'''
+	if getattr(connection, 'timed_cursors', False):
+		return
+	for name in ('make_cursor', 'make_debug_cursor'):
+		make = getattr(connection, name)
+		setattr(connection, name, lambda cursor, make=make: TimedCursor(make(cursor)))
+	connection.timed_cursors = True
+
+
+class MetricsMiddleware(object):
+	'''
+	Times every request, counts its SQL queries, and adds a Server-Timing header with the time spent in each stage.
+	Goes first in MIDDLEWARE_CLASSES so the total covers the rest of the middleware too.
+	'''
+
+	def process_request(self, request):
+		local.timings = []
+		local.start = time.time()
+		if SQL_TIMING:
+			time_queries(connections[DEFAULT_DB_ALIAS])
+			# [queries, seconds]
+			local.sql = [0, 0.0]
+
+	def process_response(self, request, response):
+		start = getattr(local, 'start', None)
+		if start is None:
+			# process_request never ran (an earlier middleware answered)
+			return response
+		timings = local.timings
+		local.timings = local.start = None
+
+		match = getattr(request, 'resolver_match', None)
+		view = 'unmatched' if match is None else match.url_name or getattr(match.func, '__name__', 'view')
+		sql = getattr(local, 'sql', None)
+		local.sql = None
+		if sql is not None:
+			queries, seconds = sql
+			inc('cafb_sql_queries_total', queries, view=view)
+			if queries:
+				timings.append(('sql', seconds))
+
+		total = time.time() - start
+		observe('cafb_request_seconds', total, view=view)
+		inc('cafb_requests_total', view=view, status=str(response.status_code))
+		if getattr(settings, 'METRICS_SERVER_TIMING', True):
+			response['Server-Timing'] = server_timing(timings, total)
+		return response
+
+
+def escape(value):
+	return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def sample(name, labels, value):
+	if labels:
+		name = '%s{%s}' % (name, ','.join('%s="%s"' % (label, escape(v)) for label, v in labels))
+	return '%s %s' % (name, repr(float(value)) if isinstance(value, float) else value)
+
+
+def render(extra=()):
+	'''
+	Everything recorded in this process, in Prometheus text format.
+	extra is a list of (name, type, help, [(labels dict, value), ...]) for numbers kept elsewhere.
+	'''
+	with lock:
+		counter_items = sorted(counters.items())
+		histogram_items = sorted((key, list(values)) for key, values in histograms.items())
+
+	families = defaultdict(list)
+	for (name, labels), value in counter_items:
+		families[name].append(sample(name, labels, value))
+	for (name, labels), values in histogram_items:
+		cumulative = 0
+		for le, count in zip(BUCKETS + ('+Inf',), values):
+			cumulative += count
+			families[name].append(sample(name + '_bucket', labels + (('le', le),), cumulative))
+		families[name].append(sample(name + '_sum', labels, values[-1]))
+		families[name].append(sample(name + '_count', labels, cumulative))
+
+	out = []
+	for name in sorted(families):
+		kind, text = HELP.get(name, ('untyped', name))
+		out.extend(['# HELP %s %s' % (name, text), '# TYPE %s %s' % (name, kind)])
+		out.extend(families[name])
+	for name, kind, text, samples in extra:
+		out.extend(['# HELP %s %s' % (name, text), '# TYPE %s %s' % (name, kind)])
+		out.extend(sample(name, sorted(labels.items()), value) for labels, value in samples)
+	return '\n'.join(out) + '\n'
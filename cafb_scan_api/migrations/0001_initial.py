@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.8 on 2026-10-18 10:36
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FoodCat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('load_cat', models.TextField(blank=True, max_length=3, null=True)),
+                ('abbr', models.TextField(blank=True, max_length=10, null=True)),
+                ('name', models.TextField(blank=True, max_length=50, null=True)),
+                ('description', models.TextField(blank=True, max_length=500, null=True)),
+                ('notes', models.TextField(blank=True, max_length=500, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ('created',),
+            },
+        ),
+        migrations.CreateModel(
+            name='NutRule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nutrient', models.CharField(blank=True, choices=[('1', 'fiber'), ('2', 'sodium'), ('3', 'sugar')], default='', max_length=100, null=True)),
+                ('nutritional_field', models.CharField(blank=True, choices=[('1', 'category'), ('2', 'ingredients'), ('3', 'name'), ('4', 'sodium'), ('5', 'sugar')], default='', max_length=100, null=True)),
+                ('rule_type', models.CharField(blank=True, choices=[('1', 'contains'), ('2', 'first_item'), ('3', 'lte')], default='', max_length=100, null=True)),
+                ('value', models.TextField(blank=True, max_length=20, null=True)),
+                ('wellness', models.NullBooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('food_cat_id', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='cafb_scan_api.FoodCat')),
+            ],
+            options={
+                'ordering': ('created',),
+            },
+        ),
+        migrations.CreateModel(
+            name='Scan',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('upc_raw', models.TextField(max_length=30)),
+                ('num_items', models.IntegerField(default='1')),
+                ('device', models.CharField(default='android', max_length=15)),
+                ('user_id', models.CharField(default='keyser_soze', max_length=15)),
+                ('scan_status', models.TextField(default='Unknown', max_length=200)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('food_cat_id', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='cafb_scan_api.FoodCat')),
+            ],
+            options={
+                'ordering': ('created',),
+            },
+        ),
+        migrations.CreateModel(
+            name='UPC',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('upc_code', models.TextField(max_length=50)),
+                ('item_name', models.TextField(blank=True, max_length=100, null=True)),
+                ('brand_id', models.TextField(blank=True, max_length=30, null=True)),
+                ('brand_name', models.TextField(blank=True, max_length=100, null=True)),
+                ('item_image', models.TextField(blank=True, null=True)),
+                ('item_description', models.TextField(blank=True, max_length=500, null=True)),
+                ('api_last_update', models.DateTimeField(blank=True, default=datetime.datetime.now, null=True)),
+                ('ingredients', models.TextField(blank=True, max_length=100, null=True)),
+                ('calories', models.FloatField(blank=True, null=True)),
+                ('calories_from_fat', models.FloatField(blank=True, null=True)),
+                ('total_fat', models.FloatField(blank=True, null=True)),
+                ('saturated_fat', models.FloatField(blank=True, null=True)),
+                ('cholesterol', models.FloatField(blank=True, null=True)),
+                ('sodium', models.FloatField(blank=True, null=True)),
+                ('total_carb', models.FloatField(blank=True, null=True)),
+                ('dietary_fiber', models.FloatField(blank=True, null=True)),
+                ('sugars', models.FloatField(blank=True, null=True)),
+                ('protein', models.FloatField(blank=True, null=True)),
+                ('vitamin_a_dv', models.FloatField(blank=True, null=True)),
+                ('vitamin_c_dv', models.FloatField(blank=True, null=True)),
+                ('calcium_dv', models.FloatField(blank=True, null=True)),
+                ('iron_dv', models.FloatField(blank=True, null=True)),
+                ('serving_per_cont', models.FloatField(blank=True, null=True)),
+                ('serving_size_qty', models.FloatField(blank=True, null=True)),
+                ('serving_size_unit', models.TextField(blank=True, max_length=30, null=True)),
+                ('data_source', models.TextField(blank=True, max_length=30, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ('created',),
+            },
+        ),
+        migrations.CreateModel(
+            name='WellScore',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wellness', models.NullBooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('nut_id', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='cafb_scan_api.NutRule')),
+                ('upc_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cafb_scan_api.UPC')),
+            ],
+            options={
+                'ordering': ('created',),
+            },
+        ),
+        migrations.AddField(
+            model_name='scan',
+            name='upc_id',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='cafb_scan_api.UPC'),
+        ),
+    ]
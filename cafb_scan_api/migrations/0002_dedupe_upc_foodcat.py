@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def dedupe(model, key, references):
+    '''
+    Keeps the oldest row (lowest pk) for each duplicated key, points every foreign key at it, and deletes the rest.
+    Rows without a key aren't duplicates of each other (the unique index allows any number of NULLs), so they're left alone.
+    '''
+    dupes = model.objects.order_by().exclude(**{key: None}).values(key).annotate(n=Count('pk'), keep=Min('pk')).filter(n__gt=1)
+    for dupe in dupes:
+        extra = list(model.objects.filter(**{key: dupe[key]}).exclude(pk=dupe['keep']).values_list('pk', flat=True))
+        for ref_model, field in references:
+            ref_model.objects.filter(**{field + '__in': extra}).update(**{field: dupe['keep']})
+        model.objects.filter(pk__in=extra).delete()
+
+
+def dedupe_rows(apps, schema_editor):
+    UPC = apps.get_model('cafb_scan_api', 'UPC')
+    FoodCat = apps.get_model('cafb_scan_api', 'FoodCat')
+    Scan = apps.get_model('cafb_scan_api', 'Scan')
+    NutRule = apps.get_model('cafb_scan_api', 'NutRule')
+    WellScore = apps.get_model('cafb_scan_api', 'WellScore')
+
+    dedupe(UPC, 'upc_code', [(Scan, 'upc_id'), (WellScore, 'upc_id')])
+    dedupe(FoodCat, 'load_cat', [(Scan, 'food_cat_id'), (NutRule, 'food_cat_id')])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafb_scan_api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_rows, migrations.RunPython.noop),
+    ]
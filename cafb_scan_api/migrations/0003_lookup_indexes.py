@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.8 on 2026-10-18 10:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafb_scan_api', '0002_dedupe_upc_foodcat'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='foodcat',
+            name='load_cat',
+            field=models.TextField(blank=True, max_length=3, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='upc',
+            name='upc_code',
+            field=models.TextField(max_length=50, unique=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='scan',
+            index_together=set([('created', 'scan_status')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='wellscore',
+            index_together=set([('upc_id', 'nut_id', 'created')]),
+        ),
+    ]
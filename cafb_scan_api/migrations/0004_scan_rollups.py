@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.8 on 2026-10-18 10:51
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafb_scan_api', '0003_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'hour'), ('day', 'day')], max_length=4)),
+                ('bucket', models.DateTimeField()),
+                ('scan_status', models.TextField(blank=True, default='', max_length=200)),
+                ('food_cat', models.TextField(blank=True, default='', max_length=3)),
+                ('data_source', models.TextField(blank=True, default='', max_length=30)),
+                ('wellness', models.CharField(default='unknown', max_length=15)),
+                ('total', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ('bucket',),
+            },
+        ),
+        migrations.AddField(
+            model_name='scan',
+            name='wellness',
+            field=models.NullBooleanField(),
+        ),
+        migrations.AlterUniqueTogether(
+            name='scanrollup',
+            unique_together=set([('period', 'bucket', 'scan_status', 'food_cat', 'data_source', 'wellness')]),
+        ),
+    ]
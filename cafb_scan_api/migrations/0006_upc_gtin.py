@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# as cafb_scan_api.gtin had it when this migration was written; migrations can't follow live code
+
+def check_digit(body):
+    total = sum(int(digit) * (3 if i % 2 == 0 else 1) for i, digit in enumerate(reversed(body)))
+    return str((10 - total % 10) % 10)
+
+
+def canonical(code):
+    '''
+    The GTIN-14 for a barcode, or None if it isn't one (not digits, too long, or a bad check digit).
+    '''
+    if code is None:
+        return None
+    code = code.strip()
+    if not code.isdigit() or len(code) > 14 or not code.strip('0'):
+        return None
+    code = code.zfill(14)
+    if check_digit(code[:-1]) != code[-1]:
+        return None
+    return code
+
+
+def fill_gtins(apps, schema_editor):
+    '''
+    Sets UPC.gtin from upc_code. Codes that are the same GTIN spelt differently (012000017421, 12000017421) are merged the same way 0002 merged duplicates: the oldest row is kept and scans and scores are pointed at it.
+    '''
+    UPC = apps.get_model('cafb_scan_api', 'UPC')
+    Scan = apps.get_model('cafb_scan_api', 'Scan')
+    WellScore = apps.get_model('cafb_scan_api', 'WellScore')
+
+    groups = {}
+    for pk, upc_code in UPC.objects.order_by('pk').values_list('pk', 'upc_code').iterator():
+        gtin = canonical(upc_code)
+        if gtin is not None:
+            groups.setdefault(gtin, []).append(pk)
+
+    for gtin, pks in groups.items():
+        keep, extra = pks[0], pks[1:]
+        if extra:
+            Scan.objects.filter(upc_id__in=extra).update(upc_id=keep)
+            WellScore.objects.filter(upc_id__in=extra).update(upc_id=keep)
+            UPC.objects.filter(pk__in=extra).delete()
+        UPC.objects.filter(pk=keep).update(gtin=gtin)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafb_scan_api', '0005_cursor_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upc',
+            name='gtin',
+            field=models.CharField(blank=True, max_length=14, null=True),
+        ),
+        migrations.RunPython(fill_gtins, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='upc',
+            name='gtin',
+            field=models.CharField(blank=True, max_length=14, null=True, unique=True),
+        ),
+    ]
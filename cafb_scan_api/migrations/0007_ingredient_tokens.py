@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.8 on 2026-10-18 11:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import re
+
+# as cafb_scan_api.ingredients had it when this migration was written; migrations can't follow live code
+WORD = re.compile(r'\w+', re.UNICODE)
+CHUNK_SIZE = 500
+
+
+def normalize(text):
+    return u' '.join(text.lower().split())
+
+
+def first_ingredient(ingredients):
+    return normalize(ingredients.replace('+++', ',').split(',')[0])
+
+
+def tokens(ingredients):
+    if not ingredients:
+        return {}
+    first = set(WORD.findall(first_ingredient(ingredients)))
+    return dict((word, word in first) for word in WORD.findall(ingredients.lower()))
+
+
+def index_ingredients(apps, schema_editor):
+    '''
+    Sets first_ingredient and adds the IngredientToken rows for every product with ingredients, CHUNK_SIZE at a time.
+    '''
+    UPC = apps.get_model('cafb_scan_api', 'UPC')
+    IngredientToken = apps.get_model('cafb_scan_api', 'IngredientToken')
+
+    last = 0
+    while True:
+        rows = list(UPC.objects.exclude(ingredients=None).filter(pk__gt=last).order_by('pk').values_list('pk', 'ingredients')[:CHUNK_SIZE])
+        if not rows:
+            return
+        last = rows[-1][0]
+        firsts = {}
+        token_rows = []
+        for pk, ingredients in rows:
+            firsts.setdefault(first_ingredient(ingredients), []).append(pk)
+            token_rows.extend(IngredientToken(upc_id_id=pk, token=token, first=first) for token, first in tokens(ingredients).items())
+        # one UPDATE per distinct first ingredient rather than per product
+        for first, same in firsts.items():
+            UPC.objects.filter(pk__in=same).update(first_ingredient=first)
+        IngredientToken.objects.bulk_create(token_rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafb_scan_api', '0006_upc_gtin'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngredientToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.TextField(db_index=True, max_length=50)),
+                ('first', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='upc',
+            name='first_ingredient',
+            field=models.TextField(blank=True, db_index=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='ingredienttoken',
+            name='upc_id',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cafb_scan_api.UPC'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='ingredienttoken',
+            unique_together=set([('upc_id', 'token')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='ingredienttoken',
+            index_together=set([('token', 'first')]),
+        ),
+        migrations.RunPython(index_ingredients, migrations.RunPython.noop),
+    ]
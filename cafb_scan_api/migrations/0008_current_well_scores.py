@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.8 on 2026-10-18 11:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+# products per query; SQLite allows 999 variables in one
+CHUNK_SIZE = 400
+
+
+def fill_current_scores(apps, schema_editor):
+    '''
+    Fills CurrentWellScore with the latest score for each (UPC, rule) in the WellScore history, CHUNK_SIZE products at a time.
+    The table was only just created, so every row is new.
+    '''
+    WellScore = apps.get_model('cafb_scan_api', 'WellScore')
+    CurrentWellScore = apps.get_model('cafb_scan_api', 'CurrentWellScore')
+
+    now = timezone.now()
+    last = 0
+    while True:
+        upc_ids = list(WellScore.objects.filter(upc_id__gt=last).order_by('upc_id').values_list('upc_id', flat=True).distinct()[:CHUNK_SIZE])
+        if not upc_ids:
+            return
+        # oldest first, so the latest score wins
+        latest = {}
+        rows = WellScore.objects.filter(upc_id__gte=upc_ids[0], upc_id__lte=upc_ids[-1]).exclude(nut_id=None).order_by('created').values_list('upc_id', 'nut_id', 'wellness')
+        for upc_id, nut_id, wellness in rows:
+            latest[(upc_id, nut_id)] = wellness
+        CurrentWellScore.objects.bulk_create(
+            CurrentWellScore(upc_id_id=upc_id, nut_id_id=nut_id, wellness=wellness, updated=now)
+            for (upc_id, nut_id), wellness in sorted(latest.items()))
+        last = upc_ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafb_scan_api', '0007_ingredient_tokens'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CurrentWellScore',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wellness', models.NullBooleanField()),
+                ('updated', models.DateTimeField(db_index=True)),
+                ('nut_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cafb_scan_api.NutRule')),
+                ('upc_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cafb_scan_api.UPC')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='currentwellscore',
+            unique_together=set([('upc_id', 'nut_id')]),
+        ),
+        migrations.RunPython(fill_current_scores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.8 on 2026-10-18 11:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafb_scan_api', '0008_current_well_scores'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UpstreamFetch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=15)),
+                ('gtin', models.CharField(db_index=True, max_length=14)),
+                ('fetched', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'ordering': ('fetched',),
+            },
+        ),
+        migrations.CreateModel(
+            name='UpstreamPayload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=40, unique=True)),
+                ('data', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='upstreamfetch',
+            name='payload',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='cafb_scan_api.UpstreamPayload'),
+        ),
+    ]
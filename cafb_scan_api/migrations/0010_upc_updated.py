@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.8 on 2026-10-18 14:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def updated_when_created(apps, schema_editor):
+    # rather than all at once now, which would put every product in the next snapshot delta
+    UPC = apps.get_model('cafb_scan_api', 'UPC')
+    UPC.objects.update(updated=models.F('created'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafb_scan_api', '0009_upstream_payloads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upc',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(updated_when_created, migrations.RunPython.noop),
+    ]
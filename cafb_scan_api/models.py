@@ -8,6 +8,7 @@ from datetime import datetime
 NUTRIENT_CHOICES = [('1','fiber'), ('2','sodium'), ('3','sugar')]
 FIELD_CHOICES = [('1','category'), ('2','ingredients'), ('3','name'), ('4','sodium'), ('5','sugar')]
 TYPE_CHOICES = [('1','contains'), ('2','first_item'), ('3','lte')]
+PERIOD_CHOICES = [('hour','hour'), ('day','day')]
 
 # Create your models here.
 class UPC(models.Model):
@@ -15,7 +16,9 @@ class UPC(models.Model):
 	'''
 	This records all details from Nutrionix database, or entered manually (functionality TK)
 	'''
-	upc_code = models.TextField(max_length=50)
+	upc_code = models.TextField(max_length=50, unique=True)
+	# upc_code as a zero padded GTIN-14 (see gtin.py); what lookups go by, so 012000017421 and 12000017421 are one product. Null if upc_code isn't a valid barcode
+	gtin = models.CharField(max_length=14, unique=True, blank=True, null=True)
 	item_name = models.TextField(max_length=100,blank=True,null=True)
 	brand_id = models.TextField(max_length=30,blank=True,null=True)
 	brand_name = models.TextField(max_length=100,blank=True,null=True)
@@ -23,6 +26,8 @@ class UPC(models.Model):
 	item_description = models.TextField(max_length=500,blank=True,null=True)
 	api_last_update = models.DateTimeField(default=datetime.now,blank=True,null=True)
 	ingredients = models.TextField(max_length=100,blank=True,null=True)
+	# parsed out of ingredients when the row is written (see ingredients.py), so first_item rules don't split the text on every scan
+	first_ingredient = models.TextField(max_length=100, blank=True, null=True, db_index=True)
 	calories = models.FloatField(blank=True,null=True)
 	calories_from_fat = models.FloatField(blank=True,null=True)
 	total_fat = models.FloatField(blank=True,null=True)
@@ -41,17 +46,33 @@ class UPC(models.Model):
 	serving_size_qty = models.FloatField(blank=True,null=True)
 	serving_size_unit = models.TextField(max_length=30,blank=True,null=True)
 	data_source = models.TextField(max_length=30,blank=True,null=True)
-	created = models.DateTimeField(auto_now_add=True)
+	created = models.DateTimeField(auto_now_add=True, db_index=True)
+	# last time the product's details changed, so offline snapshot deltas (snapshot.py) pick up edits; bulk .update()s must set it themselves
+	updated = models.DateTimeField(auto_now=True, db_index=True)
 
 	class Meta:
 		ordering = ('created',)
 
 
+class IngredientToken(models.Model):
+	'''
+	This records each word in a product's ingredients, and whether it is part of the first ingredient, so products can be found by ingredient with an index (see ingredients.py)
+	'''
+
+	upc_id = models.ForeignKey(UPC, on_delete=models.CASCADE)
+	token = models.TextField(max_length=50, db_index=True)
+	first = models.BooleanField(default=False)
+
+	class Meta:
+		unique_together = [('upc_id', 'token')]
+		index_together = [('token', 'first')]
+
+
 class FoodCat(models.Model):
 	'''
 	This records all food categories designated in the database
 	'''
-	load_cat = models.TextField(max_length=3, blank=True, null=True)
+	load_cat = models.TextField(max_length=3, unique=True, blank=True, null=True)
 	abbr = models.TextField(max_length=10, blank=True, null=True)
 	name = models.TextField(max_length=50, blank=True, null=True)
 	description = models.TextField(max_length=500, blank=True, null=True)
@@ -74,10 +95,12 @@ class Scan(models.Model):
 	device = models.CharField(max_length=15, default='android')
 	user_id = models.CharField(max_length=15, default='keyser_soze')
 	scan_status = models.TextField(max_length=200, default='Unknown')
+	wellness = models.NullBooleanField(blank=True, null=True)
 	created = models.DateTimeField(auto_now_add=True)
 
 	class Meta:
 		ordering = ('created',)
+		index_together = [('created', 'scan_status')]
 
 
 class NutRule(models.Model):
@@ -107,7 +130,76 @@ class WellScore(models.Model):
 	upc_id = models.ForeignKey(UPC, on_delete=models.CASCADE)
 	wellness = models.NullBooleanField(default=False,blank=True, null=True)
 	nut_id = models.ForeignKey(NutRule, on_delete=models.CASCADE,blank=True, null=True)
-	created = models.DateTimeField(auto_now_add=True)
+	created = models.DateTimeField(auto_now_add=True, db_index=True)
 
 	class Meta:
 		ordering = ('created',)
+		index_together = [('upc_id', 'nut_id', 'created')]
+
+
+class CurrentWellScore(models.Model):
+	'''
+	This records the latest wellness score for each product and nutrition rule, kept in step with every write to WellScore (see scores.py).
+	Scans read this instead of WellScore, so they cost the same however much score history piles up.
+	'''
+
+	upc_id = models.ForeignKey(UPC, on_delete=models.CASCADE)
+	nut_id = models.ForeignKey(NutRule, on_delete=models.CASCADE)
+	wellness = models.NullBooleanField(blank=True, null=True)
+	# when this became the current score
+	updated = models.DateTimeField(db_index=True)
+
+	class Meta:
+		unique_together = [('upc_id', 'nut_id')]
+
+
+class ScanRollup(models.Model):
+	'''
+	This records scan counts per hour and per day, by scan status, food category, data source and wellness.
+	It is kept up to date as scans are written (and rebuilt by manage.py rollup_scans), so the scan tracker never has to count the whole Scan table.
+	'''
+
+	period = models.CharField(choices=PERIOD_CHOICES, max_length=4)
+	bucket = models.DateTimeField()
+	scan_status = models.TextField(max_length=200, default='', blank=True)
+	food_cat = models.TextField(max_length=3, default='', blank=True)
+	data_source = models.TextField(max_length=30, default='', blank=True)
+	wellness = models.CharField(max_length=15, default='unknown')
+	total = models.IntegerField(default=0)
+
+	class Meta:
+		ordering = ('bucket',)
+		unique_together = [('period', 'bucket', 'scan_status', 'food_cat', 'data_source', 'wellness')]
+
+
+class UpstreamPayload(models.Model):
+	'''
+	This records each distinct product payload OFF or Nutritionix has sent us, zlib compressed JSON keyed by its SHA-1, so the same payload is only stored once (see payloads.py)
+	'''
+
+	digest = models.CharField(max_length=40, unique=True)
+	data = models.BinaryField()
+	created = models.DateTimeField(auto_now_add=True)
+
+
+class UpstreamFetch(models.Model):
+	'''
+	This records every product fetched from OFF or Nutritionix: which source, which GTIN, when, and the payload it sent, so UPC rows can be rebuilt without asking again (manage.py reparse_upstream). Rebuilding a row is recorded as another fetch of the same payload
+	'''
+
+	source = models.CharField(max_length=15)
+	gtin = models.CharField(max_length=14, db_index=True)
+	payload = models.ForeignKey(UpstreamPayload, on_delete=models.PROTECT)
+	fetched = models.DateTimeField(auto_now_add=True, db_index=True)
+
+	class Meta:
+		ordering = ('fetched',)
+
+
+class Counter(models.Model):
+	'''
+	This records named numbers that every process has to agree on, like the rule version (see rules.py) and, when the wellness cache isn't shared, the Nutritionix quota (see quota.py)
+	'''
+
+	name = models.CharField(max_length=100, unique=True)
+	value = models.BigIntegerField(default=0)
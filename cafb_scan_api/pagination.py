@@ -0,0 +1,22 @@
+from rest_framework.pagination import CursorPagination
+
+
+class CreatedCursorPagination(CursorPagination):
+	'''
+	Pages the /api/v1/ lists newest first by created, using an opaque ?cursor= instead of ?page=N.
+	Every page is a "created < x ORDER BY created DESC LIMIT n" on an index, so page 10,000 costs the same as page 1 and rows added mid-walk don't shift the pages.
+	Bulk consumers can ask for up to max_page_size rows a page with ?page_size=.
+	'''
+	ordering = '-created'
+	page_size_query_param = 'page_size'
+	max_page_size = 1000
+
+	def get_page_size(self, request):
+		# CursorPagination doesn't read page_size_query_param itself (yet)
+		try:
+			size = int(request.query_params[self.page_size_query_param])
+		except (KeyError, ValueError):
+			return self.page_size
+		if size <= 0:
+			return self.page_size
+		return min(size, self.max_page_size)
@@ -0,0 +1,51 @@
+'''
+Every product OFF or Nutritionix sends us is kept as it came, so a fix to how we parse them can be applied to the whole catalogue (manage.py reparse_upstream) without asking the APIs again.
+
+A payload is stored once per distinct content: UpstreamPayload holds it as zlib compressed JSON (keys sorted, so equal payloads compress to the same bytes) under its SHA-1.
+UpstreamFetch records each fetch: the source, the GTIN and when, pointing at the payload it sent. reparse_upstream records its rewrites of a product the same way, so the last fetch always says when the row was last written from a payload.
+'''
+from django.db.models import Max
+import hashlib
+import json
+import zlib
+
+from cafb_scan_api.models import UpstreamPayload, UpstreamFetch
+
+CHUNK_SIZE = 500
+
+
+def encode(payload):
+	'''
+	(digest, compressed bytes) for a payload.
+	'''
+	text = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+	return hashlib.sha1(text).hexdigest(), zlib.compress(text, 9)
+
+
+def decode(data):
+	return json.loads(zlib.decompress(bytes(data)))
+
+
+def save(source, gtin, payload):
+	'''
+	Archives a payload a source sent for a GTIN.
+	'''
+	digest, data = encode(payload)
+	stored, created = UpstreamPayload.objects.get_or_create(digest=digest, defaults={'data': data})
+	return UpstreamFetch.objects.create(source=source, gtin=gtin, payload=stored)
+
+
+def latest(gtins, source=None):
+	'''
+	{gtin: (source, compressed payload, when it was fetched, payload id)} for the last fetch of each GTIN (from source, if given).
+	'''
+	gtins = list(gtins)
+	found = {}
+	for i in range(0, len(gtins), CHUNK_SIZE):
+		fetches = UpstreamFetch.objects.filter(gtin__in=gtins[i:i + CHUNK_SIZE])
+		if source is not None:
+			fetches = fetches.filter(source=source)
+		last = fetches.order_by().values('gtin').annotate(last=Max('pk')).values_list('last', flat=True)
+		for gtin, fetch_source, data, fetched, payload_id in UpstreamFetch.objects.filter(pk__in=list(last)).values_list('gtin', 'source', 'payload__data', 'fetched', 'payload_id'):
+			found[gtin] = (fetch_source, bytes(data), fetched, payload_id)
+	return found
@@ -1,8 +1,126 @@
-from django.core.exceptions import ObjectDoesNotExist
-import os
-import unirest
-import pprint
-from cafb_scan_api.models import UPC, Scan, FoodCat, WellScore, NutRule
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from concurrent.futures import ThreadPoolExecutor, wait
+from cafb_scan_api.models import UPC, WellScore, CurrentWellScore
+from cafb_scan_api.rules import engine
+from cafb_scan_api.upstream import lookup, fetch_open_food_facts, fetch_nutrionix, OFF, NUTRITIONIX, UNAVAILABLE
+from cafb_scan_api.coalesce import fetches, acquire, release, wait_for
+from cafb_scan_api.metrics import timed
+from cafb_scan_api.gtin import canonical, short
+from cafb_scan_api.ingredients import first_ingredient, reindex
+from cafb_scan_api.scores import record
+from cafb_scan_api import payloads
+
+INVALID_UPC = 'Invalid UPC code (bad length or check digit). Please scan again.'
+LOOKUP_TIMED_OUT = 'Item lookup is taking too long. Please scan again.'
+# neither API knows the UPC (cached, see cache.py), or one of them couldn't tell us (not cached)
+ITEM_NOT_FOUND = 'API Error or Item Not Found. Please enter item details via app.'
+UPSTREAM_UNAVAILABLE = 'Could not reach the product databases. Please scan again.'
+
+# a batch's new UPCs are looked up this many at a time, and the batch stops waiting on them after BATCH_SCAN_DEADLINE seconds
+batch_lookups = ThreadPoolExecutor(max_workers=getattr(settings, 'BATCH_SCAN_LOOKUPS', 8))
+BATCH_SCAN_DEADLINE = getattr(settings, 'BATCH_SCAN_DEADLINE', 10.0)
+
+
+# OFF gives energy in kcal or kJ; calories are kcal, like Nutritionix's
+KJ_PER_KCAL = 4.184
+
+
+def off_calories(nutriments):
+	'''
+	kcal for an OFF product's energy, or None if it has none (or in a unit we don't know).
+	'''
+	if not nutriments['energy']:
+		return None
+	if nutriments['energy_unit'] == 'kcal':
+		return float(nutriments['energy'])
+	if nutriments['energy_unit'] == 'kJ':
+		return float(nutriments['energy']) / KJ_PER_KCAL
+	return None
+
+
+def off_columns(product):
+	'''
+	UPC column values (all but upc_code and gtin) for an OFF product. Leaves product as it is, so it can be archived and reparsed (manage.py reparse_upstream picks up fixes here).
+	'''
+	nutriments = product['nutriments']
+	#ISSUE: Please check my work
+	return dict(
+			item_name=product['product_name'],
+			brand_id=None, #not in OFF
+			brand_name=product['brands'],
+			item_description=product['generic_name'],
+			api_last_update=product['last_edit_dates_tags'][0],
+			#converting their pretty list of dictionaries to a plain ole list of ingredients so it is comparable to the other API
+			ingredients=", ".join([item['text'] for item in product['ingredients']]),
+			#RE: nutriMents: yes there's a typo in the key; not sure how long they'll keep it; if this starts fussing that might be something to check out first
+			calories=off_calories(nutriments),
+			#ISSUE: There are a bunch of wacky foreign units in OFF; need to write fxn to get all these to calories in the US sense
+			calories_from_fat=None, #NA in OFF, as far as I can tell
+			total_fat=float(nutriments['fat']) if nutriments['fat'] else None,
+			saturated_fat=float(nutriments['saturated-fat']) if nutriments['saturated-fat'] else None,
+			cholesterol=None, #NA in OFF, as far as I can tell
+			sodium=float(nutriments['sodium']) if nutriments['sodium'] else None,
+			total_carb=float(nutriments['carbohydrates']) if nutriments['carbohydrates'] else None,
+			dietary_fiber=float(nutriments['fiber']) if nutriments['fiber'] else None,
+			sugars=float(nutriments['sugars']) if nutriments['sugars'] else None,
+			protein=float(nutriments['proteins']) if nutriments['proteins'] else None,
+			vitamin_a_dv=None, #NA in OFF, as far as I can tell
+			vitamin_c_dv=None, #NA in OFF, as far as I can tell
+			calcium_dv=None, #NA in OFF, as far as I can tell
+			iron_dv=None, #NA in OFF, as far as I can tell
+			serving_per_cont=float(nutriments['fat']) if nutriments['fat'] else None,
+			serving_size_qty=float(product['serving_quantity']) if product['serving_quantity'] else None,
+			serving_size_unit=filter(lambda x: x.isalpha(), product['serving_size']),
+			data_source='Open Food Facts'
+	)
+
+
+def nutritionix_info(item):
+	'''
+	A Nutritionix item with the nf_ prefixes dropped and ingredient_statement called ingredients, like our own fields.
+	'''
+	new_dict_keys = map(lambda x:str(x).replace('nf_',''), item.keys())
+	new_dict_keys = ['ingredients' if name=='ingredient_statement' else name for name in new_dict_keys]
+	return dict(zip(new_dict_keys,item.values()))
+
+
+def nutritionix_columns(item):
+	'''
+	UPC column values (all but upc_code and gtin) for a Nutritionix item, like off_columns().
+	'''
+	info = nutritionix_info(item)
+	return dict(
+			item_name=info['item_name'],
+			brand_id=info['brand_id'],
+			brand_name=info['brand_name'],
+			item_description=info['item_description'],
+			api_last_update=info['updated_at'],
+			ingredients=info['ingredients'],
+			calories=float(info['calories']) if info['calories'] else None,
+			#ISSUE: All of the ones below this point should be rewritten to be like the one above. Basically, the data comes from the API as a string, and we need it to be float or None, but float has a problem with Nones, so here we are. Also possible that the API call data comes in as float, but it felt like an issue at the time.
+			calories_from_fat=None if not info['calories_from_fat'] else float(info['calories_from_fat']),
+			total_fat=None if not info['total_fat'] else float(info['total_fat']),
+			saturated_fat=None if not info['saturated_fat'] else float(info['saturated_fat']),
+			cholesterol=None if not info['cholesterol'] else float(info['cholesterol']),
+			sodium=None if not info['sodium'] else float(info['sodium']),
+			total_carb=None if not info['total_carbohydrate'] else float(info['total_carbohydrate']),
+			dietary_fiber=None if not info['dietary_fiber'] else float(info['dietary_fiber']),
+			sugars=None if not info['sugars'] else float(info['sugars']),
+			protein=None if not info['protein'] else float(info['protein']),
+			vitamin_a_dv=None if not info['vitamin_a_dv'] else float(info['vitamin_a_dv']),
+			vitamin_c_dv=None if not info['vitamin_c_dv'] else float(info['vitamin_c_dv']),
+			calcium_dv=None if not info['calcium_dv'] else float(info['calcium_dv']),
+			iron_dv=None if not info['iron_dv'] else float(info['iron_dv']),
+			serving_per_cont=None if not info['servings_per_container'] else float(info['servings_per_container']),
+			serving_size_qty=None if not info['serving_size_qty'] else float(info['serving_size_qty']),
+			serving_size_unit=info['serving_size_unit'],
+			data_source='Nutrionix'
+	)
+
+
+# how to turn each source's payload into UPC columns
+COLUMNS = {OFF: off_columns, NUTRITIONIX: nutritionix_columns}
 
 class Food(object):
 	'''
@@ -31,9 +149,15 @@ class Food(object):
 
 	def __init__(self, upc_code, food_cat, api_key, api_id):
 		self.upc_code = upc_code
+		# what we look it up by; None if upc_code isn't a valid barcode, and then run() gives up before any lookup
+		self.gtin = canonical(upc_code)
 		self.api_key = api_key 
 		self.api_id = api_id
 		self.food_cat = food_cat
+		self.food_info = None
+		self.upc_pk = None
+		self.food_cat_pk = engine.food_cat_pk(food_cat)
+		self.nut_rule = engine.rule_for(food_cat)
 		self.food_info, self.api_response, self.wellness = self.run()
 		
 	def reset_keys(self, new_key):
@@ -52,15 +176,19 @@ class Food(object):
 	def check_wellness(self):
 		'''
 		This checks for an existing wellness score based on the upc code and nutrition rule for the given food category.
-		Returns wellness score if exists, false otherwise.
+		The category and rule come from the rule engine, so this is at most two queries: the UPC row (kept in self.food_info) and its current score (CurrentWellScore, so the length of the score history doesn't matter).
+		Returns wellness score if exists, None otherwise.
 		'''
-		try:
-			upc_key = UPC.objects.values_list('pk',flat=True).get(upc_code=self.upc_code)
-			cat_key = FoodCat.objects.values_list('pk', flat=True).get(load_cat=self.food_cat)
-			nut_key = NutRule.objects.values_list('pk', flat=True).get(food_cat_id_id=cat_key)
-			return WellScore.objects.filter(upc_id_id=upc_key,nut_id_id=nut_key).values()
-		except ObjectDoesNotExist:
-			return False
+		db_check = UPC.objects.filter(gtin=self.gtin).values()[:1]
+		if not db_check:
+			return None
+
+		self.food_info = db_check[0]
+		self.upc_pk = self.food_info['id']
+		if self.nut_rule is None:
+			return None
+
+		return CurrentWellScore.objects.filter(upc_id_id=self.upc_pk,nut_id_id=self.nut_rule.id).values_list('wellness', flat=True).first()
 
 
 	def get_food_item(self):
@@ -68,107 +196,94 @@ class Food(object):
 		Get nutritional info from the UPC table, Nutrionix API, or add in new item if not found
 		"""
 
-		#check if in our database already
-		db_check = UPC.objects.filter(upc_code=self.upc_code).values()
-		if db_check:
-			self.food_info = db_check[0]
+		#check if in our database already (check_wellness has usually looked already)
+		if self.upc_pk is None:
+			db_check = UPC.objects.filter(gtin=self.gtin).values()[:1]
+			if db_check:
+				self.food_info = db_check[0]
+				self.upc_pk = self.food_info['id']
+
+		if self.upc_pk is not None:
 			self.api_response = {'success' : 'Already in database'}
 		else:
-			#first try OFF 'cause it's free, otherwise try nutritionix
-			off_check = self.get_open_food_facts()
-			self.food_info, source = (off_check, 'OFF') if off_check else (self.get_nutrionix(), 'Nutrionix')
-
-			api_success = {'success' : 'Item found in {0}'.format(source)}
-			api_fail = {'error': 'API Error or Item Not Found. Please enter item details via app.'}
-			self.api_response =  api_success if self.food_info else api_fail
+			# scans of the same new UPC at the same time share one upstream fetch
+			(food_info, self.api_response, self.upc_pk), leader = fetches.do(self.gtin, self.fetch_food_item)
+			self.food_info = dict(food_info) if food_info else food_info
 
 		return self.food_info, self.api_response
 
-	def get_open_food_facts(self):
-		response = unirest.get("http://world.openfoodfacts.org/api/v0/product/{upc}.json".format(upc=self.upc_code),headers={"Accept": "application/json"})
+	def fetch_food_item(self):
+		'''
+		Looks the UPC up in OFF and Nutritionix and saves it to the UPC table.
+		Across workers, only the one holding the UPC's lock asks upstream; the others wait for its row to show up.
+		Returns (food_info, api_response, upc_pk).
+		'''
+		if not acquire(self.gtin):
+			db_check = wait_for(self.gtin, lambda: list(UPC.objects.filter(gtin=self.gtin).values()[:1]))
+			if db_check:
+				return db_check[0], {'success' : 'Already in database'}, db_check[0]['id']
+			# we don't know what the other worker found out
+			return None, {'error': UPSTREAM_UNAVAILABLE}, None
 
-		if response.code == 200 and response.body['status'] == 1:
-			self.food_info = response.body['product']
-			self.food_info['ingredients'] = ", ".join([item['text'] for item in self.food_info['ingredients']])
-			#converting their pretty list of dictionaries to a plain ole list of ingredients so it is comparable to the other API
+		try:
+			#ask OFF and nutritionix at once; OFF wins if it answers in time 'cause it's free
+			source, payload = lookup(short(self.gtin), self.api_id, self.api_key)
+			if source == OFF:
+				self.food_info = self.get_open_food_facts(payload)
+			elif source == NUTRITIONIX:
+				self.food_info = self.get_nutrionix(payload)
+			else:
+				self.food_info = None
+		finally:
+			release(self.gtin)
+
+		if self.food_info:
+			return self.food_info, {'success' : 'Item found in {0}'.format(source)}, self.upc_pk
+		return self.food_info, {'error': UPSTREAM_UNAVAILABLE if source == UNAVAILABLE else ITEM_NOT_FOUND}, self.upc_pk
+
+	def save_upc(self, obj):
+		'''
+		Saves a new UPC row. If someone else saved this GTIN first, the unique constraint stops a duplicate and we use their row.
+		'''
+		try:
+			with transaction.atomic():
+				obj.save()
+			self.upc_pk = obj.pk
+			reindex([obj.pk])
+		except IntegrityError:
+			self.upc_pk = UPC.objects.values_list('pk', flat=True).get(gtin=self.gtin)
+		return self.upc_pk
+
+	def get_open_food_facts(self, product=None):
+		'''
+		Saves an OFF product to the UPC table, fetching it first if it isn't passed in. The raw product is archived first (see payloads.py).
+		'''
+		if product is None:
+			product = fetch_open_food_facts(short(self.gtin))
+
+		if product:
+			payloads.save(OFF, self.gtin, product)
+			obj = UPC(upc_code=self.upc_code, gtin=self.gtin, **off_columns(product))
 
-			#ISSUE: Please check my work
-			obj = UPC(
-					upc_code=self.upc_code,
-					item_name=self.food_info['product_name'],
-					brand_id=None, #not in OFF
-					brand_name=self.food_info['brands'],
-					item_description=self.food_info['generic_name'],
-					api_last_update=self.food_info['last_edit_dates_tags'][0],
-					ingredients=self.food_info['ingredients'],
-					#RE: nutriMents: yes there's a typo in the key; not sure how long they'll keep it; if this starts fussing that might be something to check out first
-					calories=float(self.food_info['nutriments']['energy'])**1000 if self.food_info['nutriments']['energy'] and self.food_info['nutriments']['energy_unit'] == 'kcal' else None,
-					#ISSUE: There are a bunch of wacky foreign units in OFF; need to write fxn to get all these to calories in the US sense
-					calories_from_fat=None, #NA in OFF, as far as I can tell
-					total_fat=float(self.food_info['nutriments']['fat']) if self.food_info['nutriments']['fat'] else None,
-					saturated_fat=float(self.food_info['nutriments']['saturated-fat']) if self.food_info['nutriments']['saturated-fat'] else None,
-					cholesterol=None, #NA in OFF, as far as I can tell
-					sodium=float(self.food_info['nutriments']['sodium']) if self.food_info['nutriments']['sodium'] else None,
-					total_carb=float(self.food_info['nutriments']['carbohydrates']) if self.food_info['nutriments']['carbohydrates'] else None,
-					dietary_fiber=float(self.food_info['nutriments']['fiber']) if self.food_info['nutriments']['fiber'] else None,
-					sugars=float(self.food_info['nutriments']['sugars']) if self.food_info['nutriments']['sugars'] else None,
-					protein=float(self.food_info['nutriments']['proteins']) if self.food_info['nutriments']['proteins'] else None,
-					vitamin_a_dv=None, #NA in OFF, as far as I can tell
-					vitamin_c_dv=None, #NA in OFF, as far as I can tell
-					calcium_dv=None, #NA in OFF, as far as I can tell
-					iron_dv=None, #NA in OFF, as far as I can tell
-					serving_per_cont=float(self.food_info['nutriments']['fat']) if self.food_info['nutriments']['fat'] else None,
-					serving_size_qty=float(self.food_info['serving_quantity']) if self.food_info['serving_quantity'] else None,
-					serving_size_unit=filter(lambda x: x.isalpha(), self.food_info['serving_size']),
-					data_source='Open Food Facts'
-			)
-
-			obj.save()
-			self.food_info = UPC.objects.filter(upc_code=self.upc_code).values()[0] 
+			self.save_upc(obj)
+			self.food_info = UPC.objects.filter(pk=self.upc_pk).values()[0] 
 			#ISSUE: better parsing of OFF (kind of a hot mess), this was very rushed; hence why I am just using what I put in table
 
 			return self.food_info
 
-	def get_nutrionix(self):
-		response = unirest.get("https://api.nutritionix.com/v1_1/item?upc={upc}&appId={apiID}&appKey={apiKey}".format(
-		apiID=self.api_id, apiKey=self.api_key,upc=self.upc_code),headers={"Accept": "application/json"})
-
-		if response.code == 200:
-			self.food_info = response.body
-			new_dict_keys = map(lambda x:str(x).replace('nf_',''), self.food_info.keys())
-			new_dict_keys = ['ingredients' if name=='ingredient_statement' else name for name in new_dict_keys]
-			self.food_info = dict(zip(new_dict_keys,self.food_info.values()))
-
-			obj = UPC(
-					upc_code=self.upc_code,
-					item_name=self.food_info['item_name'],
-					brand_id=self.food_info['brand_id'],
-					brand_name=self.food_info['brand_name'],
-					item_description=self.food_info['item_description'],
-					api_last_update=self.food_info['updated_at'],
-					ingredients=self.food_info['ingredients'],
-					calories=float(self.food_info['calories']) if self.food_info['calories'] else None,
-					#ISSUE: All of the ones below this point should be rewritten to be like the one above. Basically, the data comes from the API as a string, and we need it to be float or None, but float has a problem with Nones, so here we are. Also possible that the API call data comes in as float, but it felt like an issue at the time.
-					calories_from_fat=None if not self.food_info['calories_from_fat'] else float(self.food_info['calories_from_fat']),
-					total_fat=None if not self.food_info['total_fat'] else float(self.food_info['total_fat']),
-					saturated_fat=None if not self.food_info['saturated_fat'] else float(self.food_info['saturated_fat']),
-					cholesterol=None if not self.food_info['cholesterol'] else float(self.food_info['cholesterol']),
-					sodium=None if not self.food_info['sodium'] else float(self.food_info['sodium']),
-					total_carb=None if not self.food_info['total_carbohydrate'] else float(self.food_info['total_carbohydrate']),
-					dietary_fiber=None if not self.food_info['dietary_fiber'] else float(self.food_info['dietary_fiber']),
-					sugars=None if not self.food_info['sugars'] else float(self.food_info['sugars']),
-					protein=None if not self.food_info['protein'] else float(self.food_info['protein']),
-					vitamin_a_dv=None if not self.food_info['vitamin_a_dv'] else float(self.food_info['vitamin_a_dv']),
-					vitamin_c_dv=None if not self.food_info['vitamin_c_dv'] else float(self.food_info['vitamin_c_dv']),
-					calcium_dv=None if not self.food_info['calcium_dv'] else float(self.food_info['calcium_dv']),
-					iron_dv=None if not self.food_info['iron_dv'] else float(self.food_info['iron_dv']),
-					serving_per_cont=None if not self.food_info['servings_per_container'] else float(self.food_info['servings_per_container']),
-					serving_size_qty=None if not self.food_info['serving_size_qty'] else float(self.food_info['serving_size_qty']),
-					serving_size_unit=self.food_info['serving_size_unit'],
-					data_source='Nutrionix'
-			)
-
-			obj.save()
+	def get_nutrionix(self, item=None):
+		'''
+		Saves a Nutritionix item to the UPC table, fetching it first if it isn't passed in. The raw item is archived first (see payloads.py).
+		'''
+		if item is None:
+			item = fetch_nutrionix(short(self.gtin), self.api_id, self.api_key)
+
+		if item:
+			payloads.save(NUTRITIONIX, self.gtin, item)
+			self.food_info = nutritionix_info(item)
+			obj = UPC(upc_code=self.upc_code, gtin=self.gtin, **nutritionix_columns(item))
+
+			self.save_upc(obj)
 
 			return self.food_info
 	
@@ -194,10 +309,11 @@ class Food(object):
 	@property
 	def main_ingredient(self):
 		"""
-		Extract main ingredient of the food
+		Extract main ingredient of the food (parsed when the UPC row was saved, see ingredients.py)
 		"""
-		self.food_info['ingredients'] = self.food_info['ingredients'].replace('+++', ',')
-		return self.food_info['ingredients'].split(',')[0]
+		if self.food_info.get('first_ingredient') is not None:
+			return self.food_info['first_ingredient']
+		return first_ingredient(self.food_info['ingredients'])
 	
 	def set_food_info(self, nutrition, value):
 		"""
@@ -207,8 +323,9 @@ class Food(object):
 		#setattr(self, nutrition, value)
 
 	def get_nut_rule(self):
-		cat_key = FoodCat.objects.values_list('pk', flat=True).get(load_cat=self.food_cat)
-		return NutRule.objects.filter(food_cat_id_id=cat_key).values()[0]
+		if self.nut_rule is None:
+			raise KeyError(self.food_cat)
+		return self.nut_rule
 
 	def wellness_logic(self):
 		'''
@@ -216,47 +333,124 @@ class Food(object):
 		'''
 		nut_rule = self.get_nut_rule()
 		self.food_info['category'] = str(self.food_cat)
+		self.wellness = nut_rule.score(self.food_info, self.food_cat)
 
-		#ISSUE: Refactor this into multiple, more modular functions because this makes me sad
-		if nut_rule['rule_type'] == 'contains':
-			if nut_rule['value'].lower() in self.food_info[nut_rule['nutritional_field']].lower():
-				self.wellness = nut_rule['wellness']
-			else:
-				self.wellness = abs(nut_rule['wellness'] - 1)
-		elif nut_rule['rule_type'] == 'lte':
-			if float(self.food_info[nut_rule['nutritional_field']]) <= float(nut_rule['value']):
-				self.wellness = nut_rule['wellness']
-			else:
-				self.wellness = abs(nut_rule['wellness'] - 1)
-		elif nut_rule['rule_type'] == 'first_item':
-			if nut_rule['value'].lower() in self.main_ingredient:
-				self.wellness = nut_rule['wellness']
-			else:
-				self.wellness = abs(nut_rule['wellness'] - 1)
-		else:
-			self.wellness = 0 #ISSUE: update data model to support 'Unknown' or 'None' choice
-
-		upc_key = UPC.objects.values_list('pk',flat=True).get(upc_code=self.upc_code)
-		obj = WellScore(upc_id_id=upc_key, nut_id_id=nut_rule['id'],wellness=self.wellness) 
-		obj.save()
+		obj = WellScore(upc_id_id=self.upc_pk, nut_id_id=nut_rule.id,wellness=self.wellness) 
+		record([obj])
 
 		return self.wellness
 		
 	def run(self):
-		if self.check_wellness():
+		if self.gtin is None:
+			return None, {'error': INVALID_UPC}, None
+		with timed('check_wellness'):
 			wellness = self.check_wellness()
-			self.food_info = UPC.objects.filter(upc_code=self.upc_code).values()[0]
-			return self.food_info, {'success': 'Wellness Score already calculated.'}, wellness[0]['wellness']
+		if wellness is not None:
+			return self.food_info, {'success': 'Wellness Score already calculated.'}, wellness
 		else:
-			self.get_food_item()
+			with timed('get_food_item'):
+				self.get_food_item()
 			try:
-				self.wellness = self.wellness_logic()
+				with timed('wellness_logic'):
+					self.wellness = self.wellness_logic()
 				# self.convert_dict_to_attributes() 
 				#I am not sure it's the best idea to convert the dict to attributes because it makes applying the logic more verbose, but I am also not good at classes
 				return self.food_info, self.api_response, self.wellness
-			except (KeyError,TypeError) as e:
+			except (KeyError,TypeError,AttributeError,ValueError) as e:
 				return self.food_info, self.api_response, None
 
+
+def batch_lookup(upc_code, food_cat, api_key, api_id):
+	'''
+	Runs in batch_lookups: a Food lookup for a UPC a batch hasn't seen. Closes its database connection, which no request cycle will.
+	'''
+	try:
+		return Food(upc_code, food_cat, api_key, api_id)
+	finally:
+		connection.close()
+
+
+def resolve_batch(items, api_key, api_id):
+	'''
+	Scores a whole batch of (upc_code, food_cat) pairs, e.g. a pallet at warehouse intake. Codes are matched by GTIN, and ones that aren't valid barcodes get an error without any lookup.
+
+	The UPC and CurrentWellScore rows for the whole batch are loaded with one query each, categories and rules come from the compiled rule engine, new wellness scores are written in one go, and only UPCs we have never seen fall back to a Food lookup against the APIs.
+	Those lookups run in parallel (and share upstream fetches with scans of the same UPC, see coalesce.py); ones still going after BATCH_SCAN_DEADLINE answer LOOKUP_TIMED_OUT and finish in the background.
+	Returns one (food_info, api_response, wellness, upc_pk, food_cat_pk) tuple per item, in the order given.
+	'''
+	gtins = dict((upc_code, canonical(upc_code)) for upc_code, food_cat in items)
+	food_cats = set(food_cat for upc_code, food_cat in items)
+
+	upcs = {}
+	for row in UPC.objects.filter(gtin__in=set(gtin for gtin in gtins.values() if gtin)).values():
+		upcs[row['gtin']] = row
+
+	cat_keys = dict((food_cat, engine.food_cat_pk(food_cat)) for food_cat in food_cats)
+	rules = dict((food_cat, engine.rule_for(food_cat)) for food_cat in food_cats)
+
+	scores = {}
+	score_rows = CurrentWellScore.objects.filter(upc_id_id__in=[row['id'] for row in upcs.values()], nut_id_id__in=[rule.id for rule in rules.values() if rule]).exclude(wellness=None).values_list('upc_id_id', 'nut_id_id', 'wellness')
+	for upc_id, nut_id, wellness in score_rows:
+		scores[(upc_id, nut_id)] = wellness
+
+	# never seen these; go through the APIs, all at once (scored for the first category each comes with, the rest are scored below)
+	lookups = {}
+	for upc_code, food_cat in items:
+		gtin = gtins[upc_code]
+		if gtin is not None and gtin not in upcs and gtin not in lookups:
+			lookups[gtin] = batch_lookups.submit(batch_lookup, upc_code, food_cat, api_key, api_id)
+	if lookups:
+		wait(lookups.values(), timeout=BATCH_SCAN_DEADLINE)
+
+	results = []
+	new_scores = []
+	for upc_code, food_cat in items:
+		gtin = gtins[upc_code]
+		cat_key = cat_keys[food_cat]
+		nut_rule = rules[food_cat]
+		if gtin is None:
+			results.append((None, {'error': INVALID_UPC}, None, None, cat_key))
+			continue
+
+		food_info = upcs.get(gtin)
+
+		if food_info is None:
+			lookup = lookups[gtin]
+			if not lookup.done():
+				lookup.cancel()
+				results.append((None, {'error': LOOKUP_TIMED_OUT}, None, None, cat_key))
+				continue
+			item = lookup.result()
+			upc_pk = item.upc_pk
+			if upc_pk is not None:
+				upcs[gtin] = UPC.objects.filter(pk=upc_pk).values()[0]
+				if nut_rule and item.wellness is not None:
+					scores[(upc_pk, nut_rule.id)] = item.wellness
+			results.append((item.food_info, item.api_response, item.wellness, upc_pk, cat_key))
+			continue
+
+		food_info = dict(food_info)
+		upc_pk = food_info['id']
+		if nut_rule and (upc_pk, nut_rule.id) in scores:
+			wellness = scores[(upc_pk, nut_rule.id)]
+			api_response = {'success': 'Wellness Score already calculated.'}
+		else:
+			api_response = {'success' : 'Already in database'}
+			food_info['category'] = str(food_cat)
+			try:
+				wellness = nut_rule.score(food_info, food_cat) if nut_rule else None
+			except (KeyError, TypeError, AttributeError, ValueError):
+				wellness = None
+			if wellness is not None:
+				scores[(upc_pk, nut_rule.id)] = wellness
+				new_scores.append(WellScore(upc_id_id=upc_pk, nut_id_id=nut_rule.id, wellness=wellness))
+
+		results.append((food_info, api_response, wellness, upc_pk, cat_key))
+
+	record(new_scores)
+
+	return results
+
 if __name__ == '__main__':
 	
 	#ISSUE: ad hoc testing be here; let's make formal tests ^__^__^
@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
 import os
+import tempfile
 import dj_database_url
 from django.utils.crypto import get_random_string
 
@@ -45,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    'cafb_scan_api.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -103,6 +105,140 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Caches
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+# Scan results are cached per (upc, food_cat, rule version) in the 'wellness' cache. It is
+# process-local by default; set WELLNESS_CACHE_BACKEND / WELLNESS_CACHE_LOCATION to share it
+# between workers (e.g. django.core.cache.backends.memcached.PyLibMCCache). The rule version is
+# kept in the database, and each process reads it at most every RULE_VERSION_TTL seconds, so rule
+# and score changes reach every worker either way. An edit to one product can only be forgotten
+# in every worker's cache if it's shared; otherwise it moves the rule version on too.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'wellness': {
+        'BACKEND': os.environ.get('WELLNESS_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('WELLNESS_CACHE_LOCATION', 'wellness'),
+    },
+}
+if CACHES['wellness']['BACKEND'].endswith('LocMemCache'):
+    CACHES['wellness']['OPTIONS'] = {'MAX_ENTRIES': 10000}
+
+WELLNESS_CACHE = 'wellness'
+WELLNESS_CACHE_SHARED = not CACHES['wellness']['BACKEND'].endswith('LocMemCache')
+RULE_VERSION_TTL = 2.0
+WELLNESS_CACHE_TTL = 60 * 60 * 24
+WELLNESS_UNKNOWN_TTL = 60 * 15
+
+# Workers
+# gunicorn.conf.py runs sync workers unless GUNICORN_WORKER_CLASS=gevent. Gevent workers serve
+# each request in a greenlet, so scans waiting on OFF/Nutritionix don't hold up cache hits.
+# Django keeps a database connection per greenlet, so persistent connections are turned off
+# there (every request closes its own); keep WEB_CONCURRENCY * GUNICORN_WORKER_CONNECTIONS
+# under what the database allows.
+
+ASYNC_WORKERS = os.environ.get('GUNICORN_WORKER_CLASS', 'sync') == 'gevent'
+
+# Upstream nutrition APIs
+# OFF and Nutritionix are asked in parallel; each gets its own timeout (seconds) and the
+# whole lookup gives up after UPSTREAM_DEADLINE. UPSTREAM_WORKERS lookups run at once per
+# worker (more under gevent, where they're greenlets). The URLs can be pointed at stubs.
+
+OFF_URL = os.environ.get('OFF_URL', 'http://world.openfoodfacts.org/api/v0/product/{upc}.json')
+NUTRITIONIX_URL = os.environ.get('NUTRITIONIX_URL', 'https://api.nutritionix.com/v1_1/item?upc={upc}&appId={apiID}&appKey={apiKey}')
+UPSTREAM_TIMEOUTS = {'OFF': 2.0, 'Nutrionix': 3.0}
+UPSTREAM_DEADLINE = 3.0
+UPSTREAM_WORKERS = 100 if ASYNC_WORKERS else 8
+
+# Nutritionix calls take a token from a daily quota shared by every worker (see quota.py): through
+# the wellness cache when it's shared, else through the database. BURST of the day's calls are
+# there from midnight UTC and the rest fill in over the day; background jobs leave RESERVE for scans.
+# A token is one call: Nutritionix calls aren't retried, unlike the other upstream calls below.
+# Scans only ask Nutritionix alongside OFF while more than HEDGE_ABOVE calls are left, else after OFF misses.
+
+NUTRITIONIX_DAILY_QUOTA = int(os.environ.get('NUTRITIONIX_DAILY_QUOTA', 50))
+NUTRITIONIX_QUOTA_BURST = NUTRITIONIX_DAILY_QUOTA // 4
+NUTRITIONIX_QUOTA_RESERVE = NUTRITIONIX_DAILY_QUOTA // 10
+NUTRITIONIX_HEDGE_ABOVE = NUTRITIONIX_DAILY_QUOTA // 10
+
+# Each upstream host gets a pooled keep-alive session. 429s and 5xxs are retried with
+# exponential backoff, and a host that keeps failing is skipped for a cooldown period.
+UPSTREAM_POOL_SIZE = 10
+UPSTREAM_RETRIES = 2
+UPSTREAM_BACKOFF = 0.1
+UPSTREAM_BREAKER_THRESHOLD = 5
+UPSTREAM_BREAKER_COOLDOWN = 30.0
+
+# Batch scans
+# /scan/batch/ takes at most BATCH_SCAN_MAX items. UPCs it hasn't seen are looked up
+# BATCH_SCAN_LOOKUPS at a time, and after BATCH_SCAN_DEADLINE seconds the rest are answered
+# "scan again" (their lookups finish in the background), so a batch stays well inside GUNICORN_TIMEOUT.
+
+BATCH_SCAN_MAX = 200
+BATCH_SCAN_LOOKUPS = 8
+BATCH_SCAN_DEADLINE = 10.0
+
+# Scan logging
+# Scan rows are queued in each worker and written in bulk every SCAN_LOG_FLUSH_SIZE scans or
+# SCAN_LOG_FLUSH_INTERVAL seconds. Past SCAN_LOG_MAX_QUEUE waiting scans, requests write their
+# own. Set SCAN_LOG_ASYNC = False to always write synchronously.
+
+SCAN_LOG_ASYNC = True
+SCAN_LOG_FLUSH_SIZE = 100
+SCAN_LOG_FLUSH_INTERVAL = 1.0
+SCAN_LOG_MAX_QUEUE = 5000
+
+# Scan tracker
+# Written scans are counted into hourly/daily rollups as they go (turn off with SCAN_ROLLUP_LIVE
+# and run manage.py rollup_scans instead). Rendered charts are cached for SCAN_TRACKER_TTL seconds.
+
+SCAN_ROLLUP_LIVE = True
+SCAN_TRACKER_TTL = 60
+
+# Metrics
+# Request and per-stage latencies are served at /metrics (Prometheus text) and sent back in a
+# Server-Timing header. METRICS_SQL counts and times SQL queries per request (without keeping
+# their text, unlike DEBUG's query log).
+
+METRICS_SQL = True
+METRICS_SERVER_TIMING = True
+
+# Catalogue
+# Scored products are also kept in a memory-mapped catalogue (manage.py build_catalog, rebuilt by
+# update_well_score) that scans read before the database. Workers pick up a new build within
+# CATALOG_CHECK_INTERVAL seconds. Edits made after a build only reach the other workers through the
+# wellness cache (cache.invalidate_upc), so the catalogue is off unless that cache is shared or
+# there's a single worker; CATALOG_ENABLED=1 / 0 in the environment overrides that.
+
+CATALOG_ENABLED = os.environ.get('CATALOG_ENABLED', '1' if WELLNESS_CACHE_SHARED or os.environ.get('WEB_CONCURRENCY') == '1' else '0') == '1'
+CATALOG_DIR = os.environ.get('CATALOG_DIR', os.path.join(tempfile.gettempdir(), 'cafb_catalog'))
+CATALOG_CHECK_INTERVAL = 30
+
+# Offline catalog snapshots
+# /scan/snapshot/ is built SNAPSHOT_CHUNK_SIZE products at a time. Full snapshots are kept in
+# SNAPSHOT_DIR (one file, the latest version); deltas reach SNAPSHOT_OVERLAP seconds further back.
+
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'cafb_snapshots'))
+SNAPSHOT_CHUNK_SIZE = 500
+SNAPSHOT_OVERLAP = 60
+
+# Wellness score history
+# Scans read CurrentWellScore; WellScore keeps the history. manage.py archive_scores moves old
+# history into gzipped files in SCORE_ARCHIVE_DIR, one per chunk of days, and deletes it from the
+# table. Those files are the only copy, so there's no default: point it at durable storage (a
+# mounted volume, say). It can't be under BASE_DIR, which Heroku throws away with the dyno.
+
+SCORE_ARCHIVE_DIR = os.environ.get('SCORE_ARCHIVE_DIR')
+
+# Exports
+# /export/scan.csv, /export/upc.ndjson, ... stream a table EXPORT_CHUNK_SIZE rows at a time (see
+# export.py). A sync worker can't check in with gunicorn while it streams, so long exports need the
+# gevent workers or a GUNICORN_TIMEOUT longer than they take.
+
+EXPORT_CHUNK_SIZE = 2000
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.9/topics/i18n/
 
@@ -113,9 +249,14 @@ USE_L10N = True
 USE_TZ = True
 
 # Update database configuration with $DATABASE_URL.
-db_from_env = dj_database_url.config(conn_max_age=500)
+db_from_env = dj_database_url.config(conn_max_age=0 if ASYNC_WORKERS else 500)
 DATABASES['default'].update(db_from_env)
 
+# SQLite tests get a file rather than the usual in-memory database, which on Python 2 each connection (so each
+# thread) would have its own copy of; the concurrency tests scan from several threads at once
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default']['TEST'] = {'NAME': os.path.join(tempfile.gettempdir(), 'cafb_scan_api_test.sqlite3')}
+
 # Honor the 'X-Forwarded-Proto' header for request.is_secure()
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
@@ -144,5 +285,7 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticatedOrReadOnly'
     ],
+    # newest first, ?cursor= paging on created (see pagination.py); ?page_size= goes up to 1000
+    'DEFAULT_PAGINATION_CLASS': 'cafb_scan_api.pagination.CreatedCursorPagination',
     'PAGE_SIZE': 10
 }
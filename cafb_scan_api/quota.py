@@ -0,0 +1,153 @@
+'''
+Nutritionix has a hard daily call quota, so every call takes a token from a bucket shared by all the workers.
+The bucket lives in the wellness cache, like the lookup locks in coalesce.py, when that cache is shared between workers (memcached, say; see WELLNESS_CACHE_SHARED).
+A process-local cache would give every worker the whole quota, so otherwise the bucket is a Counter row per day in the database, taken from under a row lock.
+
+The bucket fills over the (UTC) day: t seconds into it, min(quota, burst + quota * t / day) calls are allowed so far, so a busy morning can't spend the whole day's quota.
+Callers have a priority. INTERACTIVE (scans) may use the whole bucket; BACKGROUND (jobs that can wait) must leave `reserve` tokens in it for scans, and should defer for retry_after(BACKGROUND) seconds when refused.
+A token is one HTTP call, so calls to a host with a quota mustn't be retried (see upstream.fetch_nutrionix).
+A scan that is refused just doesn't ask Nutritionix. If OFF doesn't know the product either, the scan is told to try again, and that answer isn't cached (cache.py), since Nutritionix might know it.
+The clock and cache can be passed in, for testing.
+'''
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+import time
+
+from cafb_scan_api.models import Counter
+from cafb_scan_api import metrics
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+DAY = 24 * 60 * 60
+
+
+class QuotaExceeded(Exception):
+	pass
+
+
+class Quota(object):
+
+	def __init__(self, name, quota, burst=None, reserve=0, cache=None, clock=time.time):
+		self.name = name
+		self.quota = quota
+		self.burst = quota if burst is None else burst
+		self.reserve = reserve
+		self._cache = cache
+		self.clock = clock
+
+	@property
+	def cache(self):
+		'''
+		The cache the bucket is kept in, or None to keep it in the database.
+		'''
+		if self._cache is not None:
+			return self._cache
+		if getattr(settings, 'WELLNESS_CACHE_SHARED', False):
+			return caches[getattr(settings, 'WELLNESS_CACHE', 'default')]
+		return None
+
+	def day(self, now):
+		return int(now // DAY)
+
+	def key(self, now):
+		return 'quota:%s:%d' % (self.name, self.day(now))
+
+	def allowance(self, now):
+		'''
+		Calls allowed so far today.
+		'''
+		return min(self.quota, int(self.burst + self.quota * (now % DAY) / DAY))
+
+	def limit(self, priority, now):
+		return self.allowance(now) - (self.reserve if priority == BACKGROUND else 0)
+
+	def used(self, now=None):
+		now = self.clock() if now is None else now
+		cache = self.cache
+		if cache is None:
+			return Counter.objects.filter(name=self.key(now)).values_list('value', flat=True).first() or 0
+		return cache.get(self.key(now)) or 0
+
+	def available(self, priority=INTERACTIVE):
+		'''
+		Tokens a call of this priority could take right now.
+		'''
+		now = self.clock()
+		return max(0, self.limit(priority, now) - self.used(now))
+
+	def take(self, now, limit):
+		'''
+		Adds one to today's count unless it's at limit already. Returns whether it did.
+		'''
+		key = self.key(now)
+		cache = self.cache
+		if cache is None:
+			with transaction.atomic():
+				counter, created = Counter.objects.select_for_update().get_or_create(name=key)
+				if created:
+					# a new day; a clock a little behind may still want yesterday's
+					old = [name for name in Counter.objects.filter(name__startswith='quota:%s:' % self.name).values_list('name', flat=True) if int(name.rsplit(':', 1)[1]) < self.day(now) - 1]
+					Counter.objects.filter(name__in=old).delete()
+				if counter.value >= limit:
+					return False
+				Counter.objects.filter(pk=counter.pk).update(value=F('value') + 1)
+				return True
+
+		# kept past the end of the day so a clock a little behind still finds it
+		cache.add(key, 0, 2 * DAY)
+		try:
+			used = cache.incr(key)
+		except ValueError:
+			# evicted in between
+			cache.set(key, 1, 2 * DAY)
+			used = 1
+		if used > limit:
+			cache.decr(key)
+			return False
+		return True
+
+	def acquire(self, priority=INTERACTIVE):
+		'''
+		Takes a token for one call. Returns False, and takes nothing, if there isn't one for this priority.
+		'''
+		now = self.clock()
+		if not self.take(now, self.limit(priority, now)):
+			metrics.inc('cafb_quota_calls_total', quota=self.name, priority=priority, outcome='denied')
+			return False
+		metrics.inc('cafb_quota_calls_total', quota=self.name, priority=priority, outcome='granted')
+		return True
+
+	def retry_after(self, priority=INTERACTIVE):
+		'''
+		Seconds until a call of this priority could get a token; the start of the next day if today's quota can't cover it.
+		'''
+		now = self.clock()
+		needed = self.used(now) + 1 + (self.reserve if priority == BACKGROUND else 0)
+		if needed <= self.allowance(now):
+			return 0
+		day_start = now - now % DAY
+		if needed > self.quota:
+			return day_start + DAY - now
+		# when burst + quota * t / DAY reaches needed
+		return max(0, day_start + (needed - self.burst) * DAY / float(self.quota) - now)
+
+	def status(self):
+		now = self.clock()
+		used = self.used(now)
+		return {
+			'quota': self.quota,
+			'used': used,
+			'remaining': max(0, self.quota - used),
+			'available': dict((priority, max(0, self.limit(priority, now) - used)) for priority in (INTERACTIVE, BACKGROUND)),
+		}
+
+
+nutritionix = Quota(
+	'nutritionix',
+	getattr(settings, 'NUTRITIONIX_DAILY_QUOTA', 50),
+	getattr(settings, 'NUTRITIONIX_QUOTA_BURST', None),
+	getattr(settings, 'NUTRITIONIX_QUOTA_RESERVE', 0),
+)
@@ -0,0 +1,89 @@
+from collections import Counter
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from cafb_scan_api.models import Scan, ScanRollup, UPC
+from cafb_scan_api.rules import engine
+
+PERIODS = ('hour', 'day')
+
+
+def wellness_label(wellness):
+	if wellness is None:
+		return 'unknown'
+	return 'wellness' if wellness else 'not wellness'
+
+
+def bucket(created, period):
+	'''
+	Start of the (local time) hour or day a scan falls in.
+	'''
+	local = timezone.localtime(created).replace(tzinfo=None)
+	if period == 'hour':
+		local = local.replace(minute=0, second=0, microsecond=0)
+	else:
+		local = local.replace(hour=0, minute=0, second=0, microsecond=0)
+	return timezone.make_aware(local, timezone.get_current_timezone())
+
+
+def count(rows):
+	'''
+	Counts (created, scan_status, load_cat, data_source, wellness) rows into rollup buckets.
+	'''
+	counts = Counter()
+	for created, scan_status, load_cat, data_source, wellness in rows:
+		for period in PERIODS:
+			counts[(period, bucket(created, period), scan_status or '', load_cat or '', data_source or '', wellness_label(wellness))] += 1
+	return counts
+
+
+def add(counts):
+	'''
+	Adds counts to the rollup tables, creating rows for new buckets.
+	'''
+	for (period, start, scan_status, load_cat, data_source, wellness), total in counts.items():
+		key = dict(period=period, bucket=start, scan_status=scan_status, food_cat=load_cat, data_source=data_source, wellness=wellness)
+		if ScanRollup.objects.filter(**key).update(total=F('total') + total):
+			continue
+		try:
+			with transaction.atomic():
+				ScanRollup.objects.create(total=total, **key)
+		except IntegrityError:
+			# someone else created the bucket in the meantime
+			ScanRollup.objects.filter(**key).update(total=F('total') + total)
+
+
+def add_scans(scans):
+	'''
+	Rolls up Scan objects that have just been written.
+	'''
+	load_cats = dict((pk, load_cat) for load_cat, pk in engine.categories.items())
+	upc_ids = set(scan.upc_id_id for scan in scans if scan.upc_id_id is not None)
+	sources = dict(UPC.objects.filter(pk__in=upc_ids).values_list('pk', 'data_source')) if upc_ids else {}
+
+	add(count(
+		(scan.created, scan.scan_status, load_cats.get(scan.food_cat_id_id), sources.get(scan.upc_id_id), scan.wellness)
+		for scan in scans
+	))
+
+
+def rebuild(since=None):
+	'''
+	Recounts the rollups from the Scan table, from the start of the day `since` falls in (or from the beginning).
+	Returns the number of scans counted.
+	'''
+	scans = Scan.objects.order_by()
+	rollups = ScanRollup.objects.all()
+	if since is not None:
+		start = bucket(since, 'day')
+		scans = scans.filter(created__gte=start)
+		rollups = rollups.filter(bucket__gte=start)
+
+	rows = scans.values_list('created', 'scan_status', 'food_cat_id__load_cat', 'upc_id__data_source', 'wellness').iterator()
+	with transaction.atomic():
+		rollups.delete()
+		counts = count(rows)
+		add(counts)
+
+	return sum(total for key, total in counts.items() if key[0] == 'day')
@@ -0,0 +1,193 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+import hashlib
+import threading
+import time
+from cafb_scan_api.models import FoodCat, NutRule, Counter
+from cafb_scan_api.ingredients import first_ingredient, normalize
+
+# NutRule.nutritional_field values that don't match the UPC column (or API key) they refer to
+FIELD_COLUMNS = {'sugar': 'sugars', 'name': 'item_name'}
+# the Counter row holding the rule version, and how many seconds a process trusts the value it last read
+VERSION_COUNTER = 'rule_version'
+VERSION_TTL = getattr(settings, 'RULE_VERSION_TTL', 2.0)
+
+
+class CompiledRule(object):
+	'''
+	A NutRule compiled down to a predicate, with its value already lowercased or cast to float.
+	'''
+
+	def __init__(self, nut_rule):
+		self.id = nut_rule['id']
+		self.load_cat = nut_rule['food_cat_id__load_cat']
+		self.rule_type = nut_rule['rule_type']
+		self.field = FIELD_COLUMNS.get(nut_rule['nutritional_field'], nut_rule['nutritional_field'])
+		self.wellness = int(bool(nut_rule['wellness']))
+		self.value = nut_rule['value']
+
+		self.predicate = None #ISSUE: update data model to support 'Unknown' or 'None' choice
+		if self.rule_type == 'contains':
+			self.value = (self.value or '').lower()
+			self.predicate = self.contains
+		elif self.rule_type == 'first_item':
+			self.value = normalize(self.value or '')
+			self.predicate = self.first_item
+		elif self.rule_type == 'lte':
+			try:
+				self.value = float(self.value)
+				self.predicate = self.lte
+			except (TypeError, ValueError):
+				pass
+
+	def field_value(self, food_info, food_cat):
+		if self.field == 'category':
+			return str(food_cat)
+		return food_info[self.field]
+
+	def contains(self, food_info, food_cat):
+		return self.value in self.field_value(food_info, food_cat).lower()
+
+	def first_item(self, food_info, food_cat):
+		# UPC rows come with it parsed already; fresh API answers don't
+		first = food_info.get('first_ingredient')
+		if first is None:
+			first = first_ingredient(food_info['ingredients'])
+		return self.value in first
+
+	def lte(self, food_info, food_cat):
+		return float(self.field_value(food_info, food_cat)) <= self.value
+
+	def score(self, food_info, food_cat):
+		'''
+		Returns the wellness score for the food. Raises KeyError/TypeError/AttributeError if the food is missing the info the rule needs.
+		'''
+		if self.predicate is None:
+			return 0
+		return self.wellness if self.predicate(food_info, food_cat) else abs(self.wellness - 1)
+
+
+def fingerprint(rules):
+	'''
+	A hash of what every compiled rule does, so things built from one set of rules (like the catalogue) can tell when the rules have changed.
+	'''
+	signature = sorted((load_cat, rule.id, rule.rule_type, rule.field, rule.value, rule.wellness) for load_cat, rule in rules.items())
+	return hashlib.sha1(repr(signature)).hexdigest()
+
+
+class RuleEngine(object):
+	'''
+	Loads every NutRule once, compiles them, and indexes them by FoodCat.load_cat so scoring a product needs no database access.
+	It also keeps the FoodCat.load_cat -> pk map, so the scan path doesn't have to look categories up either.
+	Call bump() whenever a rule, category or score changes. It moves the rule version on in the database, so every process (gunicorn workers, management commands) rebuilds its index within VERSION_TTL seconds.
+	'''
+
+	def __init__(self):
+		self._rules = None
+		self._categories = None
+		self._fingerprint = None
+		self._lock = threading.Lock()
+		self._version = None
+		self._version_read = 0
+
+	def sync(self):
+		'''
+		Reads the rule version from the database, at most every VERSION_TTL seconds, and drops the index if it has moved on. Returns the version.
+		'''
+		if time.time() - self._version_read >= VERSION_TTL:
+			version = Counter.objects.filter(name=VERSION_COUNTER).values_list('value', flat=True).first() or 0
+			if version != self._version:
+				self.invalidate()
+				self._version = version
+			self._version_read = time.time()
+		return self._version
+
+	@property
+	def version(self):
+		return self.sync()
+
+	def bump(self):
+		'''
+		Moves the rule version on for every process, and drops this one's index now.
+		The first one starts from the clock rather than 1, so a database that's been reset can't hand out a version cached answers are already keyed on.
+		'''
+		if not Counter.objects.filter(name=VERSION_COUNTER).update(value=F('value') + 1):
+			try:
+				with transaction.atomic():
+					Counter.objects.create(name=VERSION_COUNTER, value=int(time.time() * 1000))
+			except IntegrityError:
+				# another process got there first
+				Counter.objects.filter(name=VERSION_COUNTER).update(value=F('value') + 1)
+		self._version_read = 0
+		self.invalidate()
+
+	def load(self):
+		rules = {}
+		rows = NutRule.objects.values('id', 'food_cat_id__load_cat', 'nutritional_field', 'rule_type', 'value', 'wellness')
+		for row in rows:
+			# first rule per category wins, same as Food.get_nut_rule always did
+			if row['food_cat_id__load_cat'] is not None and row['food_cat_id__load_cat'] not in rules:
+				rules[row['food_cat_id__load_cat']] = CompiledRule(row)
+		return rules
+
+	@property
+	def rules(self):
+		self.sync()
+		rules = self._rules
+		if rules is None:
+			with self._lock:
+				if self._rules is None:
+					self._rules = self.load()
+				rules = self._rules
+		return rules
+
+	@property
+	def categories(self):
+		self.sync()
+		categories = self._categories
+		if categories is None:
+			with self._lock:
+				if self._categories is None:
+					self._categories = dict(FoodCat.objects.exclude(load_cat=None).values_list('load_cat', 'pk'))
+				categories = self._categories
+		return categories
+
+	@property
+	def fingerprint(self):
+		rules = self.rules
+		if self._fingerprint is None or self._fingerprint[0] is not rules:
+			self._fingerprint = (rules, fingerprint(rules))
+		return self._fingerprint[1]
+
+	def invalidate(self):
+		self._rules = None
+		self._categories = None
+
+	def warm(self):
+		'''
+		Reloads the rules and categories now, rather than on the next scan.
+		'''
+		self.invalidate()
+		return self.rules, self.categories
+
+	def food_cat_pk(self, food_cat):
+		'''
+		Returns the FoodCat pk for a load_cat, or None if there is no such category.
+		'''
+		return self.categories.get(None if food_cat is None else str(food_cat))
+
+	def rule_for(self, food_cat):
+		'''
+		Returns the compiled rule for a food category, or None if it has no rule.
+		'''
+		return self.rules.get(None if food_cat is None else str(food_cat))
+
+	def score(self, food_info, food_cat):
+		rule = self.rule_for(food_cat)
+		if rule is None:
+			raise KeyError(food_cat)
+		return rule.score(food_info, food_cat)
+
+
+engine = RuleEngine()
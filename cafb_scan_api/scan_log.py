@@ -0,0 +1,147 @@
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+import atexit
+import os
+import threading
+
+from cafb_scan_api.models import Scan
+from cafb_scan_api import rollups
+from cafb_scan_api.metrics import timed
+
+
+class ScanRecorder(object):
+	'''
+	Write-behind logging for Scan rows, so recording a scan doesn't hold up the response.
+
+	Scans are queued in process and a background thread writes them with bulk_create once flush_size are waiting or every flush_interval seconds, whichever comes first. What's left is flushed when the worker exits.
+	If the queue ever holds max_queue scans (the database can't keep up), new scans are written synchronously by the request that made them, which slows intake down to what the database can take.
+	With async_writes off, every scan is written synchronously, like before.
+	Written scans are added to the scan tracker rollups too, unless live_rollups is off.
+	'''
+
+	def __init__(self, async_writes=True, flush_size=100, flush_interval=1.0, max_queue=5000, live_rollups=True):
+		self.async_writes = async_writes
+		self.live_rollups = live_rollups
+		self.flush_size = flush_size
+		self.flush_interval = flush_interval
+		self.max_queue = max_queue
+		self.queue = []
+		self.cond = threading.Condition()
+		self.thread = None
+		self.pid = None
+		self.stopping = False
+		self.counts = {'queued': 0, 'written': 0, 'sync_writes': 0, 'dropped': 0}
+
+	def record(self, *scans):
+		if not self.async_writes:
+			return self.write(scans, sync=True)
+
+		self.start()
+		with self.cond:
+			if len(self.queue) + len(scans) <= self.max_queue:
+				self.queue.extend(scans)
+				self.counts['queued'] += len(scans)
+				if len(self.queue) >= self.flush_size:
+					self.cond.notify()
+				return
+
+		# queue is full: backpressure, this request pays for its own insert
+		self.write(scans, sync=True)
+
+	def start(self):
+		# (re)start the flusher in each worker process, since threads don't survive a fork
+		if self.pid != os.getpid() or not self.thread.is_alive():
+			with self.cond:
+				if self.pid != os.getpid() or not self.thread.is_alive():
+					if self.pid != os.getpid():
+						self.queue = []
+					self.pid = os.getpid()
+					self.thread = threading.Thread(target=self.run, name='scan-recorder')
+					self.thread.daemon = True
+					self.thread.start()
+
+	def run(self):
+		while True:
+			with self.cond:
+				if len(self.queue) < self.flush_size and not self.stopping:
+					self.cond.wait(self.flush_interval)
+				batch, self.queue = self.queue, []
+				stopping = self.stopping
+			try:
+				if batch:
+					self.write(batch)
+				close_old_connections()
+			except Exception:
+				# keep the flusher alive whatever happens
+				self.count('dropped', len(batch))
+			if stopping:
+				return
+
+	def write(self, scans, sync=False):
+		'''
+		Bulk inserts scans; if that fails, tries them one at a time and counts the ones that still fail as dropped.
+		'''
+		scans = list(scans)
+		if sync:
+			self.count('sync_writes', len(scans))
+		try:
+			with timed('scan_insert'):
+				Scan.objects.bulk_create(scans)
+			written = scans
+		except DatabaseError:
+			written = []
+			for scan in scans:
+				try:
+					scan.save()
+					written.append(scan)
+				except DatabaseError:
+					self.count('dropped')
+		self.count('written', len(written))
+
+		if self.live_rollups and written:
+			try:
+				rollups.add_scans(written)
+			except DatabaseError:
+				# the scans are safe; manage.py rollup_scans will catch the rollups up
+				pass
+
+	def count(self, name, amount=1):
+		# requests write for themselves under backpressure, so these can come from any thread
+		with self.cond:
+			self.counts[name] += amount
+
+	def flush(self):
+		'''
+		Writes everything still queued, right now.
+		'''
+		with self.cond:
+			batch, self.queue = self.queue, []
+		if batch:
+			self.write(batch)
+
+	def stop(self):
+		'''
+		Writes everything still queued and ends the flusher thread; the next record() starts another.
+		'''
+		if self.pid != os.getpid() or not self.thread.is_alive():
+			return
+		with self.cond:
+			self.stopping = True
+			self.cond.notify()
+		self.thread.join()
+		self.stopping = False
+
+	def stats(self):
+		return dict(self.counts, pending=len(self.queue))
+
+
+recorder = ScanRecorder(
+	async_writes=getattr(settings, 'SCAN_LOG_ASYNC', True),
+	flush_size=getattr(settings, 'SCAN_LOG_FLUSH_SIZE', 100),
+	flush_interval=getattr(settings, 'SCAN_LOG_FLUSH_INTERVAL', 1.0),
+	max_queue=getattr(settings, 'SCAN_LOG_MAX_QUEUE', 5000),
+	live_rollups=getattr(settings, 'SCAN_ROLLUP_LIVE', True),
+)
+
+# gunicorn workers exit through SystemExit on SIGTERM/SIGQUIT, so this runs on graceful shutdown
+atexit.register(recorder.flush)
@@ -0,0 +1,155 @@
+'''
+WellScore is the append-only history of wellness scores; CurrentWellScore has just the latest one for each (UPC, rule), which is all a scan needs.
+Write scores with record() so the two stay in step (or call sync() on scores written some other way), and resync() pairs whose history was edited or deleted.
+archive() moves old history out of the WellScore table into gzipped JSON-lines files, a chunk of time each, so the table doesn't grow forever.
+The files are all that's left of that history, so they have to go somewhere durable: not under BASE_DIR, which is thrown away with the dyno on Heroku.
+'''
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+import gzip
+import json
+import os
+import tempfile
+
+from cafb_scan_api.models import WellScore, CurrentWellScore
+
+# pairs per query; SQLite allows 999 variables in one
+CHUNK_SIZE = 400
+# no default; see archive()
+ARCHIVE_DIR = getattr(settings, 'SCORE_ARCHIVE_DIR', None)
+
+
+def record(scores):
+	'''
+	Adds scores to the history and makes them the current ones (later ones in the list win).
+	'''
+	scores = list(scores)
+	with transaction.atomic():
+		WellScore.objects.bulk_create(scores)
+		sync(scores)
+
+
+def sync(scores):
+	latest = {}
+	for score in scores:
+		if score.nut_id_id is not None:
+			latest[(score.upc_id_id, score.nut_id_id)] = score.wellness
+	set_current(latest)
+
+
+def set_current(latest):
+	'''
+	Makes {(upc_id, nut_id): wellness} the current scores. Rows that already have that score are left alone, so their updated time only moves on a real change.
+	'''
+	now = timezone.now()
+	pairs = sorted(latest)
+	for i in range(0, len(pairs), CHUNK_SIZE):
+		chunk = pairs[i:i + CHUNK_SIZE]
+		rows = CurrentWellScore.objects.filter(upc_id__in=set(upc_id for upc_id, nut_id in chunk), nut_id__in=set(nut_id for upc_id, nut_id in chunk)).values_list('pk', 'upc_id', 'nut_id', 'wellness')
+		existing = dict(((upc_id, nut_id), (pk, wellness)) for pk, upc_id, nut_id, wellness in rows)
+
+		changed = defaultdict(list)
+		missing = []
+		for pair in chunk:
+			if pair not in existing:
+				missing.append(CurrentWellScore(upc_id_id=pair[0], nut_id_id=pair[1], wellness=latest[pair], updated=now))
+			elif existing[pair][1] != latest[pair]:
+				changed[latest[pair]].append(existing[pair][0])
+
+		for wellness, pks in changed.items():
+			CurrentWellScore.objects.filter(pk__in=pks).update(wellness=wellness, updated=now)
+		try:
+			with transaction.atomic():
+				CurrentWellScore.objects.bulk_create(missing)
+		except IntegrityError:
+			# another worker added some of them first
+			for row in missing:
+				CurrentWellScore.objects.update_or_create(upc_id_id=row.upc_id_id, nut_id_id=row.nut_id_id, defaults={'wellness': row.wellness, 'updated': now})
+
+
+def resync(pairs):
+	'''
+	Recomputes the current score for each (upc_id, nut_id) from the history, for when history rows were changed or deleted.
+	'''
+	for upc_id, nut_id in set(pairs):
+		if nut_id is None:
+			continue
+		latest = WellScore.objects.filter(upc_id_id=upc_id, nut_id_id=nut_id).order_by('-created').values_list('wellness', flat=True)[:1]
+		if latest:
+			set_current({(upc_id, nut_id): latest[0]})
+		else:
+			CurrentWellScore.objects.filter(upc_id_id=upc_id, nut_id_id=nut_id).delete()
+
+
+def archive_chunk(start, end, directory):
+	'''
+	Writes the history from [start, end) to a gzipped JSON-lines file, [id, upc_id, nut_id, wellness, created] per line, then deletes it from the table.
+	Each (UPC, rule)'s latest score is kept, so the current score always has its history row.
+	Returns (path, rows archived); path is None if there was nothing to archive.
+	'''
+	fd, partial = tempfile.mkstemp(dir=directory, suffix='.partial')
+	archived = []
+	try:
+		with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as f:
+			last = 0
+			while True:
+				rows = list(WellScore.objects.filter(created__gte=start, created__lt=end, pk__gt=last).order_by('pk').values_list('pk', 'upc_id', 'nut_id', 'wellness', 'created')[:CHUNK_SIZE])
+				if not rows:
+					break
+				last = rows[-1][0]
+				newest = WellScore.objects.filter(upc_id__in=set(row[1] for row in rows)).order_by().values_list('upc_id', 'nut_id').annotate(newest=Max('created'))
+				newest = dict(((upc_id, nut_id), created) for upc_id, nut_id, created in newest)
+				for pk, upc_id, nut_id, wellness, created in rows:
+					if newest[(upc_id, nut_id)] == created:
+						continue
+					f.write(json.dumps([pk, upc_id, nut_id, wellness, created.isoformat()]) + '\n')
+					archived.append(pk)
+
+		if not archived:
+			return None, 0
+		path = os.path.join(directory, 'wellscore-%s-%s.ndjson.gz' % (start.strftime('%Y%m%dT%H%M%S'), end.strftime('%Y%m%dT%H%M%S')))
+		n = 1
+		while os.path.exists(path):
+			# the same range archived again (rows were backdated, say); keep both
+			n += 1
+			path = os.path.join(directory, 'wellscore-%s-%s-%d.ndjson.gz' % (start.strftime('%Y%m%dT%H%M%S'), end.strftime('%Y%m%dT%H%M%S'), n))
+		os.rename(partial, path)
+	finally:
+		if os.path.exists(partial):
+			os.remove(partial)
+
+	# only once the file is safely in place
+	with transaction.atomic():
+		for i in range(0, len(archived), CHUNK_SIZE):
+			WellScore.objects.filter(pk__in=archived[i:i + CHUNK_SIZE]).delete()
+	return path, len(archived)
+
+
+def archive(before, chunk, directory):
+	'''
+	Archives the history older than before, one file per chunk of time. Returns [(path, rows archived)] for the chunks that had any.
+	Raises ValueError for a directory inside the app (BASE_DIR), where the files wouldn't outlive the next deploy.
+	'''
+	if not directory:
+		raise ValueError('No archive directory given')
+	directory, base = os.path.realpath(directory), os.path.realpath(settings.BASE_DIR)
+	if directory == base or directory.startswith(base + os.sep):
+		raise ValueError('%s is inside the app directory, which doesn\'t outlive a deploy; archive somewhere durable' % directory)
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	start = WellScore.objects.aggregate(oldest=Min('created'))['oldest']
+	if start is not None:
+		# chunks start at midnight, so the files line up run to run
+		start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+	archived = []
+	while start is not None and start < before:
+		end = min(start + chunk, before)
+		path, count = archive_chunk(start, end, directory)
+		if path is not None:
+			archived.append((path, count))
+		start = end
+	return archived
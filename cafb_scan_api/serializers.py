@@ -1,31 +1,116 @@
 from rest_framework import serializers
 from cafb_scan_api.models import UPC, Scan, FoodCat, WellScore, NutRule
+from cafb_scan_api.gtin import canonical
 
-class UPCSerializer(serializers.HyperlinkedModelSerializer):
+
+def requested_fields(request):
+	'''
+	The field names asked for with ?fields=a,b,c, or None for all of them.
+	'''
+	if request is None or not request.query_params.get('fields'):
+		return None
+	return [name.strip() for name in request.query_params['fields'].split(',') if name.strip()]
+
+
+class ProjectionMixin(object):
+	'''
+	Drops every field not named in ?fields= (unknown names are ignored).
+	'''
+	def __init__(self, *args, **kwargs):
+		super(ProjectionMixin, self).__init__(*args, **kwargs)
+		fields = requested_fields(self.context.get('request'))
+		if fields is not None:
+			for name in set(self.fields) - set(fields):
+				self.fields.pop(name)
+
+
+class UPCSerializer(ProjectionMixin, serializers.HyperlinkedModelSerializer):
 	class Meta:
 		model = UPC
-		fields = ('upc_code', 'item_name', 'brand_id', 'brand_name', 'item_image', 'item_description', 'api_last_update', 'ingredients', 'calories', 'calories_from_fat', 'total_fat', 'saturated_fat', 'cholesterol', 'sodium', 'total_carb', 'dietary_fiber', 'sugars', 'protein', 'vitamin_a_dv', 'vitamin_c_dv', 'calcium_dv', 'iron_dv', 'serving_per_cont', 'serving_size_qty', 'serving_size_unit', 'created')       
+		fields = ('upc_code', 'gtin', 'item_name', 'brand_id', 'brand_name', 'item_image', 'item_description', 'api_last_update', 'ingredients', 'calories', 'calories_from_fat', 'total_fat', 'saturated_fat', 'cholesterol', 'sodium', 'total_carb', 'dietary_fiber', 'sugars', 'protein', 'vitamin_a_dv', 'vitamin_c_dv', 'calcium_dv', 'iron_dv', 'serving_per_cont', 'serving_size_qty', 'serving_size_unit', 'created', 'updated')
+		read_only_fields = ('gtin',)
+
+	def validate_upc_code(self, value):
+		if canonical(value) is None:
+			raise serializers.ValidationError('Not a valid UPC/EAN/GTIN (bad length or check digit).')
+		return value
 
+	def validate(self, attrs):
+		# gtin follows upc_code; another spelling of a barcode we already have is the same product
+		if 'upc_code' in attrs:
+			attrs['gtin'] = canonical(attrs['upc_code'])
+			others = UPC.objects.filter(gtin=attrs['gtin'])
+			if self.instance is not None:
+				others = others.exclude(pk=self.instance.pk)
+			if others.exists():
+				raise serializers.ValidationError({'upc_code': 'A product with this GTIN already exists.'})
+		return attrs
 
-class ScanSerializer(serializers.HyperlinkedModelSerializer):
+
+class ScanSerializer(ProjectionMixin, serializers.HyperlinkedModelSerializer):
 	class Meta:
 		model = Scan
 		fields = ('upc_id', 'upc_raw', 'num_items', 'created', 'food_cat_id', 'device', 'user_id', 'scan_status')
 
 
-class FoodCatSerializer(serializers.HyperlinkedModelSerializer):
+class FoodCatSerializer(ProjectionMixin, serializers.HyperlinkedModelSerializer):
 	class Meta:
 		model = FoodCat
 		fields = ('load_cat', 'abbr', 'name', 'description', 'notes', 'created')
 
 
-class WellScoreSerializer(serializers.HyperlinkedModelSerializer):
+class WellScoreSerializer(ProjectionMixin, serializers.HyperlinkedModelSerializer):
 	class Meta:
 		model = WellScore
 		fields = ('upc_id', 'wellness', 'nut_id', 'created')
 
 
-class NutRuleSerializer(serializers.HyperlinkedModelSerializer):
+class NutRuleSerializer(ProjectionMixin, serializers.HyperlinkedModelSerializer):
+	class Meta:
+		model = NutRule
+		fields = ('food_cat_id', 'nutrient', 'nutritional_field', 'rule_type', 'value', 'wellness', 'created')
+
+
+# flat, read-only versions for bulk consumers (?flat=1): foreign keys come back as plain ids, with the code or category they point at alongside, so nothing gets URL reversed
+
+class FlatUPCSerializer(ProjectionMixin, serializers.ModelSerializer):
+	class Meta:
+		model = UPC
+		fields = ('id',) + UPCSerializer.Meta.fields + ('data_source',)
+		read_only_fields = fields
+
+
+class FlatScanSerializer(ProjectionMixin, serializers.ModelSerializer):
+	upc_code = serializers.ReadOnlyField(source='upc_id.upc_code')
+	load_cat = serializers.ReadOnlyField(source='food_cat_id.load_cat')
+
+	class Meta:
+		model = Scan
+		fields = ('id', 'upc_id', 'upc_code', 'upc_raw', 'num_items', 'created', 'food_cat_id', 'load_cat', 'device', 'user_id', 'scan_status', 'wellness')
+		read_only_fields = fields
+
+
+class FlatFoodCatSerializer(ProjectionMixin, serializers.ModelSerializer):
+	class Meta:
+		model = FoodCat
+		fields = ('id',) + FoodCatSerializer.Meta.fields
+		read_only_fields = fields
+
+
+class FlatWellScoreSerializer(ProjectionMixin, serializers.ModelSerializer):
+	upc_code = serializers.ReadOnlyField(source='upc_id.upc_code')
+	load_cat = serializers.ReadOnlyField(source='nut_id.food_cat_id.load_cat')
+
+	class Meta:
+		model = WellScore
+		fields = ('id', 'upc_id', 'upc_code', 'wellness', 'nut_id', 'load_cat', 'created')
+		read_only_fields = fields
+
+
+class FlatNutRuleSerializer(ProjectionMixin, serializers.ModelSerializer):
+	load_cat = serializers.ReadOnlyField(source='food_cat_id.load_cat')
+
 	class Meta:
 		model = NutRule
-		fields = ('food_cat_id', 'nutrient', 'nutritional_field', 'rule_type', 'value', 'wellness', 'created')
\ No newline at end of file
+		fields = ('id', 'food_cat_id', 'load_cat', 'nutrient', 'nutritional_field', 'rule_type', 'value', 'wellness', 'created')
+		read_only_fields = fields
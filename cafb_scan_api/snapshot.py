@@ -0,0 +1,158 @@
+'''
+Offline catalog snapshots for the scanner app, so it can score scans locally when the warehouse has no signal.
+
+A snapshot is gzipped JSON lines. The first line is a header, {"format": 2, "version": V, "since": S or null}, then one line per product:
+	["gtin", "item name", {"load_cat": 1 or 0 or null, ...}]
+with the product's wellness score for each food category it has been scored in, under the rule a scan would use for that category (the first, see rules.py).
+Products are keyed by GTIN-14 (see gtin.py), so the app should zero pad what it scans to 14 digits to match. Format 1 had upc_code there instead.
+The version is the newest UPC.updated / CurrentWellScore.updated in ms, so it only moves when the catalogue does.
+With since, only products added, edited or rescored after that version are sent; the app applies them over what it has.
+Deleted products aren't in deltas, so the app should take a full snapshot now and then.
+'''
+from collections import defaultdict
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+import calendar
+import json
+import os
+import tempfile
+import zlib
+
+from cafb_scan_api.models import UPC, CurrentWellScore
+from cafb_scan_api.rules import engine
+
+# bump when the line format changes, so saved snapshots and ETags from the old one aren't reused
+FORMAT = 2
+
+CHUNK_SIZE = getattr(settings, 'SNAPSHOT_CHUNK_SIZE', 500)
+# deltas reach back this far before `since`, for rows committed late by a slow transaction (resent rows are harmless)
+OVERLAP = getattr(settings, 'SNAPSHOT_OVERLAP', 60)
+SNAPSHOT_DIR = getattr(settings, 'SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'cafb_snapshots'))
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_version(created):
+	if created is None:
+		return 0
+	return calendar.timegm(created.utctimetuple()) * 1000 + created.microsecond // 1000
+
+
+def from_version(version):
+	'''
+	Raises ValueError for a version no datetime has.
+	'''
+	try:
+		if version < 0:
+			raise OverflowError
+		return EPOCH + timedelta(milliseconds=version)
+	except OverflowError:
+		raise ValueError('%d is not a snapshot version' % version)
+
+
+def current_version():
+	'''
+	Two MAX()es on indexed columns, cheap enough to run on every request.
+	'''
+	return max(
+		to_version(UPC.objects.aggregate(latest=Max('updated'))['latest']),
+		to_version(CurrentWellScore.objects.aggregate(latest=Max('updated'))['latest']),
+	)
+
+
+def products(since=None):
+	'''
+	Yields (upc pks, CurrentWellScore filter) CHUNK_SIZE products at a time: every product walking the table by pk, or just the ones changed since a version.
+	'''
+	if since is None:
+		last = 0
+		while True:
+			pks = list(UPC.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:CHUNK_SIZE])
+			if not pks:
+				return
+			yield pks, {'upc_id__gte': pks[0], 'upc_id__lte': pks[-1]}
+			last = pks[-1]
+	else:
+		start = max(EPOCH, from_version(since) - timedelta(seconds=OVERLAP))
+		changed = set(UPC.objects.filter(updated__gt=start).values_list('pk', flat=True))
+		changed.update(CurrentWellScore.objects.filter(updated__gt=start).values_list('upc_id', flat=True))
+		changed = sorted(changed)
+		for i in range(0, len(changed), CHUNK_SIZE):
+			pks = changed[i:i + CHUNK_SIZE]
+			yield pks, {'upc_id__in': pks}
+
+
+def lines(version, since=None):
+	yield json.dumps({'format': FORMAT, 'version': version, 'since': since}, separators=(',', ':')) + '\n'
+
+	# only the scores a scan would use, so the app agrees with scan_view; not ones left by a category's other or superseded rules
+	active = dict((rule.id, load_cat) for load_cat, rule in engine.rules.items())
+	for pks, score_filter in products(since):
+		scores = defaultdict(dict)
+		rows = CurrentWellScore.objects.filter(nut_id__in=list(active), **score_filter).values_list('upc_id', 'nut_id', 'wellness')
+		for upc_id, nut_id, wellness in rows:
+			scores[upc_id][active[nut_id]] = None if wellness is None else int(wellness)
+
+		# products without a valid barcode can't be scanned, so they're left out
+		items = UPC.objects.filter(pk__in=pks).exclude(gtin=None).order_by('pk').values_list('pk', 'gtin', 'item_name')
+		yield ''.join(json.dumps([gtin, item_name, scores.get(pk, {})], separators=(',', ':')) + '\n' for pk, gtin, item_name in items)
+
+
+def gzipped(chunks, level=6):
+	compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	for chunk in chunks:
+		data = compressor.compress(chunk)
+		if data:
+			yield data
+	yield compressor.flush()
+
+
+def saved(path, chunks):
+	'''
+	Passes chunks through while writing them to path; the file only appears (atomically) once the last chunk is out.
+	'''
+	fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.partial')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			for chunk in chunks:
+				f.write(chunk)
+				yield chunk
+		os.rename(partial, path)
+		# older versions are no use to anyone now
+		for name in os.listdir(os.path.dirname(path)):
+			if name.startswith('catalog-') and name.endswith('.ndjson.gz') and name != os.path.basename(path):
+				try:
+					os.remove(os.path.join(os.path.dirname(path), name))
+				except OSError:
+					pass
+	finally:
+		if os.path.exists(partial):
+			os.remove(partial)
+
+
+def read(path, size=64 * 1024):
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(size), b''):
+			yield chunk
+
+
+def stream(version, since=None):
+	'''
+	The gzipped snapshot (or delta) as an iterator of bytes, built a chunk of products at a time.
+	Full snapshots are kept on disk per version, so only the first download of a version touches the database.
+	'''
+	if since is not None:
+		return gzipped(lines(version, since))
+
+	path = os.path.join(SNAPSHOT_DIR, 'catalog-%d-%d.ndjson.gz' % (FORMAT, version))
+	if os.path.exists(path):
+		return read(path)
+	if not os.path.isdir(SNAPSHOT_DIR):
+		try:
+			os.makedirs(SNAPSHOT_DIR)
+		except OSError:
+			# another worker made it first
+			pass
+	return saved(path, gzipped(lines(version)))
@@ -0,0 +1,104 @@
+'''
+Local HTTP servers that answer like OFF and Nutritionix, for manage.py bench_scan and the tests.
+Point upstream.OFF_URL / NUTRITIONIX_URL at url(server) and lookups go to the stub instead.
+'''
+from urlparse import urlsplit, parse_qs
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import threading
+import time
+
+from cafb_scan_api import client, upstream
+
+OFF_PRODUCT = {
+	'product_name': 'Bench Oats', 'brands': 'Bench', 'generic_name': 'oats', 'last_edit_dates_tags': ['2016-07-01'],
+	'ingredients': [{'text': 'whole grain oats'}, {'text': 'sugar'}, {'text': 'salt'}],
+	'nutriments': {'energy': '1550', 'energy_unit': 'kJ', 'fat': '6', 'saturated-fat': '1', 'sodium': '0.2', 'carbohydrates': '66', 'fiber': '9', 'sugars': '12', 'proteins': '13'},
+	'serving_quantity': '40', 'serving_size': '40 g',
+}
+
+NUTRITIONIX_ITEM = {
+	'item_name': 'Bench Beans', 'brand_id': 'bench', 'brand_name': 'Bench', 'item_description': None, 'updated_at': '2016-07-01T00:00:00.000Z',
+	'nf_ingredient_statement': 'Beans, water, salt', 'nf_calories': 100, 'nf_calories_from_fat': 0, 'nf_total_fat': 0, 'nf_saturated_fat': 0,
+	'nf_cholesterol': 0, 'nf_sodium': 120, 'nf_total_carbohydrate': 20, 'nf_dietary_fiber': 6, 'nf_sugars': 1, 'nf_protein': 7,
+	'nf_vitamin_a_dv': 0, 'nf_vitamin_c_dv': 0, 'nf_calcium_dv': 2, 'nf_iron_dv': 4, 'nf_servings_per_container': 3.5,
+	'nf_serving_size_qty': 0.5, 'nf_serving_size_unit': 'cup',
+}
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def handle_error(self, request, client_address):
+		# lookups that blew their deadline hang up on us; that's expected
+		pass
+
+
+def stub_server(source, latency=0, error_rate=0, known_rate=1, error_status=503):
+	'''
+	Starts a local HTTP server that answers like OFF or Nutritionix after latency seconds.
+	error_rate of the calls get error_status; a UPC is known (the same way every time) with probability known_rate.
+	Returns the server; its port is server.server_address[1], and server.calls counts the requests it has had.
+	latency, error_rate, known_rate and error_status are attributes of the server too, and can be changed while it runs.
+	'''
+	class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1'
+
+		def log_message(self, *args):
+			pass
+
+		def do_GET(self):
+			server = self.server
+			with server.lock:
+				server.calls += 1
+			time.sleep(server.latency)
+			url = urlsplit(self.path)
+			upc_code = parse_qs(url.query).get('upc', [url.path.rsplit('/', 1)[-1].split('.')[0]])[0]
+			known = upc_code.isdigit() and (int(upc_code) * 2654435761 % 1000) < server.known_rate * 1000
+			if random.random() < server.error_rate:
+				code, body = server.error_status, {'error': 'stub'}
+			elif source == upstream.OFF:
+				code, body = 200, {'status': 1, 'product': OFF_PRODUCT} if known else {'status': 0}
+			else:
+				code, body = (200, NUTRITIONIX_ITEM) if known else (404, {'error': 'not found'})
+			data = json.dumps(body)
+			self.send_response(code)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+
+	server = ThreadingServer(('127.0.0.1', 0), Handler)
+	server.source = source
+	server.latency = latency
+	server.error_rate = error_rate
+	server.known_rate = known_rate
+	server.error_status = error_status
+	server.calls = 0
+	server.lock = threading.Lock()
+	thread = threading.Thread(target=server.serve_forever, name='stub-%s' % source)
+	thread.daemon = True
+	thread.start()
+	return server
+
+
+def stop(server):
+	'''
+	Shuts a stub server down, first hanging up the client's pooled connections to it so its threads finish.
+	'''
+	host = client.hosts.pop('127.0.0.1:%d' % server.server_address[1], None)
+	if host is not None:
+		host.session.close()
+	server.shutdown()
+	server.server_close()
+
+
+def url(server):
+	'''
+	The upstream URL template that points at a stub server.
+	'''
+	if server.source == upstream.OFF:
+		return 'http://127.0.0.1:%d/api/v0/product/{upc}.json' % server.server_address[1]
+	return 'http://127.0.0.1:%d/v1_1/item?upc={upc}&appId={apiID}&appKey={apiKey}' % server.server_address[1]
@@ -0,0 +1,1094 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from collections import OrderedDict
+from datetime import timedelta
+from StringIO import StringIO
+import csv
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from cafb_scan_api.models import UPC, FoodCat, NutRule, WellScore, CurrentWellScore, Counter, Scan, ScanRollup
+from cafb_scan_api.process_upc import Food, off_columns, INVALID_UPC, LOOKUP_TIMED_OUT
+from cafb_scan_api.cache import cached_food, bump_rule_version, invalidate_upc, rule_version, wellness_cache, counters
+from cafb_scan_api.rules import engine, RuleEngine, CompiledRule
+from cafb_scan_api.gtin import canonical, short, with_check_digit
+from cafb_scan_api.stubs import stub_server, stop, url, OFF_PRODUCT
+from cafb_scan_api.coalesce import acquire, release
+from cafb_scan_api.ingredients import reindex, matching, normalize, first_ingredient
+from cafb_scan_api.management.commands import update_well_score
+from cafb_scan_api.scan_log import ScanRecorder, recorder
+from cafb_scan_api.pagination import CreatedCursorPagination
+from cafb_scan_api.serializers import FlatScanSerializer
+from cafb_scan_api import client, upstream, quota, snapshot, metrics, scores, rules, payloads, process_upc, views, rollups, export
+
+
+def load_product(upc_code='012000017421', load_cat='27', wellness=True):
+	'''
+	A category with a rule, and a product already scored against it. Returns (upc, rule).
+	'''
+	cat = FoodCat.objects.create(load_cat=load_cat, name='Beverages')
+	rule = NutRule.objects.create(food_cat_id=cat, nutrient='Sugar', nutritional_field='sugars', rule_type='lte', value='12', wellness=True)
+	upc = UPC.objects.create(upc_code=upc_code, gtin=canonical(upc_code), item_name='Flavored Water', sugars=0, data_source='CSV')
+	CurrentWellScore.objects.create(upc_id=upc, nut_id=rule, wellness=wellness, updated=timezone.now())
+	return upc, rule
+
+
+class GtinTest(SimpleTestCase):
+
+	def test_every_format_pads_to_gtin_14(self):
+		for code, gtin in (
+			('012000017421', '00012000017421'),  # UPC-A
+			('12000017421', '00012000017421'),  # UPC-A, leading zero dropped
+			('96385074', '00000096385074'),  # EAN-8
+			('4006381333931', '04006381333931'),  # EAN-13
+			('10012000017428', '10012000017428'),  # GTIN-14
+			(' 012000017421\n', '00012000017421'),
+		):
+			self.assertEqual(canonical(code), gtin, code)
+		self.assertEqual(short('00012000017421'), '012000017421')
+		self.assertEqual(short('00000096385074'), '96385074')
+		self.assertEqual(short('04006381333931'), '4006381333931')
+		self.assertEqual(short('10012000017428'), '10012000017428')
+
+	def test_misreads(self):
+		for code in (
+			'012000017422', '96385075', '4006381333932', '10012000017427',  # wrong check digit
+			'01200001742a', '0120-0001-7421', '012000017421.0', u'\uff10\uff11\uff12',  # not digits
+			'123456789012345',  # too long
+			'', '0000', None,
+		):
+			self.assertIsNone(canonical(code), repr(code))
+
+	def test_with_check_digit(self):
+		for body, code in (('01200001742', '012000017421'), ('9638507', '96385074'), ('400638133393', '4006381333931'), ('1001200001742', '10012000017428')):
+			self.assertEqual(with_check_digit(body), code)
+			self.assertEqual(canonical(code), code.zfill(14))
+
+
+class ScanViewTest(TestCase):
+
+	def setUp(self):
+		self.upc, self.rule = load_product()
+		self.async_writes, recorder.async_writes = recorder.async_writes, False
+
+	def tearDown(self):
+		recorder.async_writes = self.async_writes
+
+	def test_misread_barcodes_get_a_400(self):
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get('/scan/012000017422/', {'food_cat': 'no such category'})
+		self.assertEqual(response.status_code, 400)
+		# logged, but never looked up
+		self.assertFalse([query for query in queries if '"cafb_scan_api_upc"' in query['sql']])
+		self.assertEqual(json.loads(response.content), {'product': None, 'wellness': 'o___0', 'response': 'error', 'message': INVALID_UPC})
+		self.assertEqual(list(Scan.objects.values_list('upc_raw', 'upc_id', 'scan_status')), [('012000017422', None, INVALID_UPC)])
+
+	def test_another_spelling_scores(self):
+		response = self.client.get('/scan/0012000017421/', {'food_cat': '27'})
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(json.loads(response.content)['wellness'], 'WELLNESS')
+		self.assertEqual(Scan.objects.get().upc_id, self.upc)
+
+
+class ScanHitTest(TestCase):
+
+	def setUp(self):
+		self.upc, self.rule = load_product()
+		# the rule engine is per process; load it outside the counted queries, like a warm worker
+		engine.warm()
+
+	def test_scored_product_takes_two_queries(self):
+		# the UPC row and its current score; nothing else on a hit
+		with self.assertNumQueries(2):
+			item = Food('012000017421', '27', '', '')
+		self.assertEqual(item.wellness, True)
+		self.assertEqual(item.upc_pk, self.upc.pk)
+		self.assertEqual(item.api_response, {'success': 'Wellness Score already calculated.'})
+
+	def test_any_spelling_of_the_code_hits(self):
+		with self.assertNumQueries(2):
+			item = Food('12000017421', '27', '', '')
+		self.assertEqual(item.upc_pk, self.upc.pk)
+
+
+
+def compiled(rule_type, value, field='sugar', wellness=True):
+	return CompiledRule({'id': 1, 'food_cat_id__load_cat': '27', 'nutritional_field': field, 'rule_type': rule_type, 'value': value, 'wellness': wellness})
+
+
+class CompiledRuleTest(SimpleTestCase):
+
+	def test_contains_lowercases(self):
+		rule = compiled('contains', 'Water', field='name')
+		self.assertEqual(rule.value, 'water')
+		self.assertEqual(rule.score({'item_name': 'Flavored WATER'}, '27'), 1)
+		self.assertEqual(rule.score({'item_name': 'Cola'}, '27'), 0)
+		# a rule for unhealthy items scores the other way round
+		self.assertEqual(compiled('contains', 'cola', field='name', wellness=False).score({'item_name': 'Diet Cola'}, '27'), 0)
+
+	def test_contains_the_category(self):
+		self.assertEqual(compiled('contains', '27', field='category').score({}, 27), 1)
+
+	def test_first_item_normalizes(self):
+		rule = compiled('first_item', '  Whole   GRAIN ', field='ingredients')
+		self.assertEqual(rule.value, 'whole grain')
+		# parsed from a fresh API answer, or already parsed on a UPC row
+		self.assertEqual(rule.score({'ingredients': 'Whole  Grain Oats, Sugar'}, '27'), 1)
+		self.assertEqual(rule.score({'ingredients': 'Sugar, whole grain oats'}, '27'), 0)
+		self.assertEqual(rule.score({'ingredients': 'ignored', 'first_ingredient': 'whole grain wheat'}, '27'), 1)
+
+	def test_lte_casts_to_float(self):
+		rule = compiled('lte', '12')
+		self.assertEqual(rule.value, 12.0)
+		self.assertEqual(rule.score({'sugars': '12'}, '27'), 1)
+		self.assertEqual(rule.score({'sugars': 12.5}, '27'), 0)
+		with self.assertRaises(TypeError):
+			rule.score({'sugars': None}, '27')
+		with self.assertRaises(KeyError):
+			rule.score({}, '27')
+
+	def test_a_value_that_isnt_a_number_never_passes(self):
+		self.assertIsNone(compiled('lte', 'n/a').predicate)
+		self.assertEqual(compiled('lte', 'n/a').score({'sugars': 0}, '27'), 0)
+
+
+class ScoreRuleTest(TestCase):
+	'''
+	update_well_score scores a whole category at once with numpy; it must say what the scan path says product by product.
+	'''
+
+	def setUp(self):
+		products = [
+			('Apple Juice', 'Apple juice, sugar', 20, 10),
+			('Oat Bars', 'Whole grain oats, sugar, salt', 12, 90),
+			('Unsalted Peanuts', 'Peanuts', 0.5, None),
+			('Mystery Can', None, None, None),
+			(None, 'Water', None, 0),
+		]
+		for i, (name, ingredients, sugars, sodium) in enumerate(products):
+			UPC.objects.create(upc_code=str(i), item_name=name, ingredients=ingredients, sugars=sugars, sodium=sodium)
+		reindex(UPC.objects.values_list('pk', flat=True))
+		for load_cat, field, rule_type, value, wellness in [
+			('1', 'sugar', 'lte', '12', True),
+			('2', 'sodium', 'lte', '50.5', False),
+			('3', 'name', 'contains', 'JUICE', False),
+			('4', 'ingredients', 'contains', 'salt', False),
+			('5', 'ingredients', 'first_item', ' Whole  Grain', True),
+			('6', 'category', 'contains', '6', True),
+			('7', 'sugar', 'lte', 'twelve', True),
+		]:
+			cat = FoodCat.objects.create(load_cat=load_cat)
+			NutRule.objects.create(food_cat_id=cat, nutritional_field=field, rule_type=rule_type, value=value, wellness=wellness)
+
+	def per_product(self, rule, load_cat):
+		# as Food.wellness_logic and resolve_batch score a product; an error means it goes unscored
+		scores = {}
+		for food_info in UPC.objects.values():
+			food_info['category'] = load_cat
+			try:
+				scores[food_info['id']] = rule.score(food_info, load_cat)
+			except (KeyError, TypeError, AttributeError, ValueError):
+				pass
+		return scores
+
+	def test_matches_the_scan_path(self):
+		columns = update_well_score.Command().load_columns()
+		self.assertTrue(np.isnan(columns['sugars']).any())
+		for load_cat, rule in sorted(RuleEngine().load().items()):
+			wellness, valid = update_well_score.score_rule(rule, columns, load_cat)
+			vectorized = dict(zip(columns['id'][valid].tolist(), wellness[valid].tolist()))
+			self.assertEqual(vectorized, self.per_product(rule, load_cat), 'category %s' % load_cat)
+			self.assertTrue(vectorized)
+
+
+class IngredientMatchingTest(TestCase):
+
+	def setUp(self):
+		statements = [
+			'Unsalted butter, cream',
+			'Water, salt',
+			'Sea salt, pepper',
+			'Sea-salt crackers',
+			'WHOLE  GRAIN oats, sugar',
+			'Whole grains+++honey',
+			'Oats, whole grain wheat',
+			u'Cr\xe8me fra\xeeche, salt',
+			'100% juice',
+			'',
+			None,
+		]
+		for i, ingredients in enumerate(statements):
+			UPC.objects.create(upc_code=str(i), ingredients=ingredients)
+		reindex(UPC.objects.values_list('pk', flat=True))
+		self.products = dict(UPC.objects.values_list('pk', 'ingredients'))
+
+	def contains(self, value):
+		# the contains rule on ingredients, product by product
+		return set(pk for pk, text in self.products.items() if text is not None and value.lower() in text.lower())
+
+	def first_item(self, value):
+		return set(pk for pk, text in self.products.items() if text is not None and normalize(value) in first_ingredient(text))
+
+	def named(self, pks):
+		return sorted(self.products[pk] for pk in pks)
+
+	def test_agrees_with_contains(self):
+		for value in ('salt', 'SALT', 'sea salt', 'sea-salt', 'whole gr', 'grain', u'fra\xeeche', '100%', '%', ', ', 'nothing like it'):
+			self.assertEqual(matching(value), self.contains(value), value)
+		# a substring, like the rule, not a word: the butter is unsalted but has "salt" in it
+		self.assertEqual(self.named(matching('salt')), [u'Cr\xe8me fra\xeeche, salt', 'Sea salt, pepper', 'Sea-salt crackers', 'Unsalted butter, cream', 'Water, salt'])
+		self.assertEqual(self.named(matching('sea salt')), ['Sea salt, pepper'])
+
+	def test_first_only(self):
+		for value in ('salt', 'whole grain', ' Whole  Grain', 'grain', u'cr\xe8me', '100', '%'):
+			self.assertEqual(matching(value, first_only=True), self.first_item(value), value)
+		# only the first ingredient counts, with its whitespace collapsed
+		self.assertEqual(self.named(matching('salt', first_only=True)), ['Sea salt, pepper', 'Sea-salt crackers', 'Unsalted butter, cream'])
+		self.assertEqual(self.named(matching('whole grain', first_only=True)), ['WHOLE  GRAIN oats, sugar', 'Whole grains+++honey'])
+
+
+class RuleEngineTest(TestCase):
+
+	def setUp(self):
+		self.upc, self.rule = load_product()
+		engine.invalidate()
+
+	def test_rule_edits_in_another_process_are_picked_up(self):
+		self.assertEqual(engine.rule_for('27').value, 12.0)
+		NutRule.objects.filter(pk=self.rule.pk).update(value='5')
+		# another worker (or manage.py initial_load) saved the rule and bumped the version
+		RuleEngine().bump()
+		engine._version_read = 0
+		self.assertEqual(engine.rule_for('27').value, 5.0)
+
+
+class ResultCacheTest(TestCase):
+
+	def setUp(self):
+		self.upc, self.rule = load_product()
+		wellness_cache().clear()
+
+	def scan(self, food_cat='27'):
+		'''
+		Scans the product; True if the answer came from the cache.
+		'''
+		misses = counters['misses']
+		cached_food('012000017421', food_cat, '', '')
+		return counters['misses'] == misses
+
+	def test_a_bump_in_another_process_reaches_this_one(self):
+		self.scan()
+		self.assertTrue(self.scan())
+		# a separate engine stands in for another worker, or a management command
+		RuleEngine().bump()
+		# trusted for up to VERSION_TTL seconds; then the version is read again
+		self.assertTrue(self.scan())
+		engine._version_read = 0
+		self.assertFalse(self.scan())
+
+	def test_an_edit_drops_every_food_cat(self):
+		with self.settings(WELLNESS_CACHE_SHARED=True):
+			for food_cat in ('27', None, '99'):
+				self.scan(food_cat)
+				self.assertTrue(self.scan(food_cat))
+			version = rule_version()
+			invalidate_upc(self.upc.gtin)
+			self.assertEqual(rule_version(), version)
+			for food_cat in ('27', None, '99'):
+				self.assertFalse(self.scan(food_cat))
+
+	def test_an_edit_moves_the_version_on_when_the_cache_is_local(self):
+		with self.settings(WELLNESS_CACHE_SHARED=False):
+			version = rule_version()
+			invalidate_upc(self.upc.gtin)
+			self.assertGreater(rule_version(), version)
+
+
+class SnapshotTest(TestCase):
+
+	def setUp(self):
+		self.upc, self.rule = load_product()
+		# loaded yesterday, so a delta since now doesn't reach back to it
+		yesterday = timezone.now() - timedelta(days=1)
+		UPC.objects.update(created=yesterday, updated=yesterday)
+		CurrentWellScore.objects.update(updated=yesterday)
+
+	def delta(self, since):
+		response = self.client.get('/scan/snapshot/', {'since': since})
+		self.assertEqual(response.status_code, 200)
+		# minus the header line
+		return zlib.decompress(b''.join(response.streaming_content), 16 + zlib.MAX_WBITS).splitlines()[1:]
+
+	def test_edits_reach_deltas(self):
+		# a client that synced a while after the load; deltas reach back OVERLAP seconds
+		since = snapshot.current_version() + (snapshot.OVERLAP + 1) * 1000
+		self.assertEqual(self.delta(since), [])
+		self.upc.item_name = 'Renamed Water'
+		self.upc.save()
+		self.assertGreater(snapshot.current_version(), since)
+		delta = self.delta(since)
+		self.assertEqual(len(delta), 1)
+		self.assertIn('Renamed Water', delta[0])
+
+	def test_since_out_of_range(self):
+		for since in ('10000000000000000000', '-1', 'x'):
+			self.assertEqual(self.client.get('/scan/snapshot/', {'since': since}).status_code, 400)
+
+	def test_scores_under_the_rule_a_scan_uses(self):
+		# a second rule for the category, scored more recently; the scan path uses the first
+		later = NutRule.objects.create(food_cat_id=self.rule.food_cat_id, nutrient='Sodium', nutritional_field='sodium', rule_type='lte', value='1', wellness=True)
+		CurrentWellScore.objects.create(upc_id=self.upc, nut_id=later, wellness=False, updated=timezone.now())
+		engine.warm()
+		self.assertEqual(Food('012000017421', '27', '', '').wellness, True)
+		response = self.client.get('/scan/snapshot/')
+		header, line = zlib.decompress(b''.join(response.streaming_content), 16 + zlib.MAX_WBITS).splitlines()
+		self.assertEqual(json.loads(line), [self.upc.gtin, 'Flavored Water', {'27': 1}])
+
+
+class ExportTest(TestCase):
+
+	def setUp(self):
+		self.upc, self.rule = load_product()
+		self.upc.item_name = u'Flavored Water, "Grape" \u2013 12 fl oz'
+		self.upc.save()
+		cereal = FoodCat.objects.create(load_cat='4', name='Cereal')
+		scans = [(self.rule.food_cat_id, 'Wellness Score already calculated.')] * 5 + [(cereal, 'Already in database')] * 2 + [(None, INVALID_UPC)]
+		for food_cat, scan_status in scans:
+			Scan.objects.create(upc_id=self.upc if food_cat else None, upc_raw='012000017421', food_cat_id=food_cat, scan_status=scan_status)
+		self.old = Scan.objects.order_by('pk').first()
+		Scan.objects.filter(pk=self.old.pk).update(created=timezone.now() - timedelta(days=3))
+		# chunks of 3, so 8 scans take three
+		self.chunk_size, export.CHUNK_SIZE = export.CHUNK_SIZE, 3
+
+	def tearDown(self):
+		export.CHUNK_SIZE = self.chunk_size
+
+	def export(self, name, **params):
+		response = self.client.get('/export/%s' % name, params)
+		self.assertEqual(response.status_code, 200)
+		return list(response.streaming_content)
+
+	def csv(self, name, **params):
+		return list(csv.DictReader(StringIO(''.join(self.export(name + '.csv', **params)))))
+
+	def ndjson(self, name, **params):
+		return [json.loads(line, object_pairs_hook=OrderedDict) for line in ''.join(self.export(name + '.ndjson', **params)).splitlines()]
+
+	def test_chunks_by_id(self):
+		# a query per chunk, and one to find there are no more
+		with self.assertNumQueries(4):
+			chunks = self.export('scan.csv')
+		self.assertEqual(len(chunks), 4)
+		self.assertEqual(chunks[0], ','.join(FlatScanSerializer.Meta.fields) + '\r\n')
+		ids = [int(row['id']) for row in csv.DictReader(StringIO(''.join(chunks)))]
+		self.assertEqual(ids, sorted(Scan.objects.values_list('pk', flat=True)))
+
+	def test_csv_and_ndjson_agree(self):
+		rows, lines = self.csv('scan'), self.ndjson('scan')
+		self.assertEqual([row['id'] for row in rows], [str(line['id']) for line in lines])
+		self.assertEqual([line.keys() for line in lines], [list(FlatScanSerializer.Meta.fields)] * 8)
+		self.assertEqual(lines[0]['upc_code'], '012000017421')
+		self.assertEqual((lines[0]['load_cat'], lines[-1]['load_cat'], lines[-1]['upc_id'], rows[-1]['upc_id']), ('27', None, None, ''))
+		for row, line in zip(rows, lines):
+			self.assertEqual(row['created'], line['created'])
+		# quoting and utf-8
+		upc, = self.csv('upc')
+		self.assertEqual(upc['item_name'].decode('utf-8'), self.upc.item_name)
+		self.assertEqual(self.ndjson('upc')[0]['item_name'], self.upc.item_name)
+
+	def test_filters(self):
+		self.assertEqual(len(self.csv('scan', food_cat='4')), 2)
+		self.assertEqual(len(self.ndjson('scan', food_cat='27', scan_status='Wellness Score already calculated.')), 5)
+		self.assertEqual([row['scan_status'] for row in self.csv('scan', scan_status=INVALID_UPC)], [INVALID_UPC])
+		today = timezone.localtime(timezone.now()).date()
+		self.assertEqual(len(self.csv('scan', since=today.isoformat())), 7)
+		self.assertEqual([int(row['id']) for row in self.csv('scan', until=(today - timedelta(days=2)).isoformat())], [self.old.pk])
+		self.assertEqual(len(self.ndjson('wellscore', food_cat='27')), 0)
+		for path, params in (('scan.csv', {'since': 'last week'}), ('upc.csv', {'food_cat': '27'}), ('wellscore.ndjson', {'scan_status': INVALID_UPC})):
+			self.assertEqual(self.client.get('/export/' + path, params).status_code, 400, path)
+
+	def test_gzip(self):
+		response = self.client.get('/export/scan.ndjson', {'gzip': '1'})
+		self.assertEqual(response['Content-Type'], 'application/gzip')
+		self.assertTrue(response['Content-Disposition'].endswith('.ndjson.gz"'))
+		self.assertEqual(zlib.decompress(b''.join(response.streaming_content), 16 + zlib.MAX_WBITS), ''.join(self.export('scan.ndjson')))
+
+
+class ArchiveTest(TestCase):
+
+	def setUp(self):
+		self.upc, self.rule = load_product()
+		scores.record([WellScore(upc_id=self.upc, nut_id=self.rule, wellness=wellness) for wellness in (False, True, True)])
+		# created is auto_now_add; backdate the history to a year ago, a day apart
+		long_ago = timezone.now() - timedelta(days=400)
+		for i, pk in enumerate(WellScore.objects.order_by('pk').values_list('pk', flat=True)):
+			WellScore.objects.filter(pk=pk).update(created=long_ago + timedelta(days=i))
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_archives_all_but_the_latest(self):
+		archived = scores.archive(timezone.now() - timedelta(days=180), timedelta(days=30), self.directory)
+		self.assertEqual(sum(count for path, count in archived), 2)
+		self.assertEqual(WellScore.objects.count(), 1)
+		self.assertTrue(all(os.path.dirname(path) == os.path.realpath(self.directory) for path, count in archived))
+
+	def test_refuses_the_app_directory(self):
+		for directory in (None, settings.BASE_DIR, os.path.join(settings.BASE_DIR, 'archive')):
+			with self.assertRaises(ValueError):
+				scores.archive(timezone.now(), timedelta(days=30), directory)
+		self.assertEqual(WellScore.objects.count(), 3)
+
+
+def fixture(name):
+	return os.path.join(settings.BASE_DIR, 'cafb_scan_api', 'fixtures', name)
+
+
+class InitialLoadTest(TestCase):
+
+	def load(self, products='test_products.csv', **options):
+		out = StringIO()
+		call_command('initial_load', products=fixture(products), categories=fixture('test_categories.csv'), rules=fixture('test_nutrules.csv'), stdout=out, **options)
+		return out.getvalue()
+
+	def test_quoted_fields_with_commas(self):
+		self.assertIn('Products: Added 2, updated 0, skipped 1 with invalid UPCs', self.load())
+		water = UPC.objects.get(gtin=canonical('12000017421'))
+		self.assertEqual(water.item_name, 'Flavored Water, "Grape"')
+		self.assertEqual(water.ingredients, 'FILTERED WATER+++NATURAL FLAVOR, GRAPE+++CITRIC ACID')
+		self.assertEqual(water.first_ingredient, 'filtered water')
+		self.assertEqual(water.sugars, 0)
+		oats = UPC.objects.get(gtin=canonical('41303001752'))
+		self.assertEqual((oats.brand_name, oats.first_ingredient, oats.sugars), ('Oats, Inc.', 'whole grain oats', 12))
+		beverages = FoodCat.objects.get(load_cat='27')
+		self.assertEqual((beverages.description, beverages.notes), ('Juice, soda+++Water', 'Not "energy" drinks'))
+		self.assertEqual(sorted(NutRule.objects.values_list('food_cat_id__load_cat', 'rule_type', 'value')), [('27', 'lte', '12'), ('4', 'first_item', 'whole grain')])
+
+	def test_upsert_updates_in_place(self):
+		self.load()
+		water = UPC.objects.get(gtin=canonical('12000017421'))
+		self.assertIn('Products: Added 1, updated 1', self.load('test_products_update.csv', upsert=True))
+		self.assertEqual(UPC.objects.count(), 3)
+		updated = UPC.objects.get(pk=water.pk)
+		self.assertEqual((updated.upc_code, updated.item_name, updated.sugars), ('012000017421', 'Flavored Water - Grape', 5))
+		self.assertGreater(updated.updated, water.updated)
+		# the ingredients were indexed again
+		self.assertEqual(updated.first_ingredient, 'natural flavor')
+		self.assertEqual(UPC.objects.get(gtin=canonical('12000031106')).first_ingredient, 'filtered water')
+		self.assertEqual((FoodCat.objects.count(), NutRule.objects.count()), (2, 2))
+
+	def test_loading_twice_asks_for_upsert(self):
+		self.load()
+		with self.assertRaisesRegexp(CommandError, 'run again with --upsert'):
+			self.load('test_products_update.csv')
+		# and none of the second load went in
+		self.assertEqual(UPC.objects.count(), 2)
+		self.assertEqual(UPC.objects.get(gtin=canonical('12000017421')).item_name, 'Flavored Water, "Grape"')
+
+
+class ReparseTest(TransactionTestCase):
+
+	def setUp(self):
+		# no network: every upstream call fails the test
+		self.get, client.get = client.get, self.fail
+		product = dict(OFF_PRODUCT, nutriments=dict(OFF_PRODUCT['nutriments'], energy='209.2', energy_unit='kJ'))
+		self.upcs = {}
+		for upc_code, data_source in (('041303001752', 'Open Food Facts'), ('012000017421', 'CSV'), ('016000275287', 'Open Food Facts')):
+			gtin = canonical(upc_code)
+			payloads.save(upstream.OFF, gtin, product)
+			# as an older off_columns() left it, with no calories
+			self.upcs[upc_code] = UPC.objects.create(upc_code=upc_code, gtin=gtin, **dict(off_columns(product), calories=None, data_source=data_source))
+		# edited through the API since it was fetched
+		UPC.objects.filter(upc_code='016000275287').update(item_name='Edited Oats', updated=timezone.now() + timedelta(hours=1))
+
+	def tearDown(self):
+		client.get = self.get
+
+	def reparse(self):
+		out = StringIO()
+		call_command('reparse_upstream', workers=1, stdout=out)
+		return out.getvalue()
+
+	def calories(self, upc_code):
+		return UPC.objects.get(upc_code=upc_code).calories
+
+	def test_fixes_rows_as_fetched_from_the_archive(self):
+		self.assertIn('1 products changed, 0 added, 2 kept', self.reparse())
+		self.assertAlmostEqual(self.calories('041303001752'), 50)
+		# the CSV row and the edited one are left alone
+		self.assertIsNone(self.calories('012000017421'))
+		self.assertIsNone(self.calories('016000275287'))
+		self.assertEqual(UPC.objects.get(upc_code='016000275287').item_name, 'Edited Oats')
+
+	def test_rows_it_rewrote_can_be_fixed_again(self):
+		self.reparse()
+		# a later parsing fix (the row is untouched otherwise)
+		UPC.objects.filter(upc_code='041303001752').update(calories=None)
+		self.assertIn('1 products changed, 0 added, 2 kept', self.reparse())
+		self.assertAlmostEqual(self.calories('041303001752'), 50)
+
+
+def wait_for(condition, timeout=5):
+	'''
+	Polls until condition() is true, for things background threads do. Returns its last value.
+	'''
+	deadline = time.time() + timeout
+	while not condition() and time.time() < deadline:
+		time.sleep(0.05)
+	return condition()
+
+
+class ScanRecorderTest(TransactionTestCase):
+
+	def setUp(self):
+		self.upc, self.rule = load_product()
+		engine.warm()
+		self.recorders = []
+
+	def tearDown(self):
+		for log in self.recorders:
+			log.stop()
+
+	def recorder(self, **options):
+		log = ScanRecorder(**options)
+		self.recorders.append(log)
+		return log
+
+	def scan(self, known=True):
+		if known:
+			return Scan(upc_id=self.upc, upc_raw='012000017421', food_cat_id=self.rule.food_cat_id, scan_status='Wellness Score already calculated.', wellness=True)
+		return Scan(upc_raw='012000017422', food_cat_id=self.rule.food_cat_id, scan_status=INVALID_UPC)
+
+	def test_a_full_queue_writes_synchronously(self):
+		# a flusher that won't get round to it by itself
+		log = self.recorder(flush_size=100, flush_interval=60, max_queue=3)
+		log.record(self.scan(), self.scan())
+		log.record(self.scan())
+		self.assertEqual(Scan.objects.count(), 0)
+		# no room for these, so they're written there and then
+		log.record(self.scan(), self.scan())
+		self.assertEqual(Scan.objects.count(), 2)
+		self.assertEqual(log.stats(), {'queued': 3, 'written': 2, 'sync_writes': 2, 'dropped': 0, 'pending': 3})
+		log.flush()
+		self.assertEqual(Scan.objects.count(), 5)
+		self.assertEqual(log.stats(), {'queued': 3, 'written': 5, 'sync_writes': 2, 'dropped': 0, 'pending': 0})
+
+	def test_flushes_in_the_background(self):
+		log = self.recorder(flush_size=2, flush_interval=60)
+		log.record(self.scan())
+		time.sleep(0.1)
+		self.assertEqual(Scan.objects.count(), 0)
+		log.record(self.scan())
+		self.assertTrue(wait_for(lambda: log.stats()['written'] == 2))
+		self.assertEqual(Scan.objects.count(), 2)
+		self.assertEqual(log.stats()['sync_writes'], 0)
+		# stopping writes what's left
+		log.record(self.scan())
+		log.stop()
+		self.assertEqual(Scan.objects.count(), 3)
+		self.assertFalse(log.thread.is_alive())
+
+	def test_rollups_follow_writes(self):
+		log = self.recorder(async_writes=False)
+		log.record(self.scan(), self.scan(False), self.scan())
+		totals = ScanRollup.objects.values_list('period', 'scan_status', 'food_cat', 'data_source', 'wellness', 'total')
+		self.assertEqual(sorted(totals.filter(period='day')), [
+			('day', 'Invalid UPC code (bad length or check digit). Please scan again.', '27', '', 'unknown', 1),
+			('day', 'Wellness Score already calculated.', '27', 'CSV', 'wellness', 2),
+		])
+		self.assertEqual(sum(totals.filter(period='hour').values_list('total', flat=True)), 3)
+
+		ScanRecorder(async_writes=False, live_rollups=False).record(self.scan())
+		self.assertEqual(Scan.objects.count(), 4)
+		self.assertEqual(sum(totals.filter(period='day').values_list('total', flat=True)), 3)
+
+
+class RollupTest(TestCase):
+
+	def setUp(self):
+		self.upc, self.rule = load_product()
+		self.off = UPC.objects.create(upc_code='041303001752', gtin=canonical('041303001752'), item_name='Oats', data_source='Open Food Facts')
+		engine.warm()
+		now = timezone.now()
+		cat = self.rule.food_cat_id
+		self.scans = [
+			(Scan(upc_id=self.upc, upc_raw='012000017421', food_cat_id=cat, scan_status='Wellness Score already calculated.', wellness=True), now),
+			(Scan(upc_id=self.upc, upc_raw='12000017421', food_cat_id=cat, scan_status='Wellness Score already calculated.', wellness=True), now - timedelta(hours=1)),
+			(Scan(upc_id=self.off, upc_raw='041303001752', scan_status='Already in database'), now - timedelta(hours=1)),
+			(Scan(upc_id=self.off, upc_raw='041303001752', food_cat_id=cat, scan_status='Already in database', wellness=False), now - timedelta(days=2)),
+			(Scan(upc_raw='012000017422', food_cat_id=cat, scan_status=INVALID_UPC), now - timedelta(days=2, hours=3)),
+		]
+		for scan, created in self.scans:
+			scan.save()
+			Scan.objects.filter(pk=scan.pk).update(created=created)
+			scan.created = created
+
+	def rollups(self):
+		return sorted(ScanRollup.objects.values_list('period', 'bucket', 'scan_status', 'food_cat', 'data_source', 'wellness', 'total'))
+
+	def test_live_rollups_match_a_rebuild(self):
+		# as the scan log writes them, in more than one batch
+		scans = [scan for scan, created in self.scans]
+		rollups.add_scans(scans[:2])
+		rollups.add_scans(scans[2:])
+		live = self.rollups()
+		self.assertEqual(sum(row[-1] for row in live if row[0] == 'day'), 5)
+		self.assertEqual(sum(row[-1] for row in live if row[0] == 'hour'), 5)
+
+		self.assertEqual(rollups.rebuild(), 5)
+		self.assertEqual(self.rollups(), live)
+		# recounting just today leaves the other days alone
+		self.assertEqual(rollups.rebuild(since=timezone.now()), len([created for scan, created in self.scans if rollups.bucket(created, 'day') == rollups.bucket(timezone.now(), 'day')]))
+		self.assertEqual(self.rollups(), live)
+
+	def test_scan_tracker_reads_the_rollups(self):
+		rollups.rebuild()
+		charts = {}
+
+		def lollipop(title, counts):
+			charts[title] = counts
+			return self.lollipop(title, counts)
+
+		self.lollipop, views.lollipop = views.lollipop, lollipop
+		caches['default'].delete('scan_tracker')
+		try:
+			# one query per chart, none of them on the Scan table
+			with self.assertNumQueries(4):
+				self.assertEqual(self.client.get(reverse('scan_tracker')).status_code, 200)
+		finally:
+			views.lollipop = self.lollipop
+			caches['default'].delete('scan_tracker')
+		self.assertEqual(charts, {
+			'scans via app': {'Wellness Score already calculated.': 2, 'Already in database': 2, INVALID_UPC: 1},
+			'source for scanned upcs': {'CSV': 2, 'Open Food Facts': 2, 'none': 1},
+			'scans by food group': {'27': 4, 'none': 1},
+			'wellness vs. non-wellness scans': {'wellness': 2, 'not wellness': 1, 'unknown': 2},
+		})
+
+
+class ApiTest(TestCase):
+
+	def setUp(self):
+		self.upc, self.rule = load_product()
+		for i in range(3):
+			Scan.objects.create(upc_id=self.upc, upc_raw='012000017421', food_cat_id=self.rule.food_cat_id, scan_status='Wellness Score already calculated.', wellness=True)
+
+	def get(self, path, **params):
+		response = self.client.get(path, params)
+		self.assertEqual(response.status_code, 200)
+		return json.loads(response.content)
+
+	def test_fields_selects_only_those_columns(self):
+		with CaptureQueriesContext(connection) as queries:
+			data = self.get('/api/v1/upc/', fields='upc_code,item_name,no_such_field')
+		self.assertEqual(data['results'], [{'upc_code': '012000017421', 'item_name': 'Flavored Water'}])
+		sql, = [query['sql'] for query in queries]
+		self.assertIn('"item_name"', sql)
+		self.assertNotIn('"sugars"', sql)
+		# nothing but unknown fields leaves nothing to show
+		self.assertEqual(self.get('/api/v1/upc/', fields='no_such_field')['results'], [{}])
+
+	def test_flat_joins_instead_of_linking(self):
+		linked = self.get('/api/v1/scan/')['results'][0]
+		self.assertTrue(linked['upc_id'].endswith('/api/v1/upc/%d/' % self.upc.pk))
+		# the code and category come with every scan in one query, however many there are
+		with self.assertNumQueries(1):
+			data = self.get('/api/v1/scan/', flat='1')
+		self.assertEqual([(scan['upc_id'], scan['upc_code'], scan['load_cat']) for scan in data['results']], [(self.upc.pk, '012000017421', '27')] * 3)
+
+		with CaptureQueriesContext(connection) as queries:
+			data = self.get('/api/v1/scan/', flat='1', fields='upc_code,scan_status')
+		self.assertEqual(data['results'][0], {'upc_code': '012000017421', 'scan_status': 'Wellness Score already calculated.'})
+		sql, = [query['sql'] for query in queries]
+		self.assertIn('"cafb_scan_api_upc"', sql)
+		self.assertNotIn('"cafb_scan_api_foodcat"', sql)
+
+	def test_page_size(self):
+		seen = []
+		page = self.get('/api/v1/scan/', page_size='2')
+		while True:
+			self.assertLessEqual(len(page['results']), 2)
+			seen.extend(scan['created'] for scan in page['results'])
+			if not page['next']:
+				break
+			page = json.loads(self.client.get(page['next']).content)
+		self.assertEqual(len(seen), 3)
+		self.assertEqual(seen, sorted(set(seen), reverse=True))
+
+		pagination = CreatedCursorPagination()
+		for size, expected in (('5000', 1000), ('1000', 1000), ('0', 10), ('-1', 10), ('lots', 10), (None, 10)):
+			request = Request(APIRequestFactory().get('/api/v1/scan/', {} if size is None else {'page_size': size}))
+			self.assertEqual(pagination.get_page_size(request), expected, size)
+
+
+class MetricsTest(TestCase):
+
+	def setUp(self):
+		load_product()
+
+	def test_counts_and_times_sql_without_keeping_it(self):
+		before = metrics.counters[metrics.labelled('cafb_sql_queries_total', {'view': 'upc-list'})]
+		response = self.client.get('/api/v1/upc/', {'flat': 1})
+		timing = dict(part.split(';dur=') for part in response['Server-Timing'].split(', '))
+		self.assertGreater(float(timing['sql']), 0)
+		self.assertGreater(metrics.counters[metrics.labelled('cafb_sql_queries_total', {'view': 'upc-list'})], before)
+		self.assertEqual(len(connection.queries_log), 0)
+		self.assertFalse(connection.queries_logged)
+
+
+class StubUpstreams(object):
+	'''
+	Points the upstream lookups at stub OFF and Nutritionix servers (self.off, self.nix) for each test, with plenty of Nutritionix quota.
+	'''
+
+	def setUp(self):
+		super(StubUpstreams, self).setUp()
+		self.off = stub_server(upstream.OFF, known_rate=0)
+		self.nix = stub_server(upstream.NUTRITIONIX, known_rate=0)
+		self.saved = (upstream.OFF_URL, upstream.NUTRITIONIX_URL, quota.nutritionix.quota, quota.nutritionix.burst, quota.nutritionix._cache)
+		upstream.OFF_URL, upstream.NUTRITIONIX_URL = url(self.off), url(self.nix)
+		quota.nutritionix.quota = quota.nutritionix.burst = 10 ** 6
+		# a bucket of its own, so the lookups' threads don't need the test database
+		quota.nutritionix._cache = LocMemCache('stub-quota', {})
+		quota.nutritionix._cache.clear()
+
+	def tearDown(self):
+		upstream.OFF_URL, upstream.NUTRITIONIX_URL, quota.nutritionix.quota, quota.nutritionix.burst, quota.nutritionix._cache = self.saved
+		stop(self.off)
+		stop(self.nix)
+		super(StubUpstreams, self).tearDown()
+
+
+class ClientTest(SimpleTestCase):
+
+	def setUp(self):
+		self.server = stub_server(upstream.OFF)
+		self.url = url(self.server).format(upc='012000017421')
+		client.host(self.url).breaker = client.CircuitBreaker(threshold=2, cooldown=0.2)
+
+	def tearDown(self):
+		stop(self.server)
+
+	def test_retries_5xx_then_gives_up(self):
+		self.server.error_rate = 1
+		with self.assertRaises(client.UpstreamError):
+			client.get(self.url, timeout=1, retries=2, backoff=0)
+		self.assertEqual(self.server.calls, 3)
+
+	def test_errors_name_only_the_host(self):
+		self.server.error_rate = 1
+		with self.assertRaises(client.UpstreamError) as raised:
+			client.get(self.url + '?appId=id&appKey=secret', timeout=1, retries=0)
+		self.assertNotIn('secret', str(raised.exception))
+		self.assertIn('127.0.0.1', str(raised.exception))
+
+	def test_backs_off_exponentially(self):
+		self.server.error_rate = 1
+		start = time.time()
+		with self.assertRaises(client.UpstreamError):
+			client.get(self.url, timeout=1, retries=2, backoff=0.05)
+		# 0.05 then 0.1
+		self.assertGreaterEqual(time.time() - start, 0.15)
+
+	def test_other_statuses_are_not_retried(self):
+		self.server.error_rate, self.server.error_status = 1, 404
+		self.assertEqual(client.get(self.url, timeout=1, retries=2, backoff=0).status_code, 404)
+		self.assertEqual(self.server.calls, 1)
+
+	def test_breaker_opens_and_recovers(self):
+		breaker = client.host(self.url).breaker
+		self.server.error_rate = 1
+		for i in range(2):
+			with self.assertRaises(client.UpstreamError):
+				client.get(self.url, timeout=1, retries=0)
+		self.assertEqual(breaker.state, 'open')
+
+		# open: fails without calling
+		with self.assertRaises(client.UpstreamError):
+			client.get(self.url, timeout=1, retries=0)
+		self.assertEqual(self.server.calls, 2)
+
+		# half-open: one trial call, and a failure opens it again
+		time.sleep(0.2)
+		self.assertEqual(breaker.state, 'half-open')
+		with self.assertRaises(client.UpstreamError):
+			client.get(self.url, timeout=1, retries=0)
+		self.assertEqual(self.server.calls, 3)
+		self.assertEqual(breaker.state, 'open')
+
+		# a successful trial closes it
+		time.sleep(0.2)
+		self.server.error_rate = 0
+		self.assertEqual(client.get(self.url, timeout=1, retries=0).status_code, 200)
+		self.assertEqual(breaker.state, 'closed')
+
+
+class QuotaTests(object):
+	'''
+	For a bucket kept wherever bucket() says.
+	'''
+
+	def setUp(self):
+		# midnight UTC; 240 calls a day is one every 6 minutes, on top of a burst of 24, and background jobs leave 10 for scans
+		self.now = 1000 * quota.DAY
+		self.quota = quota.Quota('test', 240, burst=24, reserve=10, cache=self.bucket(), clock=lambda: self.now)
+
+	def take(self, priority=quota.INTERACTIVE):
+		taken = 0
+		while self.quota.acquire(priority):
+			taken += 1
+		return taken
+
+	def test_burst_then_refill(self):
+		self.assertEqual(self.take(), 24)
+		self.now += 6 * 60
+		self.assertEqual(self.quota.available(), 1)
+		self.assertEqual(self.take(), 1)
+		self.now += 60 * 60
+		self.assertEqual(self.take(), 10)
+
+	def test_refusal_takes_nothing(self):
+		self.take()
+		for i in range(3):
+			self.assertFalse(self.quota.acquire())
+		self.assertEqual(self.quota.used(), 24)
+		self.assertEqual(self.quota.retry_after(), 6 * 60)
+
+	def test_whole_day_then_tomorrow(self):
+		self.now += quota.DAY - 1
+		self.assertEqual(self.take(), 240)
+		self.assertEqual(self.quota.retry_after(), 1)
+		self.now += 1
+		self.assertEqual(self.quota.status(), {'quota': 240, 'used': 0, 'remaining': 240, 'available': {quota.INTERACTIVE: 24, quota.BACKGROUND: 14}})
+
+	def test_background_leaves_the_reserve(self):
+		self.assertEqual(self.take(quota.BACKGROUND), 14)
+		# scans can still have the rest
+		self.assertEqual(self.quota.available(quota.BACKGROUND), 0)
+		self.assertEqual(self.quota.retry_after(quota.BACKGROUND), 6 * 60)
+		self.assertEqual(self.take(), 10)
+		self.assertEqual(self.quota.retry_after(quota.BACKGROUND), 11 * 6 * 60)
+
+
+class CachedQuotaTest(QuotaTests, SimpleTestCase):
+
+	def bucket(self):
+		cache = LocMemCache('quota-test', {})
+		cache.clear()
+		return cache
+
+
+class DatabaseQuotaTest(QuotaTests, TestCase):
+
+	def bucket(self):
+		# what the wellness cache being process-local gets
+		return None
+
+	def test_only_the_last_two_days_are_kept(self):
+		for day in range(4):
+			self.quota.acquire()
+			self.now += quota.DAY
+		self.assertEqual(sorted(Counter.objects.filter(name__startswith='quota:test:').values_list('name', flat=True)), ['quota:test:1002', 'quota:test:1003'])
+
+
+class LookupTest(StubUpstreams, SimpleTestCase):
+
+	def test_off_wins(self):
+		self.off.known_rate = self.nix.known_rate = 1
+		self.assertEqual(upstream.lookup('012000017421', 'id', 'key')[0], upstream.OFF)
+
+	def test_nutritionix_when_off_is_too_slow(self):
+		self.off.known_rate = self.nix.known_rate = 1
+		self.off.latency = 0.5
+		self.assertEqual(upstream.lookup('012000017421', 'id', 'key', deadline=0.3)[0], upstream.NUTRITIONIX)
+
+	def test_neither_knows_it(self):
+		self.assertEqual(upstream.lookup('012000017421', 'id', 'key'), (None, None))
+
+	def test_errors_are_not_a_miss(self):
+		self.off.error_rate = self.nix.error_rate = 1
+		self.assertEqual(upstream.lookup('012000017421', 'id', 'key'), (upstream.UNAVAILABLE, None))
+
+	def test_one_nutritionix_call_per_token(self):
+		# a 429 (or 5xx) from a host with a quota isn't retried
+		self.nix.error_rate, self.nix.error_status = 1, 429
+		used = quota.nutritionix.used()
+		with self.assertRaises(client.UpstreamError):
+			upstream.fetch_nutrionix('012000017421', 'id', 'key')
+		self.assertEqual(self.nix.calls, 1)
+		self.assertEqual(quota.nutritionix.used(), used + 1)
+
+	def test_gives_up_at_the_deadline(self):
+		self.off.latency = self.nix.latency = 1
+		start = time.time()
+		self.assertEqual(upstream.lookup('012000017421', 'id', 'key', deadline=0.2), (upstream.UNAVAILABLE, None))
+		self.assertLess(time.time() - start, 0.5)
+
+
+class OffColumnsTest(SimpleTestCase):
+
+	def calories(self, energy, unit):
+		return off_columns(dict(OFF_PRODUCT, nutriments=dict(OFF_PRODUCT['nutriments'], energy=energy, energy_unit=unit)))['calories']
+
+	def test_calories_in_kcal(self):
+		self.assertEqual(self.calories('250', 'kcal'), 250)
+		self.assertAlmostEqual(self.calories('1046', 'kJ'), 250, places=0)
+		self.assertIsNone(self.calories('', 'kJ'))
+		self.assertIsNone(self.calories('5', 'BTU'))
+
+
+class UnknownCacheTest(StubUpstreams, TestCase):
+
+	def test_bumping_the_rule_version_forgets_unknowns(self):
+		self.assertIsNone(cached_food('041303001752', None, '', '').upc_pk)
+		# OFF adds it (or an import does); the cached "unknown" still answers until the bump
+		self.off.known_rate = 1
+		self.assertIsNone(cached_food('041303001752', None, '', '').upc_pk)
+		bump_rule_version()
+		self.assertIsNotNone(cached_food('041303001752', None, '', '').upc_pk)
+
+
+def scan_all(codes):
+	'''
+	Scans each code in its own thread, all at once. Returns the Foods in order.
+	No category, so no rule and no score to write; the scans only race to look the product up.
+	'''
+	items = [None] * len(codes)
+	errors = []
+
+	def scan(i):
+		try:
+			items[i] = Food(codes[i], None, '', '')
+		except Exception as e:
+			errors.append(e)
+		finally:
+			connection.close()
+
+	threads = [threading.Thread(target=scan, args=(i,)) for i in range(len(codes))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	if errors:
+		raise errors[0]
+	return items
+
+
+class CoalescingTest(StubUpstreams, TransactionTestCase):
+
+	def setUp(self):
+		super(CoalescingTest, self).setUp()
+		self.off.known_rate = 1
+		# long enough for every scan to pile up behind the first
+		self.off.latency = 0.3
+		# OFF knows it, so Nutritionix is never asked and a lookup is one upstream call
+		self.hedge_above, upstream.HEDGE_ABOVE = upstream.HEDGE_ABOVE, 10 ** 9
+
+	def tearDown(self):
+		upstream.HEDGE_ABOVE = self.hedge_above
+		super(CoalescingTest, self).tearDown()
+
+	def test_parallel_scans_share_one_fetch(self):
+		items = scan_all(['041303001752'] * 8)
+		self.assertEqual(self.off.calls, 1)
+		self.assertEqual(self.nix.calls, 0)
+		self.assertEqual(UPC.objects.filter(gtin=canonical('041303001752')).count(), 1)
+		self.assertEqual(set(item.upc_pk for item in items), set(UPC.objects.values_list('pk', flat=True)))
+
+	def test_every_spelling_shares_the_fetch(self):
+		scan_all(['041303001752', '41303001752', '0041303001752'] * 3)
+		self.assertEqual(self.off.calls, 1)
+		self.assertEqual(UPC.objects.count(), 1)
+
+	def test_waits_for_another_worker(self):
+		# another worker has the lock and is fetching; this one waits for its row instead of asking upstream
+		gtin = canonical('041303001752')
+		self.assertTrue(acquire(gtin))
+
+		def other_worker():
+			time.sleep(0.2)
+			UPC.objects.create(upc_code='041303001752', gtin=gtin, item_name='Fetched elsewhere')
+			release(gtin)
+			connection.close()
+
+		thread = threading.Thread(target=other_worker)
+		thread.start()
+		item, = scan_all(['041303001752'])
+		thread.join()
+		self.assertEqual(self.off.calls, 0)
+		self.assertEqual(item.food_info['item_name'], 'Fetched elsewhere')
+		self.assertEqual(item.api_response, {'success': 'Already in database'})
+		self.assertEqual(UPC.objects.count(), 1)
+
+
+class BatchScanTest(StubUpstreams, TransactionTestCase):
+
+	def setUp(self):
+		super(BatchScanTest, self).setUp()
+		self.upc, self.rule = load_product()
+		engine.warm()
+		# write scans as they come, so they're there to count
+		self.async_writes, recorder.async_writes = recorder.async_writes, False
+		self.deadline = process_upc.BATCH_SCAN_DEADLINE
+
+	def tearDown(self):
+		recorder.async_writes = self.async_writes
+		process_upc.BATCH_SCAN_DEADLINE = self.deadline
+		super(BatchScanTest, self).tearDown()
+
+	def post(self, body):
+		return self.client.post(reverse('batch_scan'), body if isinstance(body, str) else json.dumps(body), content_type='application/json')
+
+	def test_invalid_codes_get_an_error_in_place(self):
+		response = self.post([['012000017421', '27'], ['012000017422', '27'], ['123456789012345', 27], {'upc': '12000017421', 'food_cat': '27'}])
+		self.assertEqual(response.status_code, 200)
+		data = json.loads(response.content)
+		self.assertEqual([item['message'] for item in data], ['Wellness Score already calculated.', INVALID_UPC, INVALID_UPC, 'Wellness Score already calculated.'])
+		self.assertEqual([item['wellness'] for item in data], ['WELLNESS', 'o___0', 'o___0', 'WELLNESS'])
+		self.assertEqual(self.off.calls + self.nix.calls, 0)
+		self.assertEqual(list(Scan.objects.order_by('pk').values_list('upc_id', 'scan_status')), [(self.upc.pk, 'Wellness Score already calculated.'), (None, INVALID_UPC), (None, INVALID_UPC), (self.upc.pk, 'Wellness Score already calculated.')])
+
+	def test_at_most_batch_scan_max_items(self):
+		self.assertEqual(views.BATCH_SCAN_MAX, 200)
+		self.assertEqual(len(json.loads(self.post([['012000017421', '27']] * 200).content)), 200)
+		response = self.post([['012000017421', '27']] * 201)
+		self.assertEqual(response.status_code, 400)
+		self.assertEqual(Scan.objects.count(), 200)
+
+	def test_malformed_requests(self):
+		for body in ('not json', '{"upcs": []}', '[["012000017421"]]', '[12000017421]', '{"items": [{"food_cat": "27"}]}', '[["0120-0001-7421", "27"]]'):
+			self.assertEqual(self.post(body).status_code, 400, body)
+		self.assertEqual(self.client.get(reverse('batch_scan')).status_code, 405)
+		self.assertEqual(Scan.objects.count(), 0)
+
+	def test_lookups_past_the_deadline_time_out(self):
+		self.off.known_rate, self.off.latency = 1, 0.5
+		process_upc.BATCH_SCAN_DEADLINE = 0.1
+		start = time.time()
+		data = json.loads(self.post([['041303001752', None], ['012000017421', '27']]).content)
+		self.assertLess(time.time() - start, 0.4)
+		self.assertEqual([item['message'] for item in data], [LOOKUP_TIMED_OUT, 'Wellness Score already calculated.'])
+		# the lookup carries on, so the app's next scan finds it
+		for i in range(50):
+			if UPC.objects.filter(gtin=canonical('041303001752')).exists():
+				break
+			time.sleep(0.1)
+		self.assertEqual(UPC.objects.get(gtin=canonical('041303001752')).item_name, OFF_PRODUCT['product_name'])
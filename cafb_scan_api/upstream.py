@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from django.conf import settings
+from django.db import connection
+import time
+
+from cafb_scan_api import client, metrics, quota
+
+OFF = 'OFF'
+NUTRITIONIX = 'Nutrionix'
+# lookup()'s source when nobody found the UPC but a source couldn't say (error, timeout, breaker open, no quota), so it may yet be found
+UNAVAILABLE = 'unavailable'
+# result() of a source that couldn't say
+FAILED = object()
+
+# URLs are settings so the lookups can be pointed at local stub servers
+OFF_URL = getattr(settings, 'OFF_URL', "http://world.openfoodfacts.org/api/v0/product/{upc}.json")
+NUTRITIONIX_URL = getattr(settings, 'NUTRITIONIX_URL', "https://api.nutritionix.com/v1_1/item?upc={upc}&appId={apiID}&appKey={apiKey}")
+
+# seconds we'll wait on each source, and on the lookup as a whole
+TIMEOUTS = getattr(settings, 'UPSTREAM_TIMEOUTS', {OFF: 2.0, NUTRITIONIX: 3.0})
+DEADLINE = getattr(settings, 'UPSTREAM_DEADLINE', 3.0)
+# Nutritionix is only asked alongside OFF while it has more calls than this left for the lookup's priority; below it, only once OFF has missed (see quota.py)
+HEDGE_ABOVE = getattr(settings, 'NUTRITIONIX_HEDGE_ABOVE', 0)
+
+executor = ThreadPoolExecutor(max_workers=getattr(settings, 'UPSTREAM_WORKERS', 8))
+
+
+def fetch_open_food_facts(upc_code):
+	'''
+	Returns the OFF product dict, or None if OFF doesn't know the UPC. Raises if it couldn't tell us.
+	'''
+	response = client.get(OFF_URL.format(upc=upc_code), timeout=TIMEOUTS[OFF])
+	if response.status_code != 200:
+		raise client.UpstreamError('HTTP %d from %s' % (response.status_code, OFF))
+	body = response.json()
+	if body['status'] == 1:
+		return body['product']
+
+
+def fetch_nutrionix(upc_code, api_id, api_key, priority=quota.INTERACTIVE):
+	'''
+	Returns the Nutritionix item dict, or None if Nutritionix doesn't know the UPC (a 404). Raises if it couldn't tell us.
+	Raises QuotaExceeded, without calling, if there's no quota left for this priority.
+	'''
+	if not quota.nutritionix.acquire(priority):
+		raise quota.QuotaExceeded('no Nutritionix quota left for %s calls' % priority)
+	# one token, one call: a retry would spend quota we haven't taken, and retrying a 429 only digs deeper
+	response = client.get(NUTRITIONIX_URL.format(apiID=api_id, apiKey=api_key,upc=upc_code), timeout=TIMEOUTS[NUTRITIONIX], retries=0)
+	if response.status_code == 200:
+		return response.json()
+	if response.status_code != 404:
+		raise client.UpstreamError('HTTP %d from %s' % (response.status_code, NUTRITIONIX))
+
+
+def timed_fetch(source, fetch, *args):
+	'''
+	Runs fetch, recording how long it took and whether it found the UPC, didn't, failed, or wasn't allowed to ask.
+	'''
+	start = time.time()
+	outcome = 'error'
+	try:
+		found = fetch(*args)
+		outcome = 'found' if found else 'not_found'
+		return found
+	except quota.QuotaExceeded:
+		outcome = 'over_quota'
+		raise
+	finally:
+		metrics.observe('cafb_upstream_seconds', time.time() - start, source=source, outcome=outcome)
+
+
+def pooled_fetch(source, fetch, *args):
+	'''
+	timed_fetch() for the executor's threads. The quota may have opened a database connection in this thread; it's closed again, or every thread in the pool would keep one.
+	'''
+	try:
+		return timed_fetch(source, fetch, *args)
+	finally:
+		connection.close()
+
+
+def result(future):
+	'''
+	A source's answer: the payload, None if it doesn't know the UPC, or FAILED if it couldn't say (still going, errors, bad JSON, connection refused, no quota, ...).
+	'''
+	if not future.done():
+		return FAILED
+	try:
+		return future.result(0)
+	except Exception:
+		return FAILED
+
+
+def found(answer):
+	return answer is not None and answer is not FAILED
+
+
+def lookup(upc_code, api_id, api_key, deadline=None, priority=quota.INTERACTIVE):
+	'''
+	Asks OFF and Nutritionix at the same time (or Nutritionix only after OFF misses, when its quota runs low).
+	OFF wins if it answers within its timeout (it's free); otherwise Nutritionix's answer is used if it comes back inside the deadline.
+	Returns (source, payload); (None, None) if both sources said they don't know the UPC, or (UNAVAILABLE, None) if neither found it and one of them couldn't say.
+	Never takes much longer than the deadline; a source that is still going is left to finish in the background and ignored.
+	priority is the lookup's quota class: INTERACTIVE for scans, BACKGROUND for jobs that can wait.
+	'''
+	with metrics.timed('upstream'):
+		source, payload = ask_both(upc_code, api_id, api_key, DEADLINE if deadline is None else deadline, priority)
+	metrics.inc('cafb_upstream_lookups_total', source=source or 'none')
+	return source, payload
+
+
+def ask_both(upc_code, api_id, api_key, deadline, priority):
+	start = time.time()
+	off = executor.submit(timed_fetch, OFF, fetch_open_food_facts, upc_code)
+	ask_nix = lambda: executor.submit(pooled_fetch, NUTRITIONIX, fetch_nutrionix, upc_code, api_id, api_key, priority)
+	# a call cancelled before it starts takes no quota, but one OFF beats still costs a call
+	nix = ask_nix() if quota.nutritionix.available(priority) > HEDGE_ABOVE else None
+
+	# OFF first, while Nutritionix runs alongside
+	wait([off], timeout=max(0, start + min(TIMEOUTS[OFF], deadline) - time.time()))
+	off_answer = result(off)
+	if found(off_answer):
+		if nix is not None:
+			nix.cancel()
+		return OFF, off_answer
+	off.cancel()
+
+	if nix is None:
+		nix = ask_nix()
+
+	# OFF missed or was too slow; take Nutritionix if it answers in time
+	wait([nix], timeout=max(0, start + min(TIMEOUTS[NUTRITIONIX], deadline) - time.time()))
+	nix_answer = result(nix)
+	if found(nix_answer):
+		return NUTRITIONIX, nix_answer
+	nix.cancel()
+
+	if off_answer is FAILED or nix_answer is FAILED:
+		return UNAVAILABLE, None
+	return None, None
@@ -31,5 +31,11 @@ urlpatterns = [
     url(r'^', include(router.urls)),
     url(r'^api/v1/', include('rest_framework.urls', namespace='rest_framework')),
     url(r'^scan/(?P<upc>[0-9]+)/$', views.scan_view),
+    url(r'^scan/batch/$', views.batch_scan_view, name="batch_scan"),
+    url(r'^scan/snapshot/$', views.catalog_snapshot, name="catalog_snapshot"),
+    url(r'^export/(?P<table>scan|upc|wellscore)\.(?P<fmt>csv|ndjson)$', views.export_view, name="export"),
+    url(r'^scan/cache_stats/$', views.cache_stats, name="cache_stats"),
+    url(r'^scan/log_stats/$', views.scan_log_stats, name="scan_log_stats"),
+    url(r'^metrics/?$', views.prometheus_metrics, name="metrics"),
     url(r'^scan_tracker/$', views.scan_tracker, name="scan_tracker"),
 ]
\ No newline at end of file
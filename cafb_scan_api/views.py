@@ -1,143 +1,390 @@
-from django.http import HttpResponse
-from cafb_scan_api.models import Scan, FoodCat, WellScore, NutRule, UPC
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import parse_etags, quote_etag
+from django.utils import timezone
+from cafb_scan_api.models import Scan, FoodCat, WellScore, NutRule, UPC, ScanRollup
 from rest_framework import viewsets
-from django.views.generic import ListView, View
-from cafb_scan_api.serializers import UPCSerializer, ScanSerializer, FoodCatSerializer, WellScoreSerializer, NutRuleSerializer
-from cafb_scan_api.process_upc import Food
+from rest_framework.permissions import SAFE_METHODS
+from cafb_scan_api.serializers import UPCSerializer, ScanSerializer, FoodCatSerializer, WellScoreSerializer, NutRuleSerializer, requested_fields
+from cafb_scan_api.serializers import FlatUPCSerializer, FlatScanSerializer, FlatFoodCatSerializer, FlatWellScoreSerializer, FlatNutRuleSerializer
+from cafb_scan_api.process_upc import resolve_batch, INVALID_UPC
+from cafb_scan_api.gtin import canonical
+from cafb_scan_api.rules import engine
+from cafb_scan_api.ingredients import reindex
+from cafb_scan_api.scores import sync, resync
+from cafb_scan_api.cache import cached_food, bump_rule_version, invalidate_upc, stats
+from cafb_scan_api.scan_log import recorder
+from cafb_scan_api import snapshot, metrics, client, export, quota
 import os
-from json import dumps
-from django.core.exceptions import ObjectDoesNotExist
+from json import dumps, loads
 from django.shortcuts import render
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from bokeh.resources import CDN
 from bokeh.embed import components
-from bokeh.plotting import figure, show, output_file, vplot
-from django.db.models import Count
+from bokeh.plotting import figure
+from django.db.models import Sum
+from django.conf import settings
+from django.core.cache import caches
 
 # Create your views here.
 
-class ScanViewSet(viewsets.ModelViewSet):
+BATCH_SCAN_MAX = getattr(settings, 'BATCH_SCAN_MAX', 200)
+
+class LeanMixin(object):
+    """
+    What every /api/v1/ viewset does on top of ModelViewSet (pages come from CreatedCursorPagination):
+    ?fields=a,b,c serializes only those fields and only SELECTs their columns (plus id and created, which the cursor needs).
+    ?flat=1 on reads uses the flat, read-only serializer instead of the hyperlinked one.
+    related maps the flat serializer's looked-up fields to the columns they come from; those relations are select_related instead of costing a query per row.
+    Hyperlinked foreign keys only need the id column already on the row, so plain reads don't join anything.
+    """
+    flat_serializer_class = None
+    related = {}
+
+    def flat(self):
+        request = getattr(self, 'request', None)
+        # the schema generator asks for the serializer without a request
+        return request is not None and request.method in SAFE_METHODS and request.query_params.get('flat') in ('1', 'true', 'yes')
+
+    def get_serializer_class(self):
+        if self.flat_serializer_class is not None and self.flat():
+            return self.flat_serializer_class
+        return super(LeanMixin, self).get_serializer_class()
+
+    def get_queryset(self):
+        queryset = super(LeanMixin, self).get_queryset()
+        fields = requested_fields(self.request)
+
+        related = {}
+        if self.flat() or self.request.method not in SAFE_METHODS:
+            # writes look the related code up in the cache invalidation hooks
+            related = dict((name, column) for name, column in self.related.items() if fields is None or name in fields)
+        joins = set(column.rsplit('__', 1)[0] for column in related.values())
+        if joins:
+            queryset = queryset.select_related(*joins)
+
+        if fields is not None:
+            names = set(field.name for field in queryset.model._meta.concrete_fields)
+            columns = set(name for name in fields if name in names) | set(related.values())
+            for join in joins:
+                # select_related can't follow a deferred foreign key
+                parts = join.split('__')
+                columns.update('__'.join(parts[:i]) for i in range(1, len(parts) + 1))
+            queryset = queryset.only('id', 'created', *columns)
+        return queryset
+
+
+class ScanViewSet(LeanMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     queryset = Scan.objects.all().order_by('-created')
     serializer_class = ScanSerializer
+    flat_serializer_class = FlatScanSerializer
+    related = {'upc_code': 'upc_id__upc_code', 'load_cat': 'food_cat_id__load_cat'}
 
 
-class FoodCatViewSet(viewsets.ModelViewSet):
+class FoodCatViewSet(LeanMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     queryset = FoodCat.objects.all().order_by('-created')
     serializer_class = FoodCatSerializer
+    flat_serializer_class = FlatFoodCatSerializer
+
+    # the rule engine keeps the load_cat -> pk map, and cached scans carry the category pk
+    def perform_create(self, serializer):
+        serializer.save()
+        bump_rule_version()
 
+    def perform_update(self, serializer):
+        serializer.save()
+        bump_rule_version()
 
-class WellScoreViewSet(viewsets.ModelViewSet):
+    def perform_destroy(self, instance):
+        instance.delete()
+        bump_rule_version()
+
+
+class WellScoreViewSet(LeanMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     queryset = WellScore.objects.all().order_by('-created')
     serializer_class = WellScoreSerializer
+    flat_serializer_class = FlatWellScoreSerializer
+    related = {'upc_code': 'upc_id__upc_code', 'load_cat': 'nut_id__food_cat_id__load_cat'}
+
+    # keep CurrentWellScore in step, and cached scans carry the latest score
+    def perform_create(self, serializer):
+        score = serializer.save()
+        sync([score])
+        invalidate_upc(score.upc_id.gtin)
+
+    def perform_update(self, serializer):
+        old = (serializer.instance.upc_id_id, serializer.instance.nut_id_id, serializer.instance.upc_id.gtin)
+        score = serializer.save()
+        resync([old[:2], (score.upc_id_id, score.nut_id_id)])
+        invalidate_upc(old[2])
+        invalidate_upc(score.upc_id.gtin)
 
+    def perform_destroy(self, instance):
+        instance.delete()
+        resync([(instance.upc_id_id, instance.nut_id_id)])
+        invalidate_upc(instance.upc_id.gtin)
 
-class NutRuleViewSet(viewsets.ModelViewSet):
+
+class NutRuleViewSet(LeanMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     queryset = NutRule.objects.all().order_by('-created')
     serializer_class = NutRuleSerializer
+    flat_serializer_class = FlatNutRuleSerializer
+    related = {'load_cat': 'food_cat_id__load_cat'}
+
+    # rebuild the compiled rules and drop cached scans whenever one changes
+    def perform_create(self, serializer):
+        serializer.save()
+        bump_rule_version()
+
+    def perform_update(self, serializer):
+        serializer.save()
+        bump_rule_version()
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        bump_rule_version()
 
 
-class UPCViewSet(viewsets.ModelViewSet):
+class UPCViewSet(LeanMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows users to be viewed or edited.
     """
     queryset = UPC.objects.all().order_by('-created')
     serializer_class = UPCSerializer
+    flat_serializer_class = FlatUPCSerializer
+
+    # reparse the ingredients, and drop cached scans (and "unknown" answers) for the UPC
+    def perform_create(self, serializer):
+        upc = serializer.save()
+        reindex([upc.pk])
+        invalidate_upc(upc.gtin)
+
+    def perform_update(self, serializer):
+        old_gtin = serializer.instance.gtin
+        upc = serializer.save()
+        reindex([upc.pk])
+        invalidate_upc(upc.gtin)
+        invalidate_upc(old_gtin)
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        invalidate_upc(instance.gtin)
 
 def scan_view(request,upc):
 	'''
 	This will be what the app sends.
 	The url format is URL_STUFF/{some upc code}/?food_cat={some food cat}
 	It will return JSON with the item name, wellness score, and API status.
+	A misread barcode (bad length or check digit) gets a 400 in the same shape, without any lookup.
 	'''
 	food_cat = request.GET.get('food_cat')
+	if canonical(upc) is None:
+		with metrics.timed('scan_log'):
+			recorder.record(Scan(upc_raw=upc, food_cat_id_id=engine.food_cat_pk(food_cat), scan_status=INVALID_UPC))
+		return HttpResponseBadRequest(dumps(app_data(None, None, {'error': INVALID_UPC}), indent=4, sort_keys=True), content_type="application/json")
+
 	api_key = os.environ.get('api_key', '')  # api_key
 	api_id = os.environ.get('api_id', '') # api_id
-	item = Food(str(upc), food_cat, api_key, api_id)
+	item = cached_food(str(upc), food_cat, api_key, api_id)
 
-	try:
-		upc_pk = UPC.objects.values_list('pk',flat=True).get(upc_code=upc)
-	except ObjectDoesNotExist:
-		upc_pk = None 
+	# do scanner update (written in the background, see scan_log.py)
+	with metrics.timed('scan_log'):
+		recorder.record(Scan(upc_id_id=item.upc_pk, upc_raw=upc, food_cat_id_id=item.food_cat_pk, scan_status=item.api_response.values()[0], wellness=item.wellness))
 
+	return HttpResponse(dumps(app_data(item.food_info, item.wellness, item.api_response), indent=4, sort_keys=True, default=lambda x:str(x)), content_type="application/json")
+
+@csrf_exempt
+@require_POST
+def batch_scan_view(request):
+	'''
+	Scores a whole pallet of scans in one request.
+	The app POSTs JSON to URL_STUFF/scan/batch/ as either [[upc, food_cat], ...] or {"items": [{"upc": ..., "food_cat": ...}, ...]}
+	It will return a JSON list with one entry per item, each the same shape scan_view returns.
+	At most BATCH_SCAN_MAX items a request; UPCs we don't know are looked up in parallel, within BATCH_SCAN_DEADLINE (see resolve_batch).
+	'''
 	try:
-		food_cat_pk = FoodCat.objects.values_list('pk', flat=True).get(load_cat=food_cat)
-	except ObjectDoesNotExist:
-		food_cat_pk = None
-	
-	# do scanner update
-	obj = Scan(upc_id_id=upc_pk, upc_raw=upc, food_cat_id_id=food_cat_pk, scan_status=item.api_response.values()[0])
-	obj.save()
-
-	if item.wellness:
+		payload = loads(request.body)
+		if isinstance(payload, dict):
+			payload = payload['items']
+		items = [(str(i['upc']), i.get('food_cat')) if isinstance(i, dict) else (str(i[0]), i[1]) for i in payload]
+	except (ValueError, KeyError, IndexError, TypeError):
+		return HttpResponseBadRequest('Expected a JSON list of [upc, food_cat] pairs.')
+
+	if not all(upc.isdigit() for upc, food_cat in items):
+		return HttpResponseBadRequest('UPC codes must be digits only.')
+	if len(items) > BATCH_SCAN_MAX:
+		return HttpResponseBadRequest('At most %d items per batch.' % BATCH_SCAN_MAX)
+
+	items = [(upc, None if food_cat is None else str(food_cat)) for upc, food_cat in items]
+	api_key = os.environ.get('api_key', '')  # api_key
+	api_id = os.environ.get('api_id', '') # api_id
+	with metrics.timed('resolve_batch'):
+		results = resolve_batch(items, api_key, api_id)
+
+	# do scanner update, all in one go
+	with metrics.timed('scan_log'):
+		recorder.record(*[
+			Scan(upc_id_id=upc_pk, upc_raw=upc, food_cat_id_id=food_cat_pk, scan_status=api_response.values()[0], wellness=wellness)
+			for (upc, food_cat), (food_info, api_response, wellness, upc_pk, food_cat_pk) in zip(items, results)
+		])
+
+	data = [app_data(food_info, wellness, api_response) for food_info, api_response, wellness, upc_pk, food_cat_pk in results]
+
+	return HttpResponse(dumps(data, indent=4, sort_keys=True, default=lambda x:str(x)), content_type="application/json")
+
+def app_data(food_info, wellness, api_response):
+	'''
+	Formats a scan result for the app.
+	'''
+	if wellness:
 		pretty_well = 'WELLNESS'
-	elif item.wellness == 0:
+	elif wellness == 0:
 		pretty_well = 'NOT WELLNESS'
 	else:
 		pretty_well = 'o___0'
 
-	# format response for the app
-	app_data = { 
-	'product': item.food_info,
+	return { 
+	'product': food_info,
 	'wellness' : pretty_well,
-	'response' : item.api_response.keys()[0],
-	'message' : item.api_response.values()[0]
+	'response' : api_response.keys()[0],
+	'message' : api_response.values()[0]
 	}
 
-	return HttpResponse(dumps(app_data, indent=4, sort_keys=True, default=lambda x:str(x)), content_type="application/json")
+def catalog_snapshot(request):
+	'''
+	Gzipped catalogue for scoring offline (format in snapshot.py).
+	URL_STUFF/scan/snapshot/ sends everything, URL_STUFF/scan/snapshot/?since={version} just what changed after that version.
+	Send the ETag back in If-None-Match and an unchanged catalogue costs a 304.
+	'''
+	since = request.GET.get('since')
+	if since:
+		try:
+			since = int(since)
+			snapshot.from_version(since)
+		except ValueError:
+			return HttpResponseBadRequest('since must be a snapshot version.')
+	else:
+		since = None
 
-def scan_tracker(request):
-	# cats = Scan.objects.annotate(num_scans=Count('upc_raw'))
-	# stats = Scan.objects.annotate(num_success=Count('scan_status'))
+	version = snapshot.current_version()
+	etag = '%d-%d' % (snapshot.FORMAT, version) if since is None else '%d-%d-%d' % (snapshot.FORMAT, since, version)
+	if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+	if if_none_match and (etag in parse_etags(if_none_match) or if_none_match.strip() == '*'):
+		response = HttpResponseNotModified()
+	else:
+		response = StreamingHttpResponse(snapshot.stream(version, since), content_type='application/gzip')
+		response['Content-Disposition'] = 'attachment; filename="catalog-%s.ndjson.gz"' % etag
+	response['ETag'] = quote_etag(etag)
+	response['X-Snapshot-Version'] = str(version)
+	# always check back, the ETag makes that cheap
+	response['Cache-Control'] = 'no-cache'
+	return response
+
+def export_view(request, table, fmt):
+	'''
+	Streams a whole table for reporting: URL_STUFF/export/scan.csv, /export/upc.ndjson, /export/wellscore.csv, ...
+	Filter with ?since=2016-01-01&until=2016-12-31 (created), ?food_cat= and ?scan_status=, and add ?gzip=1 for a gzipped file. See export.py.
+	'''
+	try:
+		rows = export.queryset(table, request.GET)
+	except export.ExportError as e:
+		return HttpResponseBadRequest(str(e))
+
+	chunks = export.lines(table, fmt, rows)
+	filename = 'export-%s-%s.%s' % (table, timezone.now().strftime('%Y%m%dT%H%M%S'), fmt)
+	if request.GET.get('gzip') in ('1', 'true', 'yes'):
+		response = StreamingHttpResponse(snapshot.gzipped(chunks), content_type='application/gzip')
+		filename += '.gz'
+	else:
+		response = StreamingHttpResponse(chunks, content_type='text/csv; charset=utf-8' if fmt == 'csv' else 'application/x-ndjson; charset=utf-8')
+	response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+	return response
 
-	# cat_name = range(1,32)
-	# stat_name = Scan.objects.order_by().values_list('scan_status', flat=True).distinct()
+def cache_stats(request):
+	'''
+	Wellness cache hit/miss counters for the worker that serves the request.
+	'''
+	return HttpResponse(dumps(stats(), indent=4, sort_keys=True), content_type="application/json")
 
-	counts = Scan.objects.exclude(scan_status__exact='').exclude(scan_status__isnull=True).values('scan_status').annotate(total=Count('scan_status')).order_by('scan_status')
-	x = []
-	factors = []
+def scan_log_stats(request):
+	'''
+	Write-behind scan log counters (queued, written, pending, dropped, ...) for the worker that serves the request.
+	'''
+	return HttpResponse(dumps(recorder.stats(), indent=4, sort_keys=True), content_type="application/json")
 
-	for count in counts:
-		x.append(count.values()[0])
-		factors.append(count.values()[1])
+def prometheus_metrics(request):
+	'''
+	Prometheus scrape endpoint: request/stage latencies, SQL and upstream counts (metrics.py), plus the wellness cache, scan log and circuit breaker numbers, for the worker that serves the request.
+	The Nutritionix quota gauges are for the shared bucket (quota.py), so every worker reports the same ones.
+	'''
+	cache = stats()
+	scan_log = recorder.stats()
+	nutritionix = quota.nutritionix.status()
+	extra = [
+		('cafb_wellness_cache_total', 'counter', 'Wellness cache lookups, by result.', [
+			({'result': 'hit'}, cache['hits']), ({'result': 'unknown_hit'}, cache['unknown_hits']), ({'result': 'catalog_hit'}, cache['catalog_hits']), ({'result': 'miss'}, cache['misses'])]),
+		('cafb_scan_log_total', 'counter', 'Scan rows through the write-behind log, by what happened to them.', [
+			({'event': event}, scan_log[event]) for event in ('queued', 'written', 'sync_writes', 'dropped')]),
+		('cafb_scan_log_pending', 'gauge', 'Scan rows waiting to be written.', [({}, scan_log['pending'])]),
+		('cafb_upstream_breaker_open', 'gauge', '1 while the circuit breaker for an upstream host is open or half-open.', [
+			({'host': host}, int(breaker['state'] != 'closed')) for host, breaker in sorted(client.status().items())]),
+		('cafb_nutritionix_quota_used', 'gauge', 'Nutritionix calls made today (UTC).', [({}, nutritionix['used'])]),
+		('cafb_nutritionix_quota_remaining', 'gauge', 'Nutritionix calls left in today\'s quota.', [({}, nutritionix['remaining'])]),
+		('cafb_nutritionix_quota_available', 'gauge', 'Nutritionix calls that could be made right now, by priority.', [
+			({'priority': priority}, available) for priority, available in sorted(nutritionix['available'].items())]),
+	]
+	return HttpResponse(metrics.render(extra), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def lollipop(title, counts):
+	'''
+	Horizontal lollipop chart of {label: count}.
+	'''
+	factors = sorted(counts.keys())
+	x = [counts[factor] for factor in factors]
 
-	plot = figure(plot_width=800, plot_height=300, title="scans via app", y_range=factors, x_range=[0,20])
+	plot = figure(plot_width=800, plot_height=300, title=title, y_range=factors, x_range=[0, max(x + [1]) * 1.1])
 	plot.segment(0, factors, x, factors, line_width=2, line_color="green", )
 	plot.circle(x, factors, size=15, fill_color="orange", line_color="green", line_width=3)
+	return plot
 
-	x = []
-	factors = []
-	sources = UPC.objects.values('data_source').annotate(total=Count('data_source')).order_by('data_source')
-	for source in sources:
-		x.append(source.values()[0])
-		factors.append(source.values()[1])
-
-	plot2 = figure(plot_width=800, plot_height=300, title="source for upcs", y_range=factors, x_range=[0,100])
-	plot2.segment(0, factors, x, factors, line_width=2, line_color="green", )
-	plot2.circle(x, factors, size=15, fill_color="orange", line_color="green", line_width=3)
-
-	script1, div1 = components(plot, CDN)
-	script2, div2 = components(plot2, CDN)
-
-	# scans by food group
-
-	# wellness vs. nonwellness 
-
-	return render(request, "scan_tracker.html", {"the_script1": script1, "the_div1": div1, "the_script2": script2, "the_div2": div2})
-
-
-
-
-
-
+def rollup_totals(field):
+	'''
+	Scan counts by one rollup column, from the daily rollups.
+	'''
+	totals = ScanRollup.objects.filter(period='day').order_by().values_list(field).annotate(total=Sum('total'))
+	return dict((label or 'none', total) for label, total in totals)
 
+def scan_tracker(request):
+	# charts only read the rollup tables (see rollups.py), and the rendered charts are cached for a bit
+	cache = caches['default']
+	context = cache.get('scan_tracker')
+	if context is None:
+		statuses = rollup_totals('scan_status')
+		statuses.pop('none', None)
+		plots = [
+			lollipop("scans via app", statuses),
+			lollipop("source for scanned upcs", rollup_totals('data_source')),
+			# scans by food group
+			lollipop("scans by food group", rollup_totals('food_cat')),
+			# wellness vs. nonwellness 
+			lollipop("wellness vs. non-wellness scans", rollup_totals('wellness')),
+		]
+
+		context = {}
+		for i, plot in enumerate(plots, 1):
+			context["the_script%d" % i], context["the_div%d" % i] = components(plot, CDN)
+		cache.set('scan_tracker', context, getattr(settings, 'SCAN_TRACKER_TTL', 60))
+
+	return render(request, "scan_tracker.html", context)
@@ -0,0 +1,28 @@
+# Gunicorn settings, see the Procfile.
+#
+# Sync workers (the default) serve one request at a time, so a scan waiting on OFF or Nutritionix
+# holds a whole worker and cache hits queue up behind it. With GUNICORN_WORKER_CLASS=gevent each
+# worker serves up to GUNICORN_WORKER_CONNECTIONS requests as greenlets, and one that is waiting
+# on an upstream API or the database lets the others run. See "Workers" in production.py.
+import os
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', '8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 50))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+
+# the app must be imported after a gevent worker has patched the standard library, so that
+# thread locals (Django's database connections, the per-request metrics) are per greenlet
+preload_app = False
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # psycopg2 waits on the socket in C, blocking every greenlet, unless it's told to wait through gevent
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            server.log.warning('psycogreen is not installed; database queries will block the whole worker')
+        else:
+            patch_psycopg()